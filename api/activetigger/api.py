@@ -1,11 +1,12 @@
+import asyncio
 import importlib
 import logging
-import time
 from contextlib import asynccontextmanager
 from io import StringIO
 from typing import Annotated, Any, Dict, List
 
 import pandas as pd
+from anyio import to_thread
 from fastapi import (
     Depends,
     FastAPI,
@@ -15,6 +16,7 @@ from fastapi import (
     Request,
     Response,
 )
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, HTMLResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -31,8 +33,10 @@ from activetigger.datamodels import (
     BertModelModel,
     DocumentationModel,
     ElementOutModel,
+    ElementsOutModel,
     FeatureModel,
     GenerateModel,
+    NextBatchInModel,
     NextInModel,
     ProjectAuthsModel,
     ProjectDataModel,
@@ -43,6 +47,7 @@ from activetigger.datamodels import (
     ProjectStateModel,
     ReconciliationModel,
     SchemeModel,
+    SimpleModelAutoModel,
     SimpleModelModel,
     SimpleModelOutModel,
     TableAnnotationsModel,
@@ -126,7 +131,56 @@ logger_simplemodel = logging.getLogger("simplemodel")
 
 # start the backend server
 server = Server()
-timer = time.time()
+
+
+def update_processes() -> None:
+    """
+    Update app state
+    (i.e. joining parallel processes)
+    """
+    # check the queue to see if process are completed
+    server.queue.check()
+
+    # update processes for active projects
+    for project in list(server.projects.values()):
+        project.update_processes()
+
+    # unload projects if too much memory is used (they will be loaded if needed)
+    server.evict_projects()
+
+    # logs waiting to be written
+    server.db_manager.flush_logs()
+
+    # jobs of the workers of the api which stopped
+    if server.shared:
+        server.recover_jobs()
+
+
+async def collect_processes(completed: asyncio.Event, step: int = 5) -> None:
+    """
+    Background task taking care of completed processes
+    - woken up by the queue each time a process is done
+    - at least every step seconds for the housekeeping
+    - executed in the threadpool not to block the event loop
+    """
+    while True:
+        try:
+            await asyncio.wait_for(completed.wait(), timeout=step)
+        except asyncio.TimeoutError:
+            pass
+        completed.clear()
+        try:
+            await run_in_threadpool(update_processes)
+        except Exception as e:
+            logger.error(f"Error in updating processes: {e}")
+
+
+def wake_up() -> None:
+    """
+    Wake up the background task before its next step
+    """
+    if server.queue.notify is not None:
+        server.queue.notify()
 
 
 @asynccontextmanager
@@ -135,9 +189,18 @@ async def lifespan(app: FastAPI):
     Frame the execution of the api
     """
     print("Active Tigger starting")
+    # bounded pool for the sync routes (blocking pandas/sql work)
+    to_thread.current_default_thread_limiter().total_tokens = server.threads
+    loop = asyncio.get_running_loop()
+    completed = asyncio.Event()
+    server.queue.notify = lambda: loop.call_soon_threadsafe(completed.set)
+    task = asyncio.create_task(collect_processes(completed))
     yield
     print("Active Tigger closing")
+    task.cancel()
+    server.queue.notify = None
     server.queue.close()
+    server.db_manager.flush_logs()
 
 
 app = FastAPI(lifespan=lifespan)  # defining the fastapi app
@@ -148,58 +211,6 @@ oauth2_scheme = OAuth2PasswordBearer(
 )  # defining the authentification object
 
 
-async def check_processes(timer, step: int = 1) -> None:
-    """
-    Function called to update app state
-    (i.e. joining parallel processes)
-    Limited to once per time interval
-    """
-    # max one update per second to avoid excessive action
-    if (time.time() - timer) < step:
-        return None
-    timer = time.time()
-
-    # check the queue to see if process are completed
-    server.queue.check()
-
-    # update processes for active projects
-    to_del = []
-    for p, project in server.projects.items():
-        # if project existing since one day, remove it from memory
-        if (timer - project.starting_time) > 86400:
-            to_del.append(p)
-
-        # update pending processes
-        project.features.update_processes()
-        project.simplemodels.update_processes()
-        project.generations.update_generations()
-        predictions = project.bertmodels.update_processes()
-
-        # if predictions completed, add them as features
-        # careful : they are categorical variables
-        if len(predictions) > 0:
-            for f in predictions:
-                df_num = functions.cat2num(predictions[f])
-                name = f.replace("__", "_")
-                project.features.add(name, df_num)  # avoid __ in the name for features
-                print("Add feature", name)
-
-    # delete old project (they will be loaded if needed)
-    for p in to_del:
-        del server.projects[p]
-
-
-@app.middleware("http")
-async def middleware(request: Request, call_next):
-    """
-    Middleware to take care of completed processes
-    Executed at each action on the server
-    """
-    await check_processes(timer)
-    response = await call_next(request)
-    return response
-
-
 app.add_middleware(
     CORSMiddleware,
     # TODO: move origins in config
@@ -214,27 +225,27 @@ app.add_middleware(
 # ------------
 
 
-async def get_project(project_slug: str) -> ProjectModel:
+def get_project(project_slug: str) -> ProjectModel:
     """
     Dependencie to get existing project
     - if already loaded, return it
     - if not loaded, load it first
+    Comments:
+        sync to be executed in the threadpool (loading can be long)
     """
 
     # if project doesn't exist
     if not server.exists(project_slug):
         raise HTTPException(status_code=404, detail="Project not found")
 
-    # if the project is already loaded
-    if project_slug in server.projects:
-        return server.projects[project_slug]
+    # loaded if needed, and not unloaded during the request
+    with server.use_project(project_slug) as project:
+        if project is None:
+            raise HTTPException(status_code=500, detail="Project could not be loaded")
+        yield project
 
-    # load it
-    server.start_project(project_slug)
-    return server.projects[project_slug]
 
-
-async def verified_user(
+def verified_user(
     request: Request, token: Annotated[str, Depends(oauth2_scheme)]
 ) -> UserInDBModel:
     """
@@ -260,7 +271,7 @@ async def verified_user(
     return user
 
 
-async def check_auth_exists(
+def check_auth_exists(
     request: Request,
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     project_slug: str | None = None,
@@ -275,7 +286,7 @@ async def check_auth_exists(
     return None
 
 
-async def check_auth_manager(
+def check_auth_manager(
     request: Request,
     username: Annotated[str, Header()],
     project_slug: str | None = None,
@@ -328,7 +339,7 @@ async def get_documentation() -> DocumentationModel:
 
 
 @app.post("/token")
-async def login_for_access_token(
+def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
 ) -> TokenModel:
     """
@@ -346,7 +357,7 @@ async def login_for_access_token(
 
 
 @app.post("/users/disconnect", dependencies=[Depends(verified_user)])
-async def disconnect_user(token: Annotated[str, Depends(oauth2_scheme)]) -> None:
+def disconnect_user(token: Annotated[str, Depends(oauth2_scheme)]) -> None:
     """
     Revoke user connexion
     """
@@ -355,7 +366,7 @@ async def disconnect_user(token: Annotated[str, Depends(oauth2_scheme)]) -> None
 
 
 @app.get("/users/me")
-async def read_users_me(
+def read_users_me(
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
 ) -> UserModel:
     """
@@ -365,7 +376,7 @@ async def read_users_me(
 
 
 @app.get("/users", dependencies=[Depends(verified_user)])
-async def existing_users() -> UsersServerModel:
+def existing_users() -> UsersServerModel:
     """
     Get existing users
     """
@@ -375,7 +386,7 @@ async def existing_users() -> UsersServerModel:
 
 
 @app.post("/users/create", dependencies=[Depends(verified_user)])
-async def create_user(
+def create_user(
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     username_to_create: str = Query(),
     password: str = Query(),
@@ -394,7 +405,7 @@ async def create_user(
 
 
 @app.post("/users/delete", dependencies=[Depends(verified_user)])
-async def delete_user(
+def delete_user(
     current_user: Annotated[UserInDBModel, Depends(verified_user)], user_to_delete: str
 ) -> None:
     """
@@ -408,7 +419,7 @@ async def delete_user(
 
 
 @app.post("/users/auth/{action}", dependencies=[Depends(verified_user)])
-async def set_auth(
+def set_auth(
     action: AuthActions,
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     username: str = Query(),
@@ -436,7 +447,7 @@ async def set_auth(
 
 
 @app.get("/users/auth", dependencies=[Depends(verified_user)])
-async def get_auth(username: str) -> List:
+def get_auth(username: str) -> List:
     """
     Get all user auth
     """
@@ -444,7 +455,7 @@ async def get_auth(username: str) -> List:
 
 
 @app.get("/logs", dependencies=[Depends(verified_user)])
-async def get_logs(
+def get_logs(
     username: str, project_slug: str = "all", limit: int = 100
 ) -> TableOutModel:
     """
@@ -465,7 +476,7 @@ async def get_logs(
     "/projects/{project_slug}",
     dependencies=[Depends(verified_user), Depends(check_auth_exists)],
 )
-async def get_project_state(
+def get_project_state(
     project: Annotated[Project, Depends(get_project)],
 ) -> ProjectStateModel:
     """
@@ -478,7 +489,7 @@ async def get_project_state(
 
 
 @app.get("/projects/{project_slug}/statistics", dependencies=[Depends(verified_user)])
-async def get_project_statistics(
+def get_project_statistics(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str | None = None,
@@ -493,7 +504,7 @@ async def get_project_statistics(
 
 
 @app.get("/projects")
-async def get_projects(
+def get_projects(
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
 ) -> AvailableProjectsModel:
     """
@@ -507,13 +518,38 @@ async def get_projects(
 
 
 @app.get("/queue")
-async def get_queue() -> dict:
+def get_queue() -> dict:
     """
     Get the state of the server queue
     """
     r = server.queue.state()
-    # only running processes for the moment
-    return {i: r[i] for i in r if r[i]["state"] == "running"}
+    # running processes (with their progress) and waiting ones
+    return {i: r[i] for i in r if r[i]["state"] in ["running", "pending"]}
+
+
+@app.post("/queue/kill", dependencies=[Depends(verified_user)])
+def kill_queue_process(
+    current_user: Annotated[UserInDBModel, Depends(verified_user)],
+    unique_id: str,
+) -> None:
+    """
+    Stop a process of the queue (root or the user who launched it)
+    Comments:
+        a process of another worker of the api is killed by this worker
+    """
+    state = server.queue.state()
+    if unique_id not in state:
+        raise HTTPException(status_code=404, detail="Process doesn't exist")
+    if current_user.username not in ["root", state[unique_id]["user"]]:
+        raise HTTPException(status_code=403, detail="Forbidden: Invalid rights")
+    if unique_id in server.queue.current:
+        r = server.queue.kill(unique_id)
+    else:
+        r = server.queue.kill_remote(unique_id)
+    if "error" in r:
+        raise HTTPException(status_code=500, detail=r["error"])
+    server.log_action(current_user.username, f"kill process {unique_id}")
+    return None
 
 
 @app.get("/queue/num")
@@ -525,7 +561,7 @@ async def get_nb_queue() -> int:
 
 
 @app.get("/projects/description", dependencies=[Depends(verified_user)])
-async def get_description(
+def get_description(
     project: Annotated[Project, Depends(get_project)],
     scheme: str | None = None,
     user: str | None = None,
@@ -540,7 +576,7 @@ async def get_description(
 
 
 @app.get("/auth/project", dependencies=[Depends(verified_user)])
-async def get_project_auth(project_slug: str) -> ProjectAuthsModel:
+def get_project_auth(project_slug: str) -> ProjectAuthsModel:
     """
     Users auth on a project
     """
@@ -553,7 +589,7 @@ async def get_project_auth(project_slug: str) -> ProjectAuthsModel:
 
 
 @app.post("/projects/testset", dependencies=[Depends(verified_user)])
-async def add_testdata(
+def add_testdata(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     testset: TestSetDataModel,
@@ -577,7 +613,7 @@ async def add_testdata(
 
 
 @app.post("/projects/new", dependencies=[Depends(verified_user)])
-async def new_project(
+def new_project(
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     project: ProjectDataModel,
 ) -> None:
@@ -610,7 +646,7 @@ async def new_project(
     "/projects/delete",
     dependencies=[Depends(verified_user), Depends(check_auth_exists)],
 )
-async def delete_project(
+def delete_project(
     project_slug: str,
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
 ) -> None:
@@ -627,7 +663,7 @@ async def delete_project(
 
 
 @app.post("/elements/next", dependencies=[Depends(verified_user)])
-async def get_next(
+def get_next(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     next: NextInModel,
@@ -652,8 +688,38 @@ async def get_next(
     return ElementOutModel(**r)
 
 
+@app.post("/elements/next/batch", dependencies=[Depends(verified_user)])
+def get_next_batch(
+    project: Annotated[Project, Depends(get_project)],
+    current_user: Annotated[UserInDBModel, Depends(verified_user)],
+    next: NextBatchInModel,
+) -> ElementsOutModel:
+    """
+    Get a batch of next elements
+    reserved for the user during the lease
+    """
+    r = project.get_next_batch(
+        scheme=next.scheme,
+        n_elements=next.n_elements,
+        selection=next.selection,
+        sample=next.sample,
+        user=current_user.username,
+        tag=next.tag,
+        history=next.history,
+        frame=next.frame,
+        filter=next.filter,
+        lease=next.lease,
+    )
+
+    if "error" in r:
+        raise HTTPException(status_code=500, detail=r["error"])
+    for e in r["success"]:
+        e["context"] = {}
+    return ElementsOutModel(elements=[ElementOutModel(**e) for e in r["success"]])
+
+
 @app.get("/elements/projection", dependencies=[Depends(verified_user)])
-async def get_projection(
+def get_projection(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str | None,
@@ -688,7 +754,7 @@ async def get_projection(
 
 
 @app.get("/elements/projection/current", dependencies=[Depends(verified_user)])
-async def get_projection(
+def get_projection(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str | None,
@@ -730,7 +796,7 @@ async def get_projection(
 
 
 @app.post("/elements/projection/compute", dependencies=[Depends(verified_user)])
-async def compute_projection(
+def compute_projection(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     projection: ProjectionInStrictModel,
@@ -753,14 +819,18 @@ async def compute_projection(
             raise HTTPException(status_code=500, detail=str(e))
 
         args = {"features": features, "params": e.__dict__}
-        unique_id = server.queue.add("projection", functions.compute_umap, args)
+        unique_id = server.queue.add(
+            "projection",
+            functions.compute_umap,
+            args,
+            project_slug=project.params.project_slug,
+            user=current_user.username,
+        )
         if unique_id == "error":
             raise HTTPException(status_code=500, detail="Error in adding in the queue")
-        project.features.projections[current_user.username] = {
-            "params": projection,
-            "method": "umap",
-            "queue": unique_id,
-        }
+        project.features.add_projection(
+            current_user.username, unique_id, "umap", projection
+        )
         return WaitingModel(detail="Projection umap is computing")
 
     if projection.method == "tsne":
@@ -770,20 +840,24 @@ async def compute_projection(
         except ValidationError as e:
             raise HTTPException(status_code=500, detail=str(e))
         args = {"features": features, "params": e.__dict__}
-        unique_id = server.queue.add("projection", functions.compute_tsne, args)
+        unique_id = server.queue.add(
+            "projection",
+            functions.compute_tsne,
+            args,
+            project_slug=project.params.project_slug,
+            user=current_user.username,
+        )
         if unique_id == "error":
             raise HTTPException(status_code=500, detail="Error in adding in the queue")
-        project.features.projections[current_user.username] = {
-            "params": projection,
-            "method": "tsne",
-            "queue": unique_id,
-        }
+        project.features.add_projection(
+            current_user.username, unique_id, "tsne", projection
+        )
         return WaitingModel(detail="Projection tsne is computing")
     raise HTTPException(status_code=400, detail="Projection not available")
 
 
 @app.get("/elements/table", dependencies=[Depends(verified_user)])
-async def get_list_elements(
+def get_list_elements(
     project: Annotated[Project, Depends(get_project)],
     scheme: str,
     min: int = 0,
@@ -807,7 +881,7 @@ async def get_list_elements(
 
 
 @app.post("/annotation/table", dependencies=[Depends(verified_user)])
-async def post_list_elements(
+def post_list_elements(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     table: TableAnnotationsModel,
@@ -816,25 +890,37 @@ async def post_list_elements(
     Update a table of annotations
     """
     errors = []
-    # loop on annotations
+    # valid annotations by scheme
+    available = project.schemes.available()
+    schemes = {}
     for annotation in table.annotations:
-        if annotation.label is None or annotation.element_id is None:
+        if (
+            annotation.label is None
+            or annotation.element_id is None
+            or annotation.scheme not in available
+            or annotation.label not in available[annotation.scheme]
+        ):
             errors.append(annotation)
             continue
-
-        r = project.schemes.push_tag(
-            annotation.element_id,
-            annotation.label,
-            annotation.scheme,
+        schemes.setdefault(annotation.scheme, []).append(annotation)
+
+    # recorded in bulk
+    for scheme, annotations in schemes.items():
+        r = project.schemes.push_tags(
+            [a.element_id for a in annotations],
+            [a.label for a in annotations],
+            scheme,
             current_user.username,
             table.dataset,
         )
         if "error" in r:
-            errors.append(annotation)
+            errors += annotations
             continue
+        if project.simplemodels.add_annotations(scheme, len(annotations)):
+            wake_up()
         server.log_action(
             current_user.username,
-            f"update annotation {annotation.element_id}",
+            f"update annotations {scheme} ({len(annotations)} elements)",
             project.name,
         )
 
@@ -848,7 +934,7 @@ async def post_list_elements(
 
 
 @app.get("/elements/reconciliate", dependencies=[Depends(verified_user)])
-async def get_reconciliation_table(
+def get_reconciliation_table(
     project: Annotated[Project, Depends(get_project)], scheme: str
 ) -> ReconciliationModel:
     """
@@ -864,7 +950,7 @@ async def get_reconciliation_table(
 
 
 @app.post("/elements/reconciliate", dependencies=[Depends(verified_user)])
-async def post_reconciliation(
+def post_reconciliation(
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     project: Annotated[Project, Depends(get_project)],
     users: list = Query(),
@@ -898,7 +984,7 @@ async def post_reconciliation(
 
 
 @app.post("/elements/generate/start", dependencies=[Depends(verified_user)])
-async def postgenerate(
+def postgenerate(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     request: GenerateModel,
@@ -926,7 +1012,13 @@ async def postgenerate(
         "prompt": request.prompt,
     }
 
-    unique_id = server.queue.add("generation", functions.generate, args)
+    unique_id = server.queue.add(
+        "generation",
+        functions.generate,
+        args,
+        project_slug=project.params.project_slug,
+        user=current_user.username,
+    )
 
     if unique_id == "error":
         raise HTTPException(
@@ -941,7 +1033,7 @@ async def postgenerate(
 
 
 @app.post("/elements/generate/stop", dependencies=[Depends(verified_user)])
-async def stop_generation(
+def stop_generation(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
 ) -> None:
@@ -959,7 +1051,7 @@ async def stop_generation(
 
 
 @app.get("/elements/generate/elements", dependencies=[Depends(verified_user)])
-async def getgenerate(
+def getgenerate(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     n_elements: int,
@@ -982,7 +1074,7 @@ async def getgenerate(
 
 
 @app.get("/elements/{element_id}", dependencies=[Depends(verified_user)])
-async def get_element(
+def get_element(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     element_id: str,
@@ -1001,7 +1093,7 @@ async def get_element(
 
 
 @app.post("/annotation/{action}", dependencies=[Depends(verified_user)])
-async def post_tag(
+def post_tag(
     action: ActionModel,
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     project: Annotated[Project, Depends(get_project)],
@@ -1024,6 +1116,8 @@ async def post_tag(
 
         if "error" in r:
             raise HTTPException(status_code=500, detail=r["error"])
+        if project.simplemodels.add_annotations(annotation.scheme):
+            wake_up()
 
         server.log_action(
             current_user.username,
@@ -1054,7 +1148,7 @@ async def post_tag(
 
 
 @app.post("/schemes/label/add", dependencies=[Depends(verified_user)])
-async def add_label(
+def add_label(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str,
@@ -1075,7 +1169,7 @@ async def add_label(
 
 
 @app.post("/schemes/label/delete", dependencies=[Depends(verified_user)])
-async def delete_label(
+def delete_label(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str,
@@ -1096,7 +1190,7 @@ async def delete_label(
 
 
 @app.post("/schemes/label/rename", dependencies=[Depends(verified_user)])
-async def rename_label(
+def rename_label(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str,
@@ -1142,7 +1236,7 @@ async def rename_label(
 
 
 @app.post("/schemes/{action}", dependencies=[Depends(verified_user)])
-async def post_schemes(
+def post_schemes(
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     project: Annotated[Project, Depends(get_project)],
     action: ActionModel,
@@ -1185,7 +1279,7 @@ async def post_schemes(
 
 
 @app.get("/features", dependencies=[Depends(verified_user)])
-async def get_features(project: Annotated[Project, Depends(get_project)]) -> List[str]:
+def get_features(project: Annotated[Project, Depends(get_project)]) -> List[str]:
     """
     Available scheme of a project
     """
@@ -1193,7 +1287,7 @@ async def get_features(project: Annotated[Project, Depends(get_project)]) -> Lis
 
 
 @app.post("/features/add", dependencies=[Depends(verified_user)])
-async def post_embeddings(
+def post_embeddings(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     feature: FeatureModel,
@@ -1257,33 +1351,9 @@ async def post_embeddings(
         return None
 
     # Features necessitating computation on the text
-    df = project.content["text"]
-
-    # Add SBERT transformation
-    if feature.type == "sbert":
-        args = {"texts": df, "model": "distiluse-base-multilingual-cased-v1"}
-        func = functions.to_sbert
-
-    # Add fasttext transformation
-    if feature.type == "fasttext":
-        args = {
-            "texts": df,
-            "language": project.params.language,
-            "path_models": server.path_models,
-        }
-        func = functions.to_fasttext
-
-    # Add Data Frequency Matrice
-    if feature.type == "dfm":
-        args = feature.parameters
-        args["texts"] = df
-        func = functions.to_dtm
-
-    # add the computation to queue
-    unique_id = server.queue.add("feature", func, args)
-    if unique_id == "error":
-        raise HTTPException(status_code=500, detail="Error in adding in the queue")
-    project.features.training[feature.name] = unique_id
+    r = project.compute_feature(feature, current_user.username)
+    if "error" in r:
+        raise HTTPException(status_code=500, detail=r["error"])
 
     # Log and return
     server.log_action(current_user.username, "Compute feature dfm", project.name)
@@ -1291,7 +1361,7 @@ async def post_embeddings(
 
 
 @app.post("/features/delete", dependencies=[Depends(verified_user)])
-async def delete_feature(
+def delete_feature(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     name: str,
@@ -1313,7 +1383,7 @@ async def delete_feature(
 
 
 @app.post("/models/simplemodel", dependencies=[Depends(verified_user)])
-async def post_simplemodel(
+def post_simplemodel(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     simplemodel: SimpleModelModel,
@@ -1329,8 +1399,30 @@ async def post_simplemodel(
     return None
 
 
+@app.post("/models/simplemodel/auto", dependencies=[Depends(verified_user)])
+def post_simplemodel_auto(
+    project: Annotated[Project, Depends(get_project)],
+    current_user: Annotated[UserInDBModel, Depends(verified_user)],
+    autotrain: SimpleModelAutoModel,
+) -> None:
+    """
+    Train the simplemodel again automatically with new annotations
+    """
+    r = project.simplemodels.set_autotrain(
+        current_user.username, autotrain.scheme, autotrain.every, autotrain.delay
+    )
+    if "error" in r:
+        raise HTTPException(status_code=500, detail=r["error"])
+    server.log_action(
+        current_user.username,
+        f"automatic simplemodel every {autotrain.every} annotations / {autotrain.delay} s",
+        project.name,
+    )
+    return None
+
+
 @app.get("/models/simplemodel", dependencies=[Depends(verified_user)])
-async def get_simplemodel(
+def get_simplemodel(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str,
@@ -1345,7 +1437,7 @@ async def get_simplemodel(
 
 
 @app.get("/models/bert", dependencies=[Depends(verified_user)])
-async def get_bert(
+def get_bert(
     project: Annotated[Project, Depends(get_project)], name: str
 ) -> Dict[str, Any]:
     """
@@ -1359,7 +1451,7 @@ async def get_bert(
 
 
 @app.post("/models/bert/predict", dependencies=[Depends(verified_user)])
-async def predict(
+def predict(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     model_name: str,
@@ -1381,7 +1473,7 @@ async def predict(
 
 
 @app.post("/models/bert/train", dependencies=[Depends(verified_user)])
-async def post_bert(
+def post_bert(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     bert: BertModelModel,
@@ -1412,7 +1504,7 @@ async def post_bert(
 
 
 @app.post("/models/bert/stop", dependencies=[Depends(verified_user)])
-async def stop_bert(
+def stop_bert(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
 ) -> None:
@@ -1430,7 +1522,7 @@ async def stop_bert(
 
 
 @app.post("/models/bert/test", dependencies=[Depends(verified_user)])
-async def start_test(
+def start_test(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     scheme: str,
@@ -1464,7 +1556,7 @@ async def start_test(
 
 
 @app.post("/models/bert/delete", dependencies=[Depends(verified_user)])
-async def delete_bert(
+def delete_bert(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     bert_name: str,
@@ -1484,7 +1576,7 @@ async def delete_bert(
 
 
 @app.post("/models/bert/rename", dependencies=[Depends(verified_user)])
-async def save_bert(
+def save_bert(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     former_name: str,
@@ -1511,7 +1603,7 @@ async def save_bert(
 
 
 @app.get("/export/data", dependencies=[Depends(verified_user)])
-async def export_data(
+def export_data(
     project: Annotated[Project, Depends(get_project)], scheme: str, format: str
 ) -> FileResponse:
     """
@@ -1524,7 +1616,7 @@ async def export_data(
 
 
 @app.get("/export/features", dependencies=[Depends(verified_user)])
-async def export_features(
+def export_features(
     project: Annotated[Project, Depends(get_project)],
     features: list = Query(),
     format: str = Query(),
@@ -1539,7 +1631,7 @@ async def export_features(
 
 
 @app.get("/export/prediction", dependencies=[Depends(verified_user)])
-async def export_prediction(
+def export_prediction(
     project: Annotated[Project, Depends(get_project)],
     format: str = Query(),
     name: str = Query(),
@@ -1554,7 +1646,7 @@ async def export_prediction(
 
 
 @app.get("/export/bert", dependencies=[Depends(verified_user)])
-async def export_bert(
+def export_bert(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     name: str = Query(),
@@ -1569,7 +1661,7 @@ async def export_bert(
 
 
 @app.get("/export/generations", dependencies=[Depends(verified_user)])
-async def export_generations(
+def export_generations(
     project: Annotated[Project, Depends(get_project)],
     current_user: Annotated[UserInDBModel, Depends(verified_user)],
     number: int = Query(),
@@ -3,7 +3,7 @@ from pathlib import Path
 from typing import Any, Dict, List, Optional, Union
 
 from pandas import DataFrame
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 # Data model to use of the API
 
@@ -79,6 +79,16 @@ class NextInModel(BaseModel):
     filter: Optional[str] = None
 
 
+class NextBatchInModel(NextInModel):
+    """
+    Requesting a batch of next elements to annotate
+    reserved for the user during the lease (in seconds)
+    """
+
+    n_elements: int = Field(10, ge=1, le=100)
+    lease: int = Field(300, ge=1, le=3600)
+
+
 class ElementOutModel(BaseModel):
     """
     Posting element to annotate
@@ -95,6 +105,14 @@ class ElementOutModel(BaseModel):
     history: list
 
 
+class ElementsOutModel(BaseModel):
+    """
+    Posting a batch of elements to annotate
+    """
+
+    elements: List[ElementOutModel]
+
+
 class UserModel(BaseModel):
     """
     User definition
@@ -189,6 +207,20 @@ class SimpleModelModel(BaseModel):
     # TODO CAN BE BETTER
     scheme: str
     standardize: Optional[bool] = True
+    incremental: Optional[bool] = True  # start from the previous model
+    cv10: Optional[bool] = True  # crossvalidation (computed afterwards)
+
+
+class SimpleModelAutoModel(BaseModel):
+    """
+    Automatic training of the simplemodel of a user
+    every n new annotations and/or after a delay (seconds)
+    (both None to stop it)
+    """
+
+    scheme: str
+    every: Optional[int] = None
+    delay: Optional[float] = None
 
 
 class SimpleModelOutModel(BaseModel):
@@ -206,6 +238,7 @@ class SimpleModelOutModel(BaseModel):
     scheme: str
     username: str
     statistics: dict
+    autotrain: Optional[dict] = None
 
 
 class BertModelParametersModel(BaseModel):
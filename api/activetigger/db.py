@@ -1,18 +1,29 @@
 import datetime
+import hashlib
 import json
+import threading
+import time
 from pathlib import Path
 
 from sqlalchemy import (
     TIMESTAMP,
     Column,
+    Index,
     Integer,
     String,
     Text,
     create_engine,
+    event,
     func,
+    insert,
+    inspect,
     select,
+    text,
 )
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import DatabaseError, IntegrityError
+from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
 
 from activetigger.functions import get_hash, get_root_pwd
 
@@ -53,6 +64,28 @@ class Annotations(Base):
     element_id = Column(String)
     scheme = Column(String)
     annotation = Column(String)
+    __table_args__ = (
+        Index("ix_annotations_element", "project", "scheme", "element_id", "time"),
+        Index("ix_annotations_user", "project", "scheme", "user", "time"),
+        Index("ix_annotations_time", "project", "time"),
+    )
+
+
+class CurrentAnnotations(Base):
+    """
+    Last annotation of each element by scheme and action
+    (maintained with the annotations table)
+    """
+
+    __tablename__ = "current_annotations"
+    project = Column(String, primary_key=True)
+    scheme = Column(String, primary_key=True)
+    action = Column(String, primary_key=True)
+    element_id = Column(String, primary_key=True)
+    annotation = Column(String)
+    user = Column(String)
+    time = Column(TIMESTAMP)
+    annotation_id = Column(Integer)
 
 
 class Users(Base):
@@ -89,8 +122,17 @@ class Tokens(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     time_created = Column(TIMESTAMP, server_default=func.current_timestamp())
     token = Column(Text)
+    token_hash = Column(String)
     status = Column(String)
     time_revoked = Column(TIMESTAMP)
+    __table_args__ = (Index("ix_tokens_token_hash", "token_hash"),)
+
+
+def hash_token(token: str) -> str:
+    """
+    Hash of a token to look it up
+    """
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
 class Generations(Base):
@@ -105,33 +147,288 @@ class Generations(Base):
     answer = Column(Text)
 
 
+class Jobs(Base):
+    __tablename__ = "jobs"
+    id = Column(String, primary_key=True)
+    time_created = Column(TIMESTAMP, server_default=func.current_timestamp())
+    time_finished = Column(TIMESTAMP)
+    kind = Column(String)
+    project = Column(String)
+    user = Column(String)
+    name = Column(String)
+    digest = Column(String)
+    state = Column(String)
+    location = Column(Text)
+    params = Column(Text)
+    result = Column(Text)
+    worker = Column(String)
+
+
+class Shared(Base):
+    __tablename__ = "shared"
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+    time_modified = Column(
+        TIMESTAMP,
+        server_default=func.current_timestamp(),
+        onupdate=func.current_timestamp(),
+    )
+
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    time = Column(TIMESTAMP, server_default=func.current_timestamp())
+
+
+def add_annotations_indexes(db_manager) -> None:
+    """
+    Version 1 : composite indexes of the annotations
+    """
+    for index in Annotations.__table__.indexes:
+        index.create(db_manager.engine, checkfirst=True)
+
+
+def fill_current_annotations(db_manager) -> None:
+    """
+    Version 2 : current annotations built from their history
+    """
+    db_manager.build_current_annotations()
+
+
+def add_tokens_hash(db_manager) -> None:
+    """
+    Version 3 : tokens looked up by their hash
+    """
+    columns = [c["name"] for c in inspect(db_manager.engine).get_columns("tokens")]
+    if "token_hash" not in columns:
+        with db_manager.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE tokens ADD COLUMN token_hash VARCHAR"))
+    session = db_manager.Session()
+    for token in session.query(Tokens).filter(Tokens.token_hash.is_(None)):
+        token.token_hash = hash_token(token.token)
+    session.commit()
+    session.close()
+    for index in Tokens.__table__.indexes:
+        index.create(db_manager.engine, checkfirst=True)
+
+
+def add_jobs_worker(db_manager) -> None:
+    """
+    Version 4 : worker of the api running a job
+    """
+    columns = [c["name"] for c in inspect(db_manager.engine).get_columns("jobs")]
+    if "worker" not in columns:
+        with db_manager.engine.begin() as connection:
+            connection.execute(text("ALTER TABLE jobs ADD COLUMN worker VARCHAR"))
+
+
+# changes of the existing tables, in order (the new tables are created
+# with the metadata), a new database is created at the last version
+migrations = [
+    add_annotations_indexes,
+    fill_current_annotations,
+    add_tokens_hash,
+    add_jobs_worker,
+]
+
+
+def upsert_current_statement(dialect: str):
+    """
+    Insert or replace of the current annotations for the databases
+    supporting it (None for the others)
+    """
+    if dialect == "sqlite":
+        statement = sqlite_insert(CurrentAnnotations.__table__)
+    elif dialect == "postgresql":
+        statement = postgresql_insert(CurrentAnnotations.__table__)
+    else:
+        return None
+    return statement.on_conflict_do_update(
+        index_elements=["project", "scheme", "action", "element_id"],
+        set_={
+            c: statement.excluded[c]
+            for c in ["annotation", "user", "time", "annotation_id"]
+        },
+    )
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """
+    Settings of each SQLite connection
+    - WAL journal : readers don't wait for the writer
+    - synchronous NORMAL : no sync on each commit (safe with WAL)
+    - busy timeout : wait for the lock instead of failing
+    - cache (64 MB) and memory-mapped reads (256 MB)
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=30000")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
+
 class DatabaseManager:
     """
     Database management with SQLAlchemy
+    Comments:
+        one session by thread, reused between the calls
+        the logs are written by batches (at most log_delay seconds later)
     """
 
-    def __init__(self, path_db: str):
-        self.db_url = f"sqlite:///{path_db}"
+    logs: list
+    log_batch: int
+    log_delay: float
+    log_lock: threading.Lock
+    log_time: float
 
-        # test if the db exists, else create it
-        if not Path(path_db).exists():
-            self.create_db()
+    def __init__(self, db_url: str | Path):
+        """
+        Connect the database (SQLite file by default) and update its schema
+        db_url : SQLAlchemy URL, or path of a SQLite file
+        """
+        if "://" not in str(db_url):
+            db_url = f"sqlite:///{db_url}"
+        self.db_url = str(db_url)
 
         # connect the session
-        self.engine = create_engine(self.db_url)
-        self.Session = sessionmaker(bind=self.engine)
+        if self.db_url.startswith("sqlite"):
+            self.engine = create_engine(self.db_url)
+            event.listen(self.engine, "connect", set_sqlite_pragmas)
+        else:
+            self.engine = create_engine(self.db_url, pool_pre_ping=True)
+        self.Session = scoped_session(sessionmaker(bind=self.engine))
         self.default_user = "server"
 
+        # logs waiting to be written
+        self.logs = []
+        self.log_batch = 100
+        self.log_delay = 5
+        self.log_lock = threading.Lock()
+        self.log_time = time.time()
+
+        # create the tables or update them
+        self.migrate()
+
         # check if there is a root user, add it
         session = self.Session()
         if not session.query(Users).filter_by(user="root").first():
             self.create_root_session()
         session.close()
 
-    def create_db(self):
-        print("Create database")
-        self.engine = create_engine(self.db_url)
-        Base.metadata.create_all(self.engine)
+    def get_version(self) -> int:
+        """
+        Version of the schema of the database
+        """
+        session = self.Session()
+        version = (
+            session.query(func.max(SchemaVersion.version))
+            .filter(SchemaVersion.version > 0)
+            .scalar()
+        )
+        session.close()
+        return version or 0
+
+    def migrate(self) -> None:
+        """
+        Create the missing tables and apply the migrations
+        not yet applied on the database
+        Comments:
+            done by one worker at a time (the others wait, then
+            find the database at the last version)
+        """
+        try:
+            SchemaVersion.__table__.create(self.engine, checkfirst=True)
+        except DatabaseError:  # created by another worker meanwhile
+            pass
+        self.lock_migrations()
+        try:
+            new = "projects" not in inspect(self.engine).get_table_names()
+            if new:
+                print("Create database")
+            Base.metadata.create_all(self.engine)
+            start = len(migrations) if new else self.get_version()
+            for version in range(start, len(migrations)):
+                migrations[version](self)
+                print("Database migrated to version", version + 1)
+            session = self.Session()
+            for version in range(self.get_version(), len(migrations)):
+                session.add(SchemaVersion(version=version + 1))
+            session.commit()
+            session.close()
+        finally:
+            self.unlock_migrations()
+
+    def lock_migrations(self, timeout: float = 600) -> None:
+        """
+        Wait for the lock of the migrations (row of version -1 in
+        the versions of the schema)
+        Comments:
+            a lock older than timeout (seconds) is left by a worker
+            stopped meanwhile, it is removed
+        """
+        while True:
+            session = self.Session()
+            session.add(SchemaVersion(version=-1, time=datetime.datetime.now()))
+            try:
+                session.commit()
+                session.close()
+                return None
+            except IntegrityError:
+                session.rollback()
+            limit = datetime.datetime.now() - datetime.timedelta(seconds=timeout)
+            session.query(SchemaVersion).filter(
+                SchemaVersion.version == -1, SchemaVersion.time < limit
+            ).delete()
+            session.commit()
+            session.close()
+            time.sleep(0.2)
+
+    def unlock_migrations(self) -> None:
+        session = self.Session()
+        session.query(SchemaVersion).filter(SchemaVersion.version == -1).delete()
+        session.commit()
+        session.close()
+
+    def build_current_annotations(self) -> None:
+        """
+        Fill the current annotations from the history of the annotations
+        (if not already done)
+        """
+        session = self.Session()
+        if session.query(CurrentAnnotations).first() is not None:
+            session.close()
+            return None
+        last = (
+            session.query(func.max(Annotations.id))
+            .group_by(
+                Annotations.project,
+                Annotations.scheme,
+                Annotations.action,
+                Annotations.element_id,
+            )
+            .subquery()
+        )
+        rows = session.query(Annotations).filter(Annotations.id.in_(select(last))).all()
+        session.add_all(
+            [
+                CurrentAnnotations(
+                    project=a.project,
+                    scheme=a.scheme,
+                    action=a.action,
+                    element_id=a.element_id,
+                    annotation=a.annotation,
+                    user=a.user,
+                    time=a.time,
+                    annotation_id=a.id,
+                )
+                for a in rows
+            ]
+        )
+        session.commit()
+        session.close()
 
     def create_root_session(self) -> None:
         """
@@ -150,13 +447,38 @@ class DatabaseManager:
         session.close()
 
     def add_log(self, user: str, action: str, project_slug: str, connect: str):
+        """
+        Add a log, written with the next batch
+        """
+        log = {
+            "time": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None),
+            "user": user,
+            "project": project_slug,
+            "action": action,
+            "connect": connect,
+        }
+        with self.log_lock:
+            self.logs.append(log)
+            full = len(self.logs) >= self.log_batch
+        if full or time.time() - self.log_time > self.log_delay:
+            self.flush_logs()
+
+    def flush_logs(self) -> None:
+        """
+        Write the logs waiting in one transaction
+        """
+        with self.log_lock:
+            logs, self.logs = self.logs, []
+            self.log_time = time.time()
+        if len(logs) == 0:
+            return None
         session = self.Session()
-        log = Logs(user=user, project=project_slug, action=action, connect=connect)
-        session.add(log)
+        session.execute(insert(Logs.__table__), logs)
         session.commit()
         session.close()
 
     def get_logs(self, username: str, project_slug: str, limit: int):
+        self.flush_logs()
         session = self.Session()
         if project_slug == "all":
             logs = (
@@ -224,14 +546,14 @@ class DatabaseManager:
 
     def add_token(self, token: str, status: str):
         session = self.Session()
-        token = Tokens(token=token, status=status)
+        token = Tokens(token=token, token_hash=hash_token(token), status=status)
         session.add(token)
         session.commit()
         session.close()
 
     def get_token_status(self, token: str):
         session = self.Session()
-        token = session.query(Tokens).filter_by(token=token).first()
+        token = session.query(Tokens).filter_by(token_hash=hash_token(token)).first()
         session.close()
         if token:
             return token.status
@@ -240,7 +562,7 @@ class DatabaseManager:
 
     def revoke_token(self, token: str):
         session = self.Session()
-        token = session.query(Tokens).filter_by(token=token).first()
+        token = session.query(Tokens).filter_by(token_hash=hash_token(token)).first()
         token.time_revoked = datetime.datetime.now()
         token.status = "revoked"
         session.commit()
@@ -272,27 +594,24 @@ class DatabaseManager:
         scheme: str,
         annotation: str,
     ):
-        session = self.Session()
-        annotation = Annotations(
-            action=action,
-            user=user,
-            project=project_slug,
-            element_id=element_id,
-            scheme=scheme,
-            annotation=annotation,
-        )
-        session.add(annotation)
-        session.commit()
-        session.close()
+        self.post_annotation(project_slug, scheme, element_id, annotation, user, action)
 
     def delete_project(self, project_slug: str):
+        self.flush_logs()
         session = self.Session()
         session.query(Projects).filter(Projects.project_slug == project_slug).delete()
         session.query(Schemes).filter(Schemes.project == project_slug).delete()
         session.query(Annotations).filter(Annotations.project == project_slug).delete()
+        session.query(CurrentAnnotations).filter(
+            CurrentAnnotations.project == project_slug
+        ).delete()
         session.query(Auths).filter(Auths.project == project_slug).delete()
         session.query(Generations).filter(Generations.project == project_slug).delete()
         session.query(Logs).filter(Logs.project == project_slug).delete()
+        for prefix in ["lease", "projection"]:
+            session.query(Shared).filter(
+                Shared.key.startswith(f"{prefix}:{project_slug}:", autoescape=True)
+            ).delete(synchronize_session=False)
         session.commit()
         session.close()
 
@@ -318,6 +637,31 @@ class DatabaseManager:
         session.commit()
         session.close()
 
+    def add_generations(self, generations: list[dict]) -> None:
+        """
+        Add generated elements in one transaction
+        generations : [{user, project_slug, element_id, endpoint, prompt, answer}]
+        """
+        if len(generations) == 0:
+            return None
+        session = self.Session()
+        session.execute(
+            insert(Generations.__table__),
+            [
+                {
+                    "user": g["user"],
+                    "project": g["project_slug"],
+                    "element_id": g["element_id"],
+                    "endpoint": g["endpoint"],
+                    "prompt": g["prompt"],
+                    "answer": g["answer"],
+                }
+                for g in generations
+            ],
+        )
+        session.commit()
+        session.close()
+
     def get_generated(self, project_slug: str, username: str, n_elements: int = 10):
         """
         Get elements from generated table by order desc
@@ -339,14 +683,15 @@ class DatabaseManager:
     def get_distinct_users(self, project_slug: str, timespan: int | None):
         session = self.Session()
         if timespan:
-            time_threshold = datetime.datetime.now() - datetime.timedelta(
-                seconds=timespan
-            )
+            # same convention as the timestamps (UTC without timezone)
+            time_threshold = datetime.datetime.now(datetime.timezone.utc).replace(
+                tzinfo=None
+            ) - datetime.timedelta(seconds=timespan)
             users = (
                 session.query(Annotations.user)
                 .filter(
                     Annotations.project == project_slug,
-                    Annotations.time > time_threshold.timestamp(),
+                    Annotations.time > time_threshold,
                 )
                 .distinct()
                 .all()
@@ -430,7 +775,11 @@ class DatabaseManager:
         session.close()
         return [row.user for row in result]
 
-    def add_user(self, username: str, password: str, role: str, created_by: str):
+    def add_user(
+        self, username: str, password: str | bytes, role: str, created_by: str
+    ):
+        if isinstance(password, bytes):  # hash stored as text
+            password = password.decode()
         session = self.Session()
         user = Users(
             user=username, key=password, description=role, created_by=created_by
@@ -449,34 +798,92 @@ class DatabaseManager:
         session = self.Session()
         user = session.query(Users).filter(Users.user == username).first()
         session.close()
+        if user is None:
+            return None
         return {"key": user.key, "description": user.description}
 
     def get_scheme_elements(self, project_slug: str, scheme: str, actions: list[str]):
         """
         Get last annotation for each element id for a project/scheme
+        (most recent first)
         """
         session = self.Session()
-        query = (
+        results = (
+            session.query(CurrentAnnotations)
+            .filter(
+                CurrentAnnotations.project == project_slug,
+                CurrentAnnotations.scheme == scheme,
+                CurrentAnnotations.action.in_(actions),
+            )
+            .order_by(CurrentAnnotations.annotation_id.desc())
+            .all()
+        )
+        session.close()
+        r = {}
+        for row in results:  # last one between the actions
+            if row.element_id not in r:
+                r[row.element_id] = [row.element_id, row.annotation, row.user, row.time]
+        return list(r.values())
+
+    def get_current_annotations(self, project_slug: str):
+        """
+        Get the last annotation of each element of a project
+        by scheme and action, in insertion order
+        """
+        session = self.Session()
+        results = (
+            session.query(CurrentAnnotations)
+            .filter(CurrentAnnotations.project == project_slug)
+            .order_by(CurrentAnnotations.annotation_id)
+            .all()
+        )
+        session.close()
+        return [
+            [
+                row.scheme,
+                row.action,
+                row.element_id,
+                row.annotation,
+                row.user,
+                row.time,
+                row.annotation_id,
+            ]
+            for row in results
+        ]
+
+    def get_project_annotations(self, project_slug: str, start: int = 0):
+        """
+        Get the annotations of a project in insertion order
+        (after the annotation id start)
+        """
+        session = self.Session()
+        results = (
             session.query(
+                Annotations.scheme,
+                Annotations.action,
                 Annotations.element_id,
                 Annotations.annotation,
                 Annotations.user,
                 Annotations.time,
-                func.max(Annotations.time),
-            )
-            .filter(
-                Annotations.scheme == scheme,
-                Annotations.project == project_slug,
-                Annotations.action.in_(actions),
+                Annotations.id,
             )
-            .group_by(Annotations.element_id)
-            .order_by(func.max(Annotations.time).desc())
+            .filter(Annotations.project == project_slug, Annotations.id > start)
+            .order_by(Annotations.id)
+            .all()
         )
-
-        # Execute the query and fetch all results
-        results = query.all()
         session.close()
-        return [[row.element_id, row.annotation, row.user, row.time] for row in results]
+        return [
+            [
+                row.scheme,
+                row.action,
+                row.element_id,
+                row.annotation,
+                row.user,
+                row.time,
+                row.id,
+            ]
+            for row in results
+        ]
 
     def get_coding_users(self, scheme: str, project_slug: str):
         session = self.Session()
@@ -521,6 +928,7 @@ class DatabaseManager:
                 .distinct()
                 .all()
             )
+        session.close()
         return [u for u in recent_annotations]
 
     def get_annotations_by_element(
@@ -543,8 +951,40 @@ class DatabaseManager:
             .limit(limit)
             .all()
         )
+        session.close()
         return [[a.annotation, a.action, a.user, a.time] for a in annotations]
 
+    def get_annotations_by_elements(
+        self, project_slug: str, scheme: str, element_ids: list, limit: int = 10
+    ) -> dict:
+        """
+        Last annotations for a list of elements {element_id: [annotations]}
+        """
+        session = self.Session()
+        annotations = (
+            session.query(
+                Annotations.element_id,
+                Annotations.annotation,
+                Annotations.action,
+                Annotations.user,
+                Annotations.time,
+            )
+            .filter(
+                Annotations.project == project_slug,
+                Annotations.scheme == scheme,
+                Annotations.element_id.in_(element_ids),
+            )
+            .order_by(Annotations.time.desc())
+            .all()
+        )
+        session.close()
+        r = {}
+        for a in annotations:
+            history = r.setdefault(a.element_id, [])
+            if len(history) < limit:
+                history.append([a.annotation, a.action, a.user, a.time])
+        return r
+
     def post_annotation(
         self,
         project_slug: str,
@@ -553,19 +993,101 @@ class DatabaseManager:
         annotation: str,
         user: str,
         action: str,
-    ):
+    ) -> int:
+        """
+        Record an annotation and update the current one of the element
+        in the same transaction, return its id
+        """
+        element_id = str(element_id)
         session = self.Session()
-        annotation = Annotations(
-            action=action,
-            user=user,
-            project=project_slug,
-            element_id=element_id,
-            scheme=scheme,
-            annotation=annotation,
-        )
-        session.add(annotation)
+        for attempt in range(2):
+            entry = Annotations(
+                action=action,
+                user=user,
+                project=project_slug,
+                element_id=element_id,
+                scheme=scheme,
+                annotation=annotation,
+            )
+            session.add(entry)
+            session.flush()  # id and time of the annotation
+            current = session.get(
+                CurrentAnnotations, (project_slug, scheme, action, element_id)
+            )
+            if current is None:
+                current = CurrentAnnotations(
+                    project=project_slug,
+                    scheme=scheme,
+                    action=action,
+                    element_id=element_id,
+                )
+                session.add(current)
+            current.annotation = annotation
+            current.user = user
+            current.time = entry.time
+            current.annotation_id = entry.id
+            annotation_id = entry.id
+            try:
+                session.commit()
+                break
+            except IntegrityError:  # current added by another writer meanwhile
+                session.rollback()
+                if attempt == 1:
+                    raise
+        session.close()
+        return annotation_id
+
+    def add_annotations(self, annotations: list[dict], chunk: int = 10000) -> list:
+        """
+        Record annotations in bulk, in one transaction, return their ids
+        annotations : [{project, scheme, element_id, annotation, user, action}]
+        chunk : number of annotations by insert
+        """
+        ids = []
+        session = self.Session()
+        for start in range(0, len(annotations), chunk):
+            rows = [
+                {**a, "element_id": str(a["element_id"])}
+                for a in annotations[start : start + chunk]
+            ]
+            inserted = session.execute(
+                insert(Annotations.__table__).returning(
+                    Annotations.id, Annotations.time, sort_by_parameter_order=True
+                ),
+                rows,
+            ).all()
+            ids += [i for i, _ in inserted]
+            # last annotation of each element in the chunk
+            current = {}
+            for a, (i, t) in zip(rows, inserted):
+                key = (a["project"], a["scheme"], a["action"], a["element_id"])
+                current[key] = {
+                    "project": a["project"],
+                    "scheme": a["scheme"],
+                    "action": a["action"],
+                    "element_id": a["element_id"],
+                    "annotation": a["annotation"],
+                    "user": a["user"],
+                    "time": t,
+                    "annotation_id": i,
+                }
+            self.upsert_current(session, list(current.values()))
         session.commit()
         session.close()
+        return ids
+
+    def upsert_current(self, session, rows: list[dict]) -> None:
+        """
+        Insert or replace current annotations
+        """
+        if len(rows) == 0:
+            return None
+        statement = upsert_current_statement(self.engine.dialect.name)
+        if statement is None:
+            for row in rows:
+                session.merge(CurrentAnnotations(**row))
+            return None
+        session.execute(statement, rows)
 
     def available_schemes(self, project_slug: str):
         session = self.Session()
@@ -608,3 +1130,168 @@ class DatabaseManager:
         results = session.execute(query).fetchall()
         session.close()
         return [[row.element_id, row.annotation, row.user, row.time] for row in results]
+
+    def add_job(
+        self,
+        unique_id: str,
+        kind: str,
+        project_slug: str | None,
+        user: str | None,
+        name: str | None,
+        digest: str,
+        location: str | None,
+        params: dict | None,
+        worker: str | None = None,
+    ):
+        session = self.Session()
+        job = Jobs(
+            id=unique_id,
+            kind=kind,
+            project=project_slug,
+            user=user,
+            name=name,
+            digest=digest,
+            state="running",
+            location=location,
+            params=json.dumps(params) if params is not None else None,
+            worker=worker,
+        )
+        session.add(job)
+        session.commit()
+        session.close()
+
+    def update_job(self, unique_id: str, state: str, result: dict | None = None):
+        session = self.Session()
+        job = session.query(Jobs).filter(Jobs.id == unique_id).first()
+        if job is not None:
+            job.state = state
+            if state in ["finished", "failed", "killed"]:
+                job.time_finished = datetime.datetime.now(datetime.timezone.utc)
+            if result is not None:
+                job.result = json.dumps(result, default=str)
+            session.commit()
+        session.close()
+
+    def get_jobs(self, states: list, project_slug: str | None = None) -> list:
+        session = self.Session()
+        query = session.query(Jobs).filter(Jobs.state.in_(states))
+        if project_slug is not None:
+            query = query.filter(Jobs.project == project_slug)
+        jobs = query.order_by(Jobs.time_created).all()
+        session.close()
+        return [
+            {
+                "id": j.id,
+                "kind": j.kind,
+                "project": j.project,
+                "user": j.user,
+                "name": j.name,
+                "state": j.state,
+                "location": j.location,
+                "params": json.loads(j.params) if j.params else None,
+                "result": json.loads(j.result) if j.result else None,
+                "worker": j.worker,
+                "time_created": j.time_created,
+            }
+            for j in jobs
+        ]
+
+    def get_shared(self, key: str) -> dict | None:
+        """
+        Get a value of the state shared by the workers of the api
+        """
+        session = self.Session()
+        entry = session.query(Shared).filter(Shared.key == key).first()
+        session.close()
+        if entry is None:
+            return None
+        return json.loads(entry.value)
+
+    def get_shared_prefix(self, prefix: str) -> dict:
+        """
+        Get the shared values with a key beginning with prefix {key: value}
+        """
+        session = self.Session()
+        entries = (
+            session.query(Shared)
+            .filter(Shared.key.startswith(prefix, autoescape=True))
+            .all()
+        )
+        session.close()
+        return {e.key: json.loads(e.value) for e in entries}
+
+    def set_shared(self, key: str, value: dict) -> None:
+        """
+        Set a shared value (created or replaced)
+        """
+        session = self.Session()
+        entry = session.query(Shared).filter(Shared.key == key).first()
+        if entry is None:
+            session.add(Shared(key=key, value=json.dumps(value, default=str)))
+        else:
+            entry.value = json.dumps(value, default=str)
+        try:
+            session.commit()
+        except IntegrityError:  # created by another worker meanwhile
+            session.rollback()
+            session.query(Shared).filter(Shared.key == key).update(
+                {"value": json.dumps(value, default=str)}
+            )
+            session.commit()
+        session.close()
+
+    def add_shared(self, key: str, value: dict) -> dict:
+        """
+        Set a shared value only if it doesn't exist, and return
+        the value kept (the first one recorded by a worker)
+        """
+        session = self.Session()
+        session.add(Shared(key=key, value=json.dumps(value, default=str)))
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()
+        session.close()
+        return self.get_shared(key)
+
+    def delete_shared(self, key: str) -> None:
+        session = self.Session()
+        session.query(Shared).filter(Shared.key == key).delete()
+        session.commit()
+        session.close()
+
+    def lease_shared(self, keys: list, user: str, expiry: float) -> list:
+        """
+        Lease shared keys to a user until expiry (timestamp) if they are
+        free, expired or already leased to the user, return the keys leased
+        Comments:
+            a lease is replaced only if its value didn't change meanwhile
+        """
+        now = time.time()
+        value = json.dumps({"user": user, "expiry": expiry})
+        r = []
+        session = self.Session()
+        for key in keys:
+            session.add(Shared(key=key, value=value))
+            try:
+                session.commit()
+                r.append(key)
+                continue
+            except IntegrityError:
+                session.rollback()
+            entry = session.query(Shared).filter(Shared.key == key).first()
+            if entry is None:
+                continue
+            current = json.loads(entry.value)
+            if current.get("user") != user and current.get("expiry", 0) >= now:
+                continue
+            updated = (
+                session.query(Shared)
+                .filter(Shared.key == key, Shared.value == entry.value)
+                .update({"value": value}, synchronize_session=False)
+            )
+            session.commit()
+            if updated == 1:
+                r.append(key)
+        session.close()
+        return r
@@ -1,16 +1,23 @@
+import hashlib
 import json
 import logging
 import multiprocessing
 import os
+import re
 import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
 
 import bcrypt
 import datasets
 import fasttext
 import numpy as np
 import pandas as pd
+import pyarrow as pa
 import requests
 import spacy
 import torch
@@ -21,7 +28,8 @@ from sentence_transformers import SentenceTransformer
 from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from sklearn.manifold import TSNE
 from sklearn.metrics import accuracy_score, f1_score, precision_score
-from sklearn.model_selection import KFold, cross_val_predict
+from sklearn.base import clone
+from sklearn.model_selection import KFold
 from sklearn.preprocessing import OneHotEncoder, StandardScaler
 from transformers import (
     AutoModelForSequenceClassification,
@@ -63,6 +71,196 @@ def get_root_pwd() -> str:
             return root_password
 
 
+class Handle:
+    """
+    Reference to a dataframe (or series) written in an Arrow file
+    to exchange it with a process without pickling it
+    """
+
+    path: Path
+    columns: list
+    series: bool
+    name: str | None
+
+    def __init__(self, path: Path, columns: list, series: bool, name=None) -> None:
+        self.path = path
+        self.columns = columns
+        self.series = series
+        self.name = name
+
+    def __repr__(self) -> str:
+        return f"Handle({self.path})"
+
+
+def write_handle(obj: DataFrame | Series, path: Path) -> Handle | None:
+    """
+    Write a dataframe/series in an Arrow file
+    Return None if not possible (sparse data, unsupported types)
+    """
+    series = isinstance(obj, Series)
+    df = obj.to_frame() if series else obj
+    if any(isinstance(t, pd.SparseDtype) for t in df.dtypes):
+        return None
+    columns = list(df.columns)
+    try:
+        df = df.set_axis([str(i) for i in range(len(columns))], axis=1)
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        with pa.OSFile(str(path), "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+    except (pa.ArrowException, TypeError, ValueError):
+        if path.exists():
+            os.remove(path)
+        return None
+    return Handle(path, columns, series, obj.name if series else None)
+
+
+def read_handle(handle: Handle) -> DataFrame | Series:
+    """
+    Read a dataframe/series from its Arrow file (memory-mapped)
+    """
+    table = pa.ipc.open_file(pa.memory_map(str(handle.path))).read_all()
+    df = table.to_pandas()
+    df.columns = handle.columns
+    if handle.series:
+        return df.iloc[:, 0].rename(handle.name)
+    return df
+
+
+def to_handles(r, path: Path):
+    """
+    Replace the dataframes (also in a dict) by handles when possible
+    """
+    if isinstance(r, (DataFrame, Series)):
+        handle = write_handle(r, path / f"{uuid.uuid4()}.arrow")
+        return r if handle is None else handle
+    if isinstance(r, dict):
+        return {k: to_handles(v, path) for k, v in r.items()}
+    return r
+
+
+def from_handles(r, delete: bool = False):
+    """
+    Replace the handles (also in a dict) by their content
+    """
+    if isinstance(r, Handle):
+        df = read_handle(r)
+        if delete:
+            os.remove(r.path)
+        return df
+    if isinstance(r, dict):
+        return {k: from_handles(v, delete) for k, v in r.items()}
+    return r
+
+
+def run_job(func: Callable, args: dict, path: Path | None = None):
+    """
+    Execute a job in a process
+    - the dataframes received as handles are memory-mapped
+    - the dataframes of the result are sent back as handles
+    """
+    # the pid allows the queue to kill the worker
+    report_progress(args.get("progress"), args.get("unique_id"), pid=os.getpid())
+    r = func(**from_handles(args))
+    if path is not None:
+        r = to_handles(r, path)
+    return r
+
+
+def report_progress(progress, unique_id: str | None, **kwargs) -> None:
+    """
+    Update the progress of a job shared with the queue
+    (e.g. done and total steps, pid of the worker)
+    """
+    if progress is None or unique_id is None:
+        return None
+    state = dict(progress.get(unique_id, {}))
+    state.update(kwargs)
+    progress[unique_id] = state
+
+
+class RWLock:
+    """
+    Readers-writer lock : several readers or one writer
+    - a waiting writer goes before new readers
+    - a thread holding the lock can take it again
+    (but a reader can't become a writer)
+    """
+
+    condition: threading.Condition
+    readers: dict
+    writer: int | None
+    depth: int
+    waiting: int
+
+    def __init__(self) -> None:
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = {}  # thread : number of reads
+        self.writer = None
+        self.depth = 0
+        self.waiting = 0
+
+    @contextmanager
+    def read(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.depth += 1
+            else:
+                while self.writer is not None or (
+                    self.waiting > 0 and me not in self.readers
+                ):
+                    self.condition.wait()
+                self.readers[me] = self.readers.get(me, 0) + 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                if self.writer == me:
+                    self.depth -= 1
+                else:
+                    self.readers[me] -= 1
+                    if self.readers[me] == 0:
+                        del self.readers[me]
+                        self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        me = threading.get_ident()
+        with self.condition:
+            if self.writer == me:
+                self.depth += 1
+            else:
+                self.waiting += 1
+                while self.writer is not None or len(self.readers) > 0:
+                    self.condition.wait()
+                self.waiting -= 1
+                self.writer = me
+                self.depth = 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.writer = None
+                    self.condition.notify_all()
+
+
+def get_available_memory() -> int:
+    """
+    Memory available on the system (bytes)
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
 def get_hash(text: str):
     """
     Hash string
@@ -92,6 +290,9 @@ def to_dtm(
     max_term_freq: int | float = 1.0,
     log: bool = False,
     norm=None,
+    event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
     **kwargs,
 ):
     """
@@ -116,12 +317,45 @@ def to_dtm(
             ngram_range=(1, ngrams), min_df=min_term_freq, max_df=max_term_freq
         )
 
+    report_progress(progress, unique_id, done=0, total=1)
     dtm = vectorizer.fit_transform(texts)
+    if event is not None and event.is_set():
+        return {"error": "process interrupted"}
+    report_progress(progress, unique_id, done=1, total=1)
     names = vectorizer.get_feature_names_out()
-    dtm = pd.DataFrame(dtm.toarray(), columns=names, index=texts.index)
+    # keep the matrix sparse
+    dtm = to_sparse(dtm, index=texts.index, columns=names)
     return {"success": dtm}
 
 
+def to_sparse(matrix, index, columns) -> DataFrame:
+    """
+    Sparse dataframe from a scipy matrix
+    (with 0 as fill value, whatever the type)
+    """
+    df = pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=columns)
+    return df.astype(pd.SparseDtype(matrix.dtype, 0))
+
+
+def is_sparse(df: DataFrame) -> bool:
+    """
+    Test if all the columns of a dataframe are sparse
+    """
+    if len(df.columns) == 0:
+        return False
+    return all(isinstance(t, pd.SparseDtype) for t in df.dtypes)
+
+
+def to_matrix(df: DataFrame):
+    """
+    Data for the models : CSR matrix if sparse, dataframe else
+    (a matrix is returned as it is)
+    """
+    if isinstance(df, DataFrame) and is_sparse(df):
+        return df.sparse.to_coo().tocsr()
+    return df
+
+
 def tokenize(texts: Series, model: str = "fr_core_news_sm") -> Series:
     """
     Clean texts with tokenization to facilitate word count
@@ -137,42 +371,231 @@ def tokenize(texts: Series, model: str = "fr_core_news_sm") -> Series:
     return textes_tk
 
 
-def to_fasttext(texts: Series, language: str, path_models: Path, **kwargs) -> DataFrame:
+def write_embeddings(emb, path: Path) -> None:
+    """
+    Write embeddings as a float32 array
+    (written in a temporary file and then renamed)
+    """
+    tmp = Path(str(path) + ".tmp.npy")
+    np.save(tmp, np.asarray(emb, dtype=np.float32))
+    os.replace(tmp, path)
+
+
+def load_embeddings_index(directory: Path) -> tuple:
+    """
+    Index of a cache of embeddings : the shards, and for each text
+    hash (first occurrence), its shard and its row in the shard
+    (the keys are memory-mapped, read again if the shards were
+    merged meanwhile)
+    """
+    while True:
+        shards = sorted(directory.glob("*.keys.npy"))
+        try:
+            shard_keys = [np.load(f, mmap_mode="r") for f in shards]
+        except FileNotFoundError:  # merged by another process
+            continue
+        if len(shards) == 0:
+            return (
+                shards,
+                pd.Index([]),
+                np.array([], dtype=int),
+                np.array([], dtype=int),
+            )
+        index = pd.Index(np.concatenate(shard_keys))
+        shard = np.concatenate([np.full(len(k), i) for i, k in enumerate(shard_keys)])
+        row = np.concatenate([np.arange(len(k)) for k in shard_keys])
+        unique = ~index.duplicated()
+        return shards, index[unique], shard[unique], row[unique]
+
+
+def merge_embeddings(directory: Path, max_shards: int = 16) -> None:
+    """
+    Merge the shards of a cache of embeddings in one shard once there
+    are more than max_shards (by one process at a time, the vectors
+    are copied in a memory-mapped file)
+    """
+    if len(list(directory.glob("*.keys.npy"))) <= max_shards:
+        return None
+    lock = directory / "merge.lock"
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+    except FileExistsError:  # merging in another process
+        try:
+            if time.time() - os.path.getmtime(lock) > 3600:  # left by a crash
+                os.remove(lock)
+        except FileNotFoundError:
+            pass
+        return None
+    try:
+        shards, index, shard, row = load_embeddings_index(directory)
+        name = uuid.uuid4().hex
+        tmp = directory / f"{name}.tmp.npy"
+        merged = None
+        for i, f in enumerate(shards):
+            vectors = np.load(str(f).replace(".keys.npy", ".npy"), mmap_mode="r")
+            if merged is None:
+                merged = np.lib.format.open_memmap(
+                    tmp,
+                    mode="w+",
+                    dtype=np.float32,
+                    shape=(len(index), vectors.shape[1]),
+                )
+            selected = np.flatnonzero(shard == i)
+            merged[selected] = vectors[row[selected]]
+        merged.flush()
+        del merged
+        os.replace(tmp, directory / f"{name}.npy")
+        np.save(directory / f"{name}.keys.tmp.npy", np.asarray(index, dtype="S40"))
+        os.replace(directory / f"{name}.keys.tmp.npy", directory / f"{name}.keys.npy")
+        for f in shards:
+            os.remove(f)
+            os.remove(str(f).replace(".keys.npy", ".npy"))
+    finally:
+        os.remove(lock)
+
+
+def cached_embeddings(
+    texts: Series, model: str, path_cache: Path, encode: Callable
+) -> np.ndarray:
+    """
+    Compute embeddings with a cache on disk shared by the projects
+    - one directory by model
+    - shards of vectors (.npy) with the hashes of their texts (.keys.npy)
+    - only the texts not in the cache are encoded, and added as a new shard
+    - the shards are merged once there are too many (see merge_embeddings)
+    Args:
+        texts (pandas.Series): texts
+        model (str): key of the model
+        path_cache (Path): directory of the cache
+        encode (Callable): function list of texts -> array of embeddings
+        (None if interrupted)
+    Returns:
+        numpy.ndarray: embeddings (float32) in the order of the texts
+        (None if the encoding was interrupted)
+    """
+    directory = path_cache / re.sub(r"[^\w.-]+", "-", model)
+    os.makedirs(directory, exist_ok=True)
+    keys = np.array(
+        [hashlib.sha1(t.encode("utf-8")).hexdigest() for t in texts], dtype="S40"
+    )
+
+    # index of the cache (a shard is visible once its keys are written)
+    shards, index, shard, row = load_embeddings_index(directory)
+    position = index.get_indexer(keys) if len(index) > 0 else np.full(len(keys), -1)
+    print(f"Embeddings in cache: {(position >= 0).sum()}/{len(keys)}")
+
+    # encode the missing texts and add them to the cache
+    missing = position < 0
+    new_keys, first = np.unique(keys[missing], return_index=True)
+    new = None
+    if len(new_keys) > 0:
+        new = encode(list(texts[missing].iloc[first]))
+        if new is None:
+            return None
+        new = np.asarray(new, dtype=np.float32)
+        name = uuid.uuid4().hex
+        write_embeddings(new, directory / f"{name}.npy")
+        np.save(directory / f"{name}.keys.tmp.npy", new_keys)
+        os.replace(directory / f"{name}.keys.tmp.npy", directory / f"{name}.keys.npy")
+
+    # assemble the embeddings from the shards (memory-mapped)
+    emb = np.empty((len(keys), 0), dtype=np.float32)
+    found = np.flatnonzero(~missing)
+    if len(found) > 0:
+        found_shard = shard[position[found]]
+        found_row = row[position[found]]
+        for i in np.unique(found_shard):
+            file = str(shards[i]).replace(".keys.npy", ".npy")
+            try:
+                vectors = np.load(file, mmap_mode="r")
+            except FileNotFoundError:  # merged by another process, read again
+                return cached_embeddings(texts, model, path_cache, encode)
+            if emb.shape[1] == 0:
+                emb = np.empty((len(keys), vectors.shape[1]), dtype=np.float32)
+            f = found_shard == i
+            emb[found[f]] = vectors[found_row[f]]
+    if new is not None:
+        if emb.shape[1] == 0:
+            emb = np.empty((len(keys), new.shape[1]), dtype=np.float32)
+        emb[missing] = new[np.searchsorted(new_keys, keys[missing])]
+        merge_embeddings(directory)
+    return emb
+
+
+def to_fasttext(
+    texts: Series,
+    language: str,
+    path_models: Path,
+    path: Path | None = None,
+    event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
+    batch: int = 1000,
+    **kwargs,
+) -> DataFrame:
     """
     Compute fasttext embedding
     Download the model if needed
     Args:
         texts (pandas.Series): texts
         model (str): model to use
+        path (Path): if specified, file to write the embeddings
     Returns:
-        pandas.DataFrame: embeddings
+        pandas.DataFrame: embeddings (or path and columns of the file)
     """
     if not path_models.exists():
         return {"error": f"path {str(path_models)} does not exist"}
+    path_cache = path_models.absolute() / "embeddings"
     os.chdir(path_models)
     print(
         "If the model doesn't exist, it will be downloaded first. It could talke some time."
     )
     model_name = download_model(language, if_exists="ignore")
     print("Model loaded")
-    texts_tk = tokenize(texts)
     ft = fasttext.load_model(model_name)
-    emb = [ft.get_sentence_vector(t.replace("\n", " ")) for t in texts_tk]
+
+    def encode(t):
+        emb = []
+        for i in range(0, len(t), batch):
+            if event is not None and event.is_set():
+                return None
+            texts_tk = tokenize(pd.Series(t[i : i + batch]))
+            emb += [ft.get_sentence_vector(j.replace("\n", " ")) for j in texts_tk]
+            report_progress(progress, unique_id, done=len(emb), total=len(t))
+        return emb
+
+    emb = cached_embeddings(texts, f"fasttext-{model_name}", path_cache, encode)
+    if emb is None:
+        return {"error": "process interrupted"}
+    if path is not None:
+        write_embeddings(emb, path)
+        columns = ["ft%03d" % (x + 1) for x in range(ft.get_dimension())]
+        return {"success": {"path": path, "columns": columns}}
     df = pd.DataFrame(emb, index=texts.index)
     df.columns = ["ft%03d" % (x + 1) for x in range(len(df.columns))]
     return {"success": df}
 
 
 def to_sbert(
-    texts: Series, model: str = "distiluse-base-multilingual-cased-v1", **kwargs
+    texts: Series,
+    model: str = "distiluse-base-multilingual-cased-v1",
+    path: Path | None = None,
+    path_models: Path | None = None,
+    event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
+    batch: int = 512,
+    **kwargs,
 ) -> DataFrame:
     """
     Compute sbert embedding
     Args:
         texts (pandas.Series): texts
         model (str): model to use
+        path (Path): if specified, file to write the embeddings
+        path_models (Path): if specified, use the embeddings cache
     Returns:
-        pandas.DataFrame: embeddings
+        pandas.DataFrame: embeddings (or path and columns of the file)
     """
 
     # manage GPU
@@ -180,50 +603,134 @@ def to_sbert(
     sbert = SentenceTransformer(model)
     sbert = sbert.to(device)
     sbert.max_seq_length = 512
-    emb = sbert.encode(list(texts), device=device)
+
+    def encode(t):
+        # by chunks to check interruption and report progress
+        emb = []
+        for i in range(0, len(t), batch):
+            if event is not None and event.is_set():
+                return None
+            emb.append(sbert.encode(t[i : i + batch], device=device))
+            report_progress(progress, unique_id, done=i + len(emb[-1]), total=len(t))
+        return np.concatenate(emb)
+
+    if path_models is not None:
+        path_cache = path_models.absolute() / "embeddings"
+        emb = cached_embeddings(texts, f"sbert-{model}", path_cache, encode)
+    else:
+        emb = encode(list(texts))
+    if emb is None:
+        return {"error": "process interrupted"}
+    if path is not None:
+        write_embeddings(emb, path)
+        columns = ["sb%03d" % (x + 1) for x in range(emb.shape[1])]
+        return {"success": {"path": path, "columns": columns}}
     emb = pd.DataFrame(emb, index=texts.index)
     emb.columns = ["sb%03d" % (x + 1) for x in range(len(emb.columns))]
     return {"success": emb}
 
 
-def compute_umap(features: DataFrame, params: dict, **kwargs):
+def compute_umap(
+    features: DataFrame,
+    params: dict,
+    event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
+    **kwargs,
+):
     """
     Compute UMAP
+    Comments:
+        the reduction itself can't be interrupted, only before and after
     """
-    scaled_features = StandardScaler().fit_transform(features)
+    report_progress(progress, unique_id, done=0, total=2)
+    scaler = StandardScaler(with_mean=not is_sparse(features))
+    scaled_features = scaler.fit_transform(to_matrix(features))
+    if event is not None and event.is_set():
+        return {"error": "process interrupted"}
+    report_progress(progress, unique_id, done=1, total=2)
     reducer = umap.UMAP(**params)
     reduced_features = reducer.fit_transform(scaled_features)
+    if event is not None and event.is_set():
+        return {"error": "process interrupted"}
+    report_progress(progress, unique_id, done=2, total=2)
     df = pd.DataFrame(reduced_features, index=features.index)
     df_scaled = 2 * (df - df.min()) / (df.max() - df.min()) - 1
     return df_scaled
 
 
-def compute_tsne(features: DataFrame, params: dict, **kwargs):
+def compute_tsne(
+    features: DataFrame,
+    params: dict,
+    event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
+    **kwargs,
+):
     """
     Compute TSNE
+    Comments:
+        the reduction itself can't be interrupted, only before and after
     """
-    scaled_features = StandardScaler().fit_transform(features)
+    report_progress(progress, unique_id, done=0, total=2)
+    scaler = StandardScaler(with_mean=not is_sparse(features))
+    scaled_features = scaler.fit_transform(to_matrix(features))
+    if event is not None and event.is_set():
+        return {"error": "process interrupted"}
+    report_progress(progress, unique_id, done=1, total=2)
     reduced_features = TSNE(**params).fit_transform(scaled_features)
+    if event is not None and event.is_set():
+        return {"error": "process interrupted"}
+    report_progress(progress, unique_id, done=2, total=2)
     df = pd.DataFrame(reduced_features, index=features.index)
     df_scaled = 2 * (df - df.min()) / (df.max() - df.min()) - 1
     return df_scaled
 
 
-def fit_model(model, X, Y, labels, **kwargs):
+def fit_model(
+    model,
+    X,
+    Y,
+    labels,
+    delta: list | None = None,
+    cv10: bool = True,
+    event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
+    **kwargs,
+):
     """
     Fit simplemodel and calculate statistics
+    Comments:
+        - delta : only fold in these elements with partial_fit
+        (model already fitted on the others)
+        - cv10 : compute the crossvalidation in the same process
+        - interruption checked between the fit and the folds
+        of the crossvalidation
     """
+    # sparse features (dfm) are used as a CSR matrix
+    index = X.index
+    X = to_matrix(X)
+
     # drop NA values
     f = Y.notnull()
-    Xf = X[f]
+    Xf = X[f.values]
     Yf = Y[f]
 
     # fit model
-    model.fit(Xf, Yf)
+    report_progress(progress, unique_id, done=0, total=1)
+    if delta is None:
+        model.fit(Xf, Yf)
+    elif len(delta) > 0:
+        d = index.isin(delta)
+        model.partial_fit(X[d], Y[d])
+    if event is not None and event.is_set():
+        return {"error": "process interrupted"}
+    report_progress(progress, unique_id, done=1, total=1)
 
     # compute probabilities
     proba = model.predict_proba(X)
-    proba = pd.DataFrame(proba, columns=model.classes_, index=X.index)
+    proba = pd.DataFrame(proba, columns=model.classes_, index=index)
     proba["entropy"] = -1 * (proba * np.log(proba)).sum(axis=1)
     proba["prediction"] = proba.drop(columns="entropy").idxmax(axis=1)
 
@@ -247,20 +754,59 @@ def fit_model(model, X, Y, labels, **kwargs):
     }
 
     # compute 10-crossvalidation
-    num_folds = 10
+    scores = None
+    if cv10:
+        r = cross_validate(model, X, Y, event=event)
+        if "error" in r:
+            return r
+        scores = r["success"]
+
+    r = {"model": model, "proba": proba, "statistics": statistics, "cv10": scores}
+    return r
+
+
+def cross_validate(
+    model,
+    X,
+    Y,
+    num_folds: int = 10,
+    event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
+    **kwargs,
+) -> dict:
+    """
+    Compute the 10-crossvalidation of a simplemodel
+    Comments:
+        fold by fold to check interruption, each fold fits
+        a new model with the same parameters
+    """
+    X = to_matrix(X)
+    f = Y.notnull()
+    Xf = X[f.values]
+    Yf = Y[f]
+
     kf = KFold(n_splits=num_folds, shuffle=True, random_state=42)
-    Y_pred = cross_val_predict(model, Xf, Yf, cv=kf)
+    Y_pred = np.empty(len(Yf), dtype=object)
+    for i, (train, test) in enumerate(kf.split(Xf)):
+        if event is not None and event.is_set():
+            return {"error": "process interrupted"}
+        if isinstance(Xf, DataFrame):
+            X_train, X_test = Xf.iloc[train], Xf.iloc[test]
+        else:
+            X_train, X_test = Xf[train], Xf[test]
+        fold = clone(model).fit(X_train, Yf.iloc[train])
+        Y_pred[test] = fold.predict(X_test)
+        report_progress(progress, unique_id, done=i + 1, total=num_folds)
     weighted_f1 = f1_score(Yf, Y_pred, average="weighted")
     accuracy = accuracy_score(Yf, Y_pred)
     macro_f1 = f1_score(Yf, Y_pred, average="macro")
-    cv10 = {
+    r = {
         "weighted_f1": round(weighted_f1, 3),
         "macro_f1": round(macro_f1, 3),
         "accuracy": round(accuracy, 3),
     }
-
-    r = {"model": model, "proba": proba, "statistics": statistics, "cv10": cv10}
-    return r
+    return {"success": r}
 
 
 def train_bert(
@@ -273,6 +819,8 @@ def train_bert(
     params: dict,
     test_size: float,
     event: Optional[multiprocessing.synchronize.Event] = None,
+    progress=None,
+    unique_id: Optional[str] = None,
     **kwargs,
 ) -> bool:
     """
@@ -289,6 +837,7 @@ def train_bert(
     params (dict) : training parameters
     test_size (dict): train/test distribution
     event : possibility to interrupt
+    progress : shared dict to report the steps done
 
     # pour le moment fichier status.log existe tant que l'entrainement est en cours
     # TODO : memory use
@@ -404,6 +953,9 @@ def train_bert(
     class CustomLoggingCallback(TrainerCallback):
         def on_step_end(self, args, state, control, **kwargs):
             logger.info(f"Step {state.global_step}")
+            report_progress(
+                progress, unique_id, done=state.global_step, total=state.max_steps
+            )
             # end if event set
             if event is not None:
                 if event.is_set():
@@ -465,6 +1017,8 @@ def predict_bert(
     col_labels: str | None = None,
     batch: int = 128,
     file_name: str = "predict.parquet",
+    progress=None,
+    unique_id: Optional[str] = None,
     **kwargs,
 ) -> DataFrame | bool:
     """
@@ -518,6 +1072,12 @@ def predict_bert(
             res = res.cpu()
         res = res.softmax(1).detach().numpy()
         predictions.append(res)
+        report_progress(
+            progress,
+            unique_id,
+            done=sum([len(p) for p in predictions]),
+            total=df.shape[0],
+        )
 
     # to dataframe
     pred = pd.DataFrame(
@@ -598,6 +1158,7 @@ def generate(
     prompt: str,
     event: Optional[multiprocessing.synchronize.Event] = None,
     unique_id: Optional[str] = None,
+    progress=None,
     **kwargs,
 ) -> None:
     """
@@ -643,5 +1204,8 @@ def generate(
                 }
             )
         print("element generated ", row["index"], response["success"])
+        report_progress(
+            progress, unique_id, done=len(results) + len(errors), total=len(df)
+        )
 
     return {"success": results}
@@ -1,17 +1,24 @@
+import copy
+import heapq
 import json
 import logging
 import os
 import pickle
 import shutil
+import threading
+import time
+import uuid
 from datetime import datetime
 from multiprocessing import Process
 from pathlib import Path
-from typing import Any
+from typing import Any, Callable
 
 import numpy as np
 import pandas as pd
+import skops.io as sio
 from pandas import DataFrame
 from pydantic import ValidationError
+from sklearn.base import clone
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
@@ -31,6 +38,31 @@ from activetigger.datamodels import (
     RandomforestParams,
 )
 
+# types to trust when loading the simplemodels written by the server
+# (trees of the randomforest, trees, distances and sparse training
+# data of the knn)
+trusted_types = [
+    "sklearn.tree._tree.Tree",
+    "sklearn.neighbors._kd_tree.KDTree",
+    "sklearn.neighbors._ball_tree.BallTree",
+    "sklearn.metrics._dist_metrics.EuclideanDistance64",
+    "sklearn.metrics._dist_metrics.EuclideanDistance32",
+    "scipy.sparse._csr.csr_matrix",
+]
+
+
+def load_skops(path: Path) -> Any:
+    """
+    Load an estimator saved with skops
+    Comments:
+        the types not trusted by skops must be in the trusted types
+    """
+    untrusted = sio.get_untrusted_types(file=path)
+    unknown = [t for t in untrusted if t not in trusted_types]
+    if len(unknown) > 0:
+        raise ValueError(f"Untrusted types in {path}: {unknown}")
+    return sio.load(path, trusted=untrusted)
+
 
 class BertModel:
     """
@@ -205,11 +237,13 @@ class BertModels:
     TODO : std.err in the logs for processes
     """
 
+    project_slug: str
     queue: Any
     path: Path
     computing: dict
 
-    def __init__(self, path: Path, queue: Any) -> None:
+    def __init__(self, project_slug: str, path: Path, queue: Any) -> None:
+        self.project_slug = project_slug
         self.params_default = {
             "batchsize": 4,
             "gradacc": 1,
@@ -350,7 +384,15 @@ class BertModels:
             "test_size": test_size,
         }
 
-        unique_id = self.queue.add("training", functions.train_bert, args)
+        unique_id = self.queue.add(
+            "training",
+            functions.train_bert,
+            args,
+            project_slug=self.project_slug,
+            user=user,
+            name=name,
+            location=self.path / name,
+        )
 
         # Update the queue
         b = BertModel(name, self.path / name, base_model)
@@ -391,7 +433,16 @@ class BertModels:
             "path": b.path,
             "file_name": "predict_test.parquet",
         }
-        unique_id = self.queue.add("prediction", functions.predict_bert, args)
+        unique_id = self.queue.add(
+            "prediction",
+            functions.predict_bert,
+            args,
+            project_slug=self.project_slug,
+            user=user,
+            name=name,
+            location=b.path / "predict_test.parquet",
+            params={"test": True},
+        )
         b.status = "testing"
         self.computing[user] = [b, unique_id]
 
@@ -419,7 +470,15 @@ class BertModels:
             "path": b.path,
             "file_name": "predict.parquet",
         }
-        unique_id = self.queue.add("prediction", functions.predict_bert, args)
+        unique_id = self.queue.add(
+            "prediction",
+            functions.predict_bert,
+            args,
+            project_slug=self.project_slug,
+            user=user,
+            name=name,
+            location=b.path / "predict.parquet",
+        )
         b.status = "predicting"
         self.computing[user] = [b, unique_id]
         return {"success": "bert model predicting"}
@@ -441,7 +500,7 @@ class BertModels:
         """
         if not user in self.computing:
             return {"error": "no current processes"}
-        self.computing[user][1].terminate()  # end process
+        self.queue.kill(self.computing[user][1])  # end process
 
         # delete files in case of training
         b = self.computing[user][0]
@@ -543,26 +602,99 @@ class BertModels:
         return r
 
 
+class Ranking:
+    """
+    Priority heap of elements by decreasing score
+    (entropy or probability of a label)
+    - built once when the simplemodel is computed
+    - elements not available anymore (annotated) are dropped lazily
+      and restored when they become available again (see restore)
+    - used by concurrent requests, the heap has its own lock
+    """
+
+    heap: list
+    removed: dict
+    lock: threading.Lock
+
+    def __init__(self, scores: pd.Series) -> None:
+        self.heap = [(-float(s), str(i)) for i, s in scores.dropna().items()]
+        heapq.heapify(self.heap)
+        self.removed = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def next(
+        self, available: Callable[[str], bool], exclude: set | list = []
+    ) -> tuple[str, float] | None:
+        """
+        Next best available element not in exclude (element_id, score)
+        """
+        exclude = set(exclude)
+        with self.lock:
+            skipped = []
+            r = None
+            while len(self.heap) > 0:
+                score, element_id = self.heap[0]
+                if not available(element_id):
+                    heapq.heappop(self.heap)
+                    self.removed[element_id] = -score
+                    continue
+                if element_id in exclude:
+                    skipped.append(heapq.heappop(self.heap))
+                    continue
+                r = (element_id, -score)
+                break
+
+            # put back the elements excluded for this request only
+            for e in skipped:
+                heapq.heappush(self.heap, e)
+            return r
+
+    def restore(self, element_id: str) -> None:
+        """
+        Put back an element dropped from the heap
+        (e.g. its annotation has been deleted)
+        """
+        with self.lock:
+            if element_id in self.removed:
+                score = self.removed.pop(element_id)
+                heapq.heappush(self.heap, (-score, element_id))
+
+
 class SimpleModels:
     """
     Managing simplemodels
     - define available models
     - save a simplemodel/user
     - train simplemodels
+    Each simplemodel is saved in its directory (estimator with skops,
+    probabilities and annotations in parquet), described in a manifest
+    with its features (by name). The models of a user are loaded when
+    needed.
     """
 
+    project_slug: str
     available_models: dict
     validation: dict
     existing: dict
     computing: dict
+    validating: dict
+    autotrain: dict
+    lock: functions.RWLock
     path: Path
+    dir: Path
+    manifest: dict
+    modified: float
     queue: Any
     save_file: str
 
-    def __init__(self, path: Path, queue):
+    def __init__(self, project_slug: str, path: Path, queue):
         """
         Init Simplemodels class
         """
+        self.project_slug = project_slug
         # Models and default parameters
         self.available_models = {
             "liblinear": {"cost": 1},
@@ -582,9 +714,15 @@ class SimpleModels:
         }
         self.existing: dict = {}  # computed simplemodels
         self.computing: dict = {}  # curently under computation
+        self.validating: dict = {}  # crossvalidation under computation
+        self.autotrain: dict = {}  # automatic training by user/scheme
+        self.lock = functions.RWLock()  # models and their state
         self.path: Path = path  # path to operate
+        self.dir: Path = path / "simplemodels"  # saved simplemodels
+        self.manifest: dict = {}  # description of the saved simplemodels
+        self.modified: float = 0  # time of the manifest read or written
         self.queue = queue  # access to executor for multiprocessing
-        self.save_file: str = "simplemodels.pickle"  # file to save current state
+        self.save_file: str = "simplemodels.pickle"  # former format
         self.loads()  # load existing simplemodels
 
     def __repr__(self) -> str:
@@ -594,37 +732,39 @@ class SimpleModels:
         """
         Available simplemodels
         """
-        r = {}
-        for u in self.existing:
-            r[u] = {}
-            for s in self.existing[u]:
-                sm = self.existing[u][s]
-                r[u][s] = {
-                    "model": sm.name,
-                    "params": sm.model_params,
-                    "features": sm.features,
-                    "statistics": sm.statistics,
-                }
-        return r
+        with self.lock.read():
+            r = {}
+            for u in self.manifest:
+                r[u] = {}
+                for s, m in self.manifest[u].items():
+                    r[u][s] = {
+                        "model": m["name"],
+                        "params": m["params"],
+                        "features": m["features"],
+                        "statistics": m["statistics"],
+                    }
+            return r
 
     def get(self, scheme: str, username: str):
         """
         Get a specific simplemodel
         """
-        if username in self.existing:
-            if scheme in self.existing[username]:
-                sm = self.existing[username][scheme]
-                return {
-                    "success": {
-                        "model": sm.name,
-                        "params": sm.model_params,
-                        "features": sm.features,
-                        "statistics": sm.statistics,
-                        "scheme": scheme,
-                        "username": username,
+        with self.lock.read():
+            if username in self.manifest:
+                if scheme in self.manifest[username]:
+                    m = self.manifest[username][scheme]
+                    return {
+                        "success": {
+                            "model": m["name"],
+                            "params": m["params"],
+                            "features": m["features"],
+                            "statistics": m["statistics"],
+                            "scheme": scheme,
+                            "username": username,
+                            "autotrain": self.autotrain.get(username, {}).get(scheme),
+                        }
                     }
-                }
-        return {"error": "No model for this user and scheme"}
+            return {"error": "No model for this user and scheme"}
 
     def training(self):
         """
@@ -639,26 +779,114 @@ class SimpleModels:
         """
         Test if a simplemodel exists for a user/scheme
         """
-        if user in self.existing:
-            if scheme in self.existing[user]:
-                return True
-        return False
+        with self.lock.read():
+            if user in self.manifest:
+                if scheme in self.manifest[user]:
+                    return True
+            return False
+
+    def set_autotrain(
+        self, user: str, scheme: str, every: int | None, delay: float | None
+    ) -> dict:
+        """
+        Train again the simplemodel of a user every n new annotations
+        of the scheme and/or after a delay (seconds) if there are new ones
+        Comments:
+            the parameters are the ones of the current model
+        """
+        with self.lock.write():
+            if every is None and delay is None:
+                if scheme in self.autotrain.get(user, {}):
+                    del self.autotrain[user][scheme]
+                return {"success": "Automatic training stopped"}
+            if not self.exists(user, scheme):
+                return {"error": "No model for this user and scheme"}
+            if (every is not None and every < 1) or (delay is not None and delay <= 0):
+                return {"error": "Wrong parameters"}
+            if user not in self.autotrain:
+                self.autotrain[user] = {}
+            self.autotrain[user][scheme] = {
+                "every": every,
+                "delay": delay,
+                "count": 0,
+                "time": time.time(),
+            }
+            return {"success": "Automatic training started"}
+
+    def add_annotations(self, scheme: str, n: int = 1) -> bool:
+        """
+        Count new annotations for the automatic training
+        Return True if a training is due
+        """
+        with self.lock.write():
+            for u in self.autotrain:
+                if scheme in self.autotrain[u]:
+                    self.autotrain[u][scheme]["count"] += n
+            return len(self.get_autotrain(reset=False)) > 0
+
+    def get_autotrain(self, reset: bool = True) -> list:
+        """
+        Simplemodels to train again, with their parameters
+        Comments:
+            - never more than one training by user/scheme, the annotations
+            added in between are counted for the next one
+            - the counter is reset once the training is launched
+        """
+        with self.lock.write():
+            r = []
+            now = time.time()
+            for u in self.autotrain:
+                for s, policy in self.autotrain[u].items():
+                    if policy["count"] == 0 or s in self.computing.get(u, {}):
+                        continue
+                    if (
+                        policy["every"] is None or policy["count"] < policy["every"]
+                    ) and (
+                        policy["delay"] is None
+                        or now - policy["time"] < policy["delay"]
+                    ):
+                        continue
+                    if not self.exists(u, s):
+                        continue
+                    m = self.manifest[u][s]
+                    params = {
+                        "features": m["features"],
+                        "model": m["name"],
+                        "params": m["params"],
+                        "scheme": s,
+                        "standardize": m["standardize"],
+                        "incremental": True,
+                        "cv10": False,
+                    }
+                    r.append((u, params))
+                    if reset:
+                        policy["count"] = 0
+                        policy["time"] = now
+            return r
 
     def get_model(self, user: str, scheme: str):
         """
         Select a specific model in the repo
         """
-        if user not in self.existing:
-            return "This user has no model"
-        if scheme not in self.existing[user]:
-            return "The model for this scheme does not exist"
-        return self.existing[user][scheme]
+        self.load_user(user)
+        with self.lock.read():
+            if user not in self.existing:
+                return "This user has no model"
+            if scheme not in self.existing[user]:
+                return "The model for this scheme does not exist"
+            return self.existing[user][scheme]
 
     def load_data(self, data, col_label, col_predictors, standardize):
         """
         Load data
+        Comments:
+            sparse predictors (dfm) have no missing values
+            and are kept sparse
         """
-        f_na = data[col_predictors].isna().sum(axis=1) > 0
+        if functions.is_sparse(data[col_predictors]):
+            f_na = pd.Series(False, index=data.index)
+        else:
+            f_na = data[col_predictors].isna().sum(axis=1) > 0
         if f_na.sum() > 0:
             print(f"There is {f_na.sum()} predictor rows with missing values")
 
@@ -681,35 +909,20 @@ class SimpleModels:
     def standardize(self, df):
         """
         Apply standardization
+        (without centering for sparse data)
         """
+        if functions.is_sparse(df):
+            scaler = StandardScaler(with_mean=False)
+            df_stand = scaler.fit_transform(functions.to_matrix(df))
+            return functions.to_sparse(df_stand, index=df.index, columns=df.columns)
         scaler = StandardScaler()
         df_stand = scaler.fit_transform(df)
         return pd.DataFrame(df_stand, columns=df.columns, index=df.index)
 
-    def add_simplemodel(
-        self,
-        user,
-        scheme,
-        features,
-        name,
-        df,
-        col_labels,
-        col_features,
-        standardize,
-        model_params: dict | None = None,
-    ):
+    def create_model(self, name: str, model_params: dict):
         """
-        A a new simplemodel for a user and a scheme
+        Create the estimator of a simplemodel with its parameters
         """
-        logger_simplemodel = logging.getLogger("simplemodel")
-        logger_simplemodel.info("Intiating the computation process for the simplemodel")
-        X, Y, labels = self.load_data(df, col_labels, col_features, standardize)
-
-        # default parameters
-        if model_params is None:
-            model_params = self.available_models[name]
-
-        # Select model
         if name == "knn":
             model = KNeighborsClassifier(n_neighbors=int(model_params["n_neighbors"]))
 
@@ -751,68 +964,362 @@ class SimpleModels:
                 class_prior=class_prior,
             )
 
+        return model
+
+    def add_simplemodel(
+        self,
+        user,
+        scheme,
+        features,
+        name,
+        df,
+        col_labels,
+        col_features,
+        standardize,
+        model_params: dict | None = None,
+        incremental: bool = True,
+        cv10: bool = True,
+    ):
+        """
+        A a new simplemodel for a user and a scheme
+        Comments:
+            - incremental : start from the previous model of the user
+            when possible (see get_incremental)
+            - cv10 : compute the crossvalidation in a separate job
+            once the model is fitted
+        """
+        logger_simplemodel = logging.getLogger("simplemodel")
+        logger_simplemodel.info("Intiating the computation process for the simplemodel")
+        X, Y, labels = self.load_data(df, col_labels, col_features, standardize)
+
+        # default parameters
+        if model_params is None:
+            model_params = self.available_models[name]
+
+        model = self.create_model(name, model_params)
+
+        # start from the previous model if possible
+        delta = None
+        if incremental:
+            self.load_user(user)
+            with self.lock.read():
+                previous = self.existing.get(user, {}).get(scheme)
+                r = self.get_incremental(
+                    previous, name, features, model_params, standardize, Y
+                )
+            if r is not None:
+                model, delta = r
+
         # launch the compuation (model + statistics) as a future process
         # TODO: refactore the SimpleModel class / move to API the executor call ?
-        args = {"model": model, "X": X, "Y": Y, "labels": labels}
-        unique_id = self.queue.add("simplemodel", functions.fit_model, args)
+        args = {
+            "model": model,
+            "X": X,
+            "Y": Y,
+            "labels": labels,
+            "delta": delta,
+            "cv10": False,
+        }
+        # parameters to launch the training again if interrupted
+        params = {
+            "features": features,
+            "model": name,
+            "params": model_params,
+            "scheme": scheme,
+            "standardize": standardize,
+            "cv10": cv10,
+        }
+        unique_id = self.queue.add(
+            "simplemodel",
+            functions.fit_model,
+            args,
+            project_slug=self.project_slug,
+            user=user,
+            name=name,
+            params=params,
+        )
         sm = SimpleModel(
             name, user, X, Y, labels, "computing", features, standardize, model_params
         )
-        if user not in self.computing:
-            self.computing[user] = {}
-        self.computing[user][scheme] = {"queue": unique_id, "sm": sm}
+        with self.lock.write():
+            if user not in self.computing:
+                self.computing[user] = {}
+            self.computing[user][scheme] = {"queue": unique_id, "sm": sm, "cv10": cv10}
+
+    def get_incremental(
+        self,
+        previous,
+        name: str,
+        features: list,
+        model_params: dict,
+        standardize: bool,
+        Y,
+    ) -> tuple | None:
+        """
+        Model to start from to train incrementally, with the elements
+        to fold in (None for all)
+        Comments:
+            - same model, parameters, features and elements than the previous
+            one, and the former annotations unchanged
+            - multi_naivebayes : partial_fit on the new annotations
+            - liblinear : warm start of the solver on all the annotations
+            - otherwise (or if not possible) : None, the model is trained again
+        """
+        if previous is None or isinstance(previous.model, str):
+            return None
+        if name not in ["multi_naivebayes", "liblinear"]:
+            return None
+        if (previous.name, previous.features, previous.standardize) != (
+            name,
+            features,
+            standardize,
+        ) or previous.model_params != model_params:
+            return None
+        if not previous.Y.index.equals(Y.index):
+            return None
+        before = previous.Y.dropna()
+        after = Y.dropna()
+        if not before.index.isin(after.index).all():
+            return None
+        if (after[before.index] != before).any():
+            return None
+        if not set(after.unique()).issubset(set(previous.model.classes_)):
+            return None
+
+        model = copy.deepcopy(previous.model)
+        if name == "multi_naivebayes":
+            return model, list(after.index.difference(before.index))
+        model.set_params(warm_start=True)
+        return model, None
+
+    def save_manifest(self) -> None:
+        """
+        Write the manifest (replace the file in one step)
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self.dir / "simplemodels.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.dir / "simplemodels.json")
+        self.modified = os.path.getmtime(self.dir / "simplemodels.json")
+
+    def restore(self, scheme: str, element_id: str) -> None:
+        """
+        Put back an element available again in the rankings
+        of the loaded simplemodels of a scheme
+        """
+        for models in list(self.existing.values()):
+            sm = models.get(scheme)
+            if sm is not None and sm.rankings is not None:
+                for ranking in sm.rankings.values():
+                    ranking.restore(element_id)
 
-    def dumps(self):
+    def is_stale(self) -> bool:
         """
-        Dumps all simplemodels to a pickle
+        Test if the manifest has been written by another worker of the api
         """
-        with open(self.path / self.save_file, "wb") as file:
-            pickle.dump(self.existing, file)
+        if not (self.dir / "simplemodels.json").exists():
+            return False
+        return os.path.getmtime(self.dir / "simplemodels.json") != self.modified
+
+    def dumps(self, user: str, scheme: str) -> None:
+        """
+        Save the simplemodel of a user for a scheme
+        Comments:
+            written in a new directory, the former one is removed
+            once the manifest is updated (only this update is
+            done under the lock)
+        """
+        with self.lock.read():
+            sm = self.existing[user][scheme]
+        name = uuid.uuid4().hex
+        os.makedirs(self.dir / name)
+        sio.dump(sm.model, self.dir / name / "model.skops")
+        sm.proba.to_parquet(self.dir / name / "proba.parquet")
+        pd.DataFrame({"labels": sm.Y}).to_parquet(self.dir / name / "labels.parquet")
+
+        with self.lock.write():
+            former = self.manifest.get(user, {}).get(scheme)
+            if user not in self.manifest:
+                self.manifest[user] = {}
+            self.manifest[user][scheme] = {
+                "name": sm.name,
+                "features": sm.features,
+                "labels": [i for i in sm.labels if not pd.isna(i)],
+                "params": sm.model_params,
+                "standardize": sm.standardize,
+                "statistics": sm.statistics,
+                "cv10": sm.cv10,
+                "dir": name,
+            }
+            self.save_manifest()
+        if former is not None:
+            shutil.rmtree(self.dir / former["dir"], ignore_errors=True)
 
     def loads(self) -> bool:
         """
-        Load all simplemodels from a pickle
+        Load the manifest of the simplemodels
+        (and convert the former pickle of all the simplemodels)
         """
+        if (self.dir / "simplemodels.json").exists():
+            with open(self.dir / "simplemodels.json", "r") as f:
+                self.manifest = json.load(f)
+            self.modified = os.path.getmtime(self.dir / "simplemodels.json")
+            return True
         if not (self.path / self.save_file).exists():
             return False
         with open(self.path / self.save_file, "rb") as file:
-            self.existing = pickle.load(file)
+            existing = pickle.load(file)
+        for u in existing:
+            self.existing[u] = {}
+            for s, sm in existing[u].items():
+                sm.X = None
+                if getattr(sm, "rankings", None) is None:
+                    sm.compute_rankings()
+                self.existing[u][s] = sm
+                self.dumps(u, s)
+        os.remove(self.path / self.save_file)
         return True
 
+    def load_user(self, user: str) -> None:
+        """
+        Load the saved simplemodels of a user if not already done
+        Comments:
+            the files are read without the lock, the models
+            are added under it (if not loaded meanwhile)
+        """
+        with self.lock.read():
+            if user in self.existing or user not in self.manifest:
+                return None
+            manifest = dict(self.manifest[user])
+        models = {}
+        for s, m in manifest.items():
+            directory = self.dir / m["dir"]
+            Y = pd.read_parquet(directory / "labels.parquet")["labels"]
+            sm = SimpleModel(
+                m["name"],
+                user,
+                None,
+                Y,
+                m["labels"],
+                "loaded",
+                m["features"],
+                m["standardize"],
+                m["params"],
+            )
+            sm.model = load_skops(directory / "model.skops")
+            sm.proba = pd.read_parquet(directory / "proba.parquet")
+            sm.statistics = m["statistics"]
+            sm.cv10 = m["cv10"]
+            sm.compute_rankings()
+            models[s] = sm
+        with self.lock.write():
+            if user not in self.existing:
+                self.existing[user] = models
+
+    def crossvalidate(self, user: str, scheme: str) -> None:
+        """
+        Launch the crossvalidation of an existing simplemodel
+        (the one of a former model is stopped)
+        """
+        with self.lock.read():
+            former = self.validating.get(user, {}).get(scheme)
+            sm = self.existing[user][scheme]
+        if former is not None:
+            self.queue.kill(former)
+        unique_id = self.queue.add(
+            "crossvalidation",
+            functions.cross_validate,
+            {"model": clone(sm.model), "X": sm.X, "Y": sm.Y},
+            project_slug=self.project_slug,
+            user=user,
+            name=sm.name,
+        )
+        with self.lock.write():
+            if user not in self.validating:
+                self.validating[user] = {}
+            self.validating[user][scheme] = unique_id
+
     def update_processes(self):
         """
         Update current computing simplemodels
-        """
-        for u in self.computing.copy():
-            s = list(self.computing[u].keys())[0]
-            unique_id = self.computing[u][s]["queue"]
-            if self.queue.current[unique_id]["future"].done():
+        and their crossvalidation
+        Comments:
+            the results are read, saved and the crossvalidations
+            launched without the lock, only the changes of the
+            models and their state are done under it
+        """
+        with self.lock.read():
+            computing = [
+                (u, s, c) for u in self.computing for s, c in self.computing[u].items()
+            ]
+            validating = [
+                (u, s, i)
+                for u in self.validating
+                for s, i in self.validating[u].items()
+            ]
+
+        for u, s, c in computing:
+            unique_id = c["queue"]
+            # case the process have been canceled, clean
+            if unique_id in self.queue.current:
+                if not self.queue.current[unique_id]["future"].done():
+                    continue
                 # TODO : deal better exception in the training
                 try:
                     results = self.queue.current[unique_id]["future"].result()
-                    sm = self.computing[u][s]["sm"]
+                    sm = c["sm"]
                     sm.model = results["model"]
                     sm.proba = results["proba"]
                     sm.cv10 = results["cv10"]
                     sm.statistics = results["statistics"]
-                    if u not in self.existing:
-                        self.existing[u] = {}
-                    self.existing[u][s] = sm
-                    del self.computing[u]
-                    self.queue.delete(unique_id)
-                    self.dumps()
+                    sm.compute_rankings()
+                    self.load_user(u)
+                    with self.lock.write():
+                        if u not in self.existing:
+                            self.existing[u] = {}
+                        self.existing[u][s] = sm
+                    if c["cv10"]:
+                        self.crossvalidate(u, s)
+                    sm.X = None  # the features are not kept with the model
+                    self.dumps(u, s)
                 except Exception as e:
                     print("Simplemodel failed")
                     print(e)
-                    del self.computing[u]
-                    self.queue.delete(unique_id)
+                self.queue.delete(unique_id)
+            with self.lock.write():
+                if self.computing.get(u, {}).get(s) is c:
+                    del self.computing[u][s]
+                    if len(self.computing[u]) == 0:
+                        del self.computing[u]
+
+        for u, s, unique_id in validating:
+            if unique_id in self.queue.current:
+                if not self.queue.current[unique_id]["future"].done():
+                    continue
+                try:
+                    r = self.queue.current[unique_id]["future"].result()
+                    with self.lock.write():
+                        if "success" in r and s in self.existing.get(u, {}):
+                            self.existing[u][s].cv10 = r["success"]
+                            self.manifest[u][s]["cv10"] = r["success"]
+                            self.save_manifest()
+                except Exception as e:
+                    print("Crossvalidation failed")
+                    print(e)
+                self.queue.delete(unique_id)
+            with self.lock.write():
+                if self.validating.get(u, {}).get(s) == unique_id:
+                    del self.validating[u][s]
+                    if len(self.validating[u]) == 0:
+                        del self.validating[u]
 
 
 class SimpleModel:
     name: str
     user: str
     features: list
-    X: DataFrame
+    X: DataFrame | None
     Y: DataFrame
     labels: list
     model_params: dict
@@ -820,6 +1327,7 @@ class SimpleModel:
     proba: DataFrame
     statistics: dict
     cv10: DataFrame
+    rankings: dict | None
     # model
 
     def __init__(
@@ -851,10 +1359,12 @@ class SimpleModel:
         self.proba = None
         self.statistics = None
         self.cv10 = None
+        self.rankings = None
         if type(model) is not str:  # TODO : tester si c'est un modèle
             self.proba = self.compute_proba(model, X)
             self.statistics = self.compute_statistics(model, X, Y, labels)
             self.cv10 = self.compute_10cv(model, X, Y)
+            self.compute_rankings()
 
     def json(self):
         """
@@ -874,6 +1384,16 @@ class SimpleModel:
         )
         self.cv10 = self.compute_10cv(self.model, self.X, self.Y)
 
+    def compute_rankings(self):
+        """
+        Priority heaps for active (entropy) and maxprob (each label) selection
+        """
+        if self.proba is None:
+            return None
+        self.rankings = {
+            c: Ranking(self.proba[c]) for c in self.proba.columns if c != "prediction"
+        }
+
     def compute_proba(self, model, X):
         """
         Compute proba + entropy
@@ -939,7 +1459,6 @@ class SimpleModel:
         Y = Y[f]
         num_folds = 10
         kf = KFold(n_splits=num_folds, shuffle=True, random_state=42)
-        predicted_labels = cross_val_predict(model, X, Y, cv=kf)
         Y_pred = cross_val_predict(model, X, Y, cv=kf)
         weighted_f1 = f1_score(Y, Y_pred, average="weighted")
         accuracy = accuracy_score(Y, Y_pred)
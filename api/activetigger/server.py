@@ -1,19 +1,29 @@
 import concurrent.futures
+import hashlib
 import json
 import logging
 import os
 import re
 import secrets
 import shutil
+import signal
+import socket
+import tempfile
+import threading
 import time
 import uuid
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime, timedelta, timezone
+from functools import cached_property
 from multiprocessing import Manager
-from multiprocessing.managers import SyncManager
+from multiprocessing.managers import DictProxy, SyncManager
 from pathlib import Path
 from typing import Callable
 
+import numpy as np
 import pandas as pd
+import scipy.sparse
 import yaml
 from fastapi.encoders import jsonable_encoder
 from jose import jwt
@@ -23,7 +33,9 @@ from slugify import slugify
 
 import activetigger.functions as functions
 from activetigger.datamodels import (
+    FeatureModel,
     ProjectDataModel,
+    ProjectionInStrictModel,
     ProjectModel,
     ProjectSummaryModel,
     SimpleModelModel,
@@ -40,6 +52,7 @@ logger = logging.getLogger("server")
 db_name = "activetigger.db"
 data_raw = "data_raw.parquet"
 features_file = "features.parquet"
+features_dir = "features"
 labels_file = "labels.parquet"
 data_file = "data.parquet"
 test_file = "test.parquet"
@@ -50,65 +63,218 @@ ALGORITHM = "HS256"
 class Queue:
     """
     Managining parallel processes for computation
-    Jobs with  concurrent.futures.ProcessPoolExecutor
-
-    TODO : better management of failed processes
+    Jobs with concurrent.futures executors, one by lane
+    - interactive : short jobs (simplemodel, projection, feature)
+    - heavy : long jobs (bert training and prediction, embeddings)
+    - io : jobs waiting for external services (generation), with threads
+    Jobs wait in the queue until a worker of their lane is free, chosen
+    by priority, then for the user with the fewest running jobs in the
+    lane, then by order of arrival. A lane can require a minimal
+    available memory to start a new job.
+    Jobs report their progress in a shared dict, and are stopped with
+    their event ; a process job still running after a grace delay is
+    killed with its worker (the lane gets a new executor, the other
+    jobs of the lane are sent again).
+    With several workers of the api (shared mode), each job is recorded
+    with the worker running it, which writes a heartbeat in the shared
+    state and stops the jobs killed from the other workers.
     """
 
     nb_workers: int
-    executor: concurrent.futures.ProcessPoolExecutor
+    lanes: dict
+    executors: dict
     manager: SyncManager
     current: dict
+    waiting: dict
+    running: dict
+    progress: DictProxy
+    killed: set
+    timers: dict
+    lock: threading.RLock
+    counter: int
+    notify: Callable | None
+    db_manager: DatabaseManager | None
+    worker: str | None
+    timeout: float
+    path: Path
 
-    def __init__(self, nb_workers: int = 2) -> None:
+    def __init__(
+        self,
+        nb_workers: int = 2,
+        db_manager: DatabaseManager | None = None,
+        lanes: dict | None = None,
+        path: Path | None = None,
+        worker: str | None = None,
+    ) -> None:
         """
         Initiating the queue
+        lanes : configuration to update the default lanes
+        path : directory to exchange data with the processes
+        worker : id of the worker of the api (shared mode only)
         """
         self.nb_workers = nb_workers
-        self.executor = concurrent.futures.ProcessPoolExecutor(
-            max_workers=self.nb_workers
-        )  # manage parallel processes
+        self.db_manager = db_manager  # to keep a registry of the jobs
+        self.worker = worker if db_manager is not None else None
+        self.timeout = 60  # seconds without heartbeat for a stopped worker
+        if path is None:
+            path = Path(tempfile.mkdtemp(prefix="activetigger-"))
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+        # lanes : number of workers, memory to start a job (bytes),
+        # kinds of jobs with their priority (lower first)
+        self.lanes = {
+            "interactive": {
+                "workers": nb_workers,
+                "threads": False,
+                "memory": 0,
+                "kinds": {
+                    "simplemodel": 0,
+                    "projection": 1,
+                    "feature": 2,
+                    "crossvalidation": 3,
+                },
+            },
+            "heavy": {
+                "workers": 1,
+                "threads": False,
+                "memory": 2 * 1024**3,
+                "kinds": {"prediction": 0, "training": 1},
+            },
+            "io": {
+                "workers": 2,
+                "threads": True,
+                "memory": 0,
+                "kinds": {"generation": 0},
+            },
+        }
+        for lane, conf in (lanes or {}).items():
+            self.lanes.setdefault(lane, {"threads": False, "memory": 0, "kinds": {}})
+            self.lanes[lane].update(conf)
+
+        self.executors = {lane: self.new_executor(lane) for lane in self.lanes}
         self.manager = Manager()  # communicate within processes
         self.current = {}  # keep track of the current stack
+        self.waiting = {}  # jobs waiting for a worker
+        self.running = {lane: set() for lane in self.lanes}
+        self.progress = self.manager.dict()  # reported by the jobs
+        self.killed = set()  # jobs killed with their worker
+        self.timers = {}  # hard kill after the grace delay
+        self.lock = threading.RLock()
+        self.counter = 0
+        self.notify = None  # called when a process is done
 
         logger.info("Init Queue")
 
+    @property
+    def executor(self) -> concurrent.futures.Executor:
+        """
+        Executor of the default lane
+        """
+        return self.executors["interactive"]
+
+    def new_executor(self, lane: str) -> concurrent.futures.Executor:
+        """
+        Create the executor of a lane
+        """
+        if self.lanes[lane]["threads"]:
+            return concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.lanes[lane]["workers"]
+            )
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.lanes[lane]["workers"]
+        )
+
     def close(self) -> None:
         """
-        Close the executor
+        Close the executors
         """
-        self.executor.shutdown(cancel_futures=True, wait=False)
+        with self.lock:
+            self.waiting = {}
+            for timer in self.timers.values():
+                timer.cancel()
+            self.timers = {}
+        for executor in self.executors.values():
+            executor.shutdown(cancel_futures=True, wait=False)
         self.manager.shutdown()
+        shutil.rmtree(self.path, ignore_errors=True)
         logger.info("Close queue")
         print("Queue closes")
 
-    # def check_failed_processes(self, future):
-    #     """
-    #     Check if a future failed.
-    #     """
-    #     try:
-    #         result = future.result()  # Will raise if the task failed
-    #         return False
-    #     except Exception as e:
-    #         return True
-
     def check(self) -> None:
         """
-        Check if the exector still works, if not recreate it
+        Check if the exectors still work, if not recreate them
+        and start waiting jobs (e.g. if memory is available again)
         """
-        try:
-            self.executor.submit(lambda: None)
-        except Exception:
-            self.executor.shutdown(cancel_futures=True)
-            self.executor = concurrent.futures.ProcessPoolExecutor(
-                max_workers=self.nb_workers
-            )
-            logger.error("Restart executor")
-            print("Problem with executor ; restart")
+        for lane in self.lanes:
+            try:
+                self.executors[lane].submit(lambda: None)
+            except Exception:
+                self.executors[lane].shutdown(cancel_futures=True)
+                self.executors[lane] = self.new_executor(lane)
+                logger.error(f"Restart executor {lane}")
+                print("Problem with executor ; restart")
+        if self.worker is not None:
+            self.heartbeat()
+        self.schedule()
+
+    def heartbeat(self) -> None:
+        """
+        Record the worker as alive and kill its jobs
+        stopped from another worker
+        """
+        self.db_manager.set_shared(f"worker:{self.worker}", {"time": time.time()})
+        for key in self.db_manager.get_shared_prefix("kill:"):
+            unique_id = key.removeprefix("kill:")
+            if unique_id in self.current:
+                self.db_manager.delete_shared(key)
+                self.kill(unique_id)
+
+    def alive(self, worker: str | None) -> bool:
+        """
+        Test if a worker of the api wrote its heartbeat recently
+        """
+        if worker is None:
+            return False
+        r = self.db_manager.get_shared(f"worker:{worker}")
+        return r is not None and time.time() - r["time"] < self.timeout
+
+    def owner(self, unique_id: str) -> str | None:
+        """
+        Worker running a job (shared mode)
+        """
+        r = self.db_manager.get_shared(f"job:{unique_id}")
+        return r["worker"] if r is not None else None
+
+    def get_lane(self, kind: str) -> str:
+        """
+        Lane of a kind of job (interactive by default)
+        """
+        for lane in self.lanes:
+            if kind in self.lanes[lane]["kinds"]:
+                return lane
+        return "interactive"
 
-    def add(self, kind: str, func: Callable, args: dict) -> str:
+    def add(
+        self,
+        kind: str,
+        func: Callable,
+        args: dict,
+        project_slug: str | None = None,
+        user: str | None = None,
+        name: str | None = None,
+        location: Path | str | None = None,
+        params: dict | None = None,
+        lane: str | None = None,
+        priority: int | None = None,
+    ) -> str:
         """
         Add new element to queue
+        Comments:
+            - the job is recorded in the database (if available)
+            - location : where the job writes its result
+            - params : what is needed to launch the job again
+            - lane and priority : default ones of the kind if not specified
         """
         # generate a unique id
         unique_id = str(uuid.uuid4())
@@ -117,28 +283,251 @@ class Queue:
         event = self.manager.Event()
         args["event"] = event
         args["unique_id"] = unique_id
+        args["progress"] = self.progress
+
+        # record the job
+        if self.db_manager is not None:
+            digest = json.dumps(
+                {"func": func.__name__, "name": name, "params": params},
+                sort_keys=True,
+                default=str,
+            )
+            self.db_manager.add_job(
+                unique_id,
+                kind,
+                project_slug,
+                user,
+                name,
+                hashlib.sha1(digest.encode("utf-8")).hexdigest(),
+                str(location) if location is not None else None,
+                params,
+                self.worker,
+            )
+            if self.worker is not None:
+                self.db_manager.set_shared(
+                    f"job:{unique_id}",
+                    {"worker": self.worker, "kind": kind, "user": user},
+                )
+
+        if lane is None or lane not in self.lanes:
+            lane = self.get_lane(kind)
+        if priority is None:
+            priority = self.lanes[lane]["kinds"].get(kind, 10)
+
+        # dataframes are written once and memory-mapped by the process
+        files = []
+        if not self.lanes[lane]["threads"]:
+            args = functions.to_handles(args, self.path)
+            files = [h.path for h in args.values() if isinstance(h, functions.Handle)]
+
+        # save in the stack, the future is resolved by the executor
+        future: concurrent.futures.Future = concurrent.futures.Future()
+        with self.lock:
+            self.counter += 1
+            self.current[unique_id] = {
+                "kind": kind,
+                "future": future,
+                "event": event,
+                "lane": lane,
+                "user": user,
+                "files": files,
+            }
+            self.waiting[unique_id] = {
+                "func": func,
+                "args": args,
+                "priority": priority,
+                "order": self.counter,
+            }
+        future.add_done_callback(lambda f: self.done(unique_id, f))
+
+        # start it if a worker is available
+        self.schedule()
+        if future.done() and future.exception() is not None:
+            del self.current[unique_id]
+            return "error"
+        return unique_id
+
+    def schedule(self) -> None:
+        """
+        Start waiting jobs when a worker of their lane is free
+        """
+        with self.lock:
+            for lane, conf in self.lanes.items():
+                while len(self.running[lane]) < conf["workers"]:
+                    candidates = [
+                        i for i in self.waiting if self.current[i]["lane"] == lane
+                    ]
+                    if len(candidates) == 0:
+                        break
+                    # admission control (always one job possible)
+                    if (
+                        len(self.running[lane]) > 0
+                        and functions.get_available_memory() < conf["memory"]
+                    ):
+                        break
+
+                    # fair share between users
+                    users = [self.current[i]["user"] for i in self.running[lane]]
+                    unique_id = min(
+                        candidates,
+                        key=lambda i: (
+                            self.waiting[i]["priority"],
+                            users.count(self.current[i]["user"]),
+                            self.waiting[i]["order"],
+                        ),
+                    )
+                    self.start(unique_id)
 
-        # send the process to the executor
+    def start(self, unique_id: str) -> None:
+        """
+        Send a waiting job to the executor of its lane
+        """
+        job = self.waiting.pop(unique_id)
+        lane = self.current[unique_id]["lane"]
+        future = self.current[unique_id]["future"]
+        # a job sent again after the loss of its worker is already running
+        if not future.running() and not future.set_running_or_notify_cancel():
+            return None
         try:
-            future = self.executor.submit(func, **args)
+            if self.lanes[lane]["threads"]:
+                f = self.executors[lane].submit(job["func"], **job["args"])
+            else:
+                f = self.executors[lane].submit(
+                    functions.run_job, job["func"], job["args"], self.path
+                )
         except Exception as e:
             logger.error(f"Error submitting task: {e}")
-            return "error"
+            future.set_exception(e)
+            return None
+        self.running[lane].add(unique_id)
+        self.current[unique_id]["job"] = job
+        self.current[unique_id]["started"] = time.time()
+        files = self.current[unique_id]["files"]
+        f.add_done_callback(lambda f: self.finish(unique_id, lane, future, f, files))
 
-        # save in the stack
-        self.current[unique_id] = {"kind": kind, "future": future, "event": event}
-        return unique_id
+    def finish(
+        self,
+        unique_id: str,
+        lane: str,
+        future: concurrent.futures.Future,
+        executed: concurrent.futures.Future,
+        files: list,
+    ) -> None:
+        """
+        Transmit the result of the executor and free the worker
+        Comments:
+            a job whose worker was lost because another job was killed
+            is sent again
+        """
+        with self.lock:
+            self.running[lane].discard(unique_id)
+            killed = unique_id in self.killed
+            self.killed.discard(unique_id)
+            if (
+                not killed
+                and not executed.cancelled()
+                and isinstance(executed.exception(), BrokenProcessPool)
+                and unique_id in self.current
+            ):
+                self.waiting[unique_id] = self.current[unique_id]["job"]
+                logger.warning(f"Job {unique_id} sent again")
+        if unique_id in self.waiting:
+            self.schedule()
+            return None
+        try:
+            self.progress.pop(unique_id, None)
+        except (OSError, EOFError):
+            pass  # queue closed
+        timer = self.timers.pop(unique_id, None)
+        if timer is not None:
+            timer.cancel()
+        for f in files:
+            if f.exists():
+                os.remove(f)
+        if executed.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif executed.exception() is not None:
+            future.set_exception(executed.exception())
+        else:
+            try:
+                future.set_result(functions.from_handles(executed.result(), True))
+            except Exception as e:
+                future.set_exception(e)
+        self.schedule()
 
-    def kill(self, unique_id: str) -> dict:
+    def done(self, unique_id: str, future: concurrent.futures.Future) -> None:
+        """
+        Callback when a process is done
+        Comments:
+            executed in a thread of the executor, notify
+            must be thread-safe
+        """
+        if self.db_manager is not None and unique_id in self.current:
+            state, result = "finished", None
+            if future.cancelled():
+                state = "killed"
+            elif future.exception() is not None:
+                state, result = "failed", {"error": str(future.exception())}
+            else:
+                r = future.result()
+                if r is False or (isinstance(r, dict) and "error" in r):
+                    state = "failed"
+                elif isinstance(r, dict) and isinstance(r.get("success"), dict):
+                    result = r["success"]  # location of the result
+            self.current[unique_id]["state"] = state
+            self.db_manager.update_job(unique_id, state, result)
+        if self.notify is not None:
+            self.notify()
+
+    def kill(self, unique_id: str, grace: float = 10) -> dict:
         """
         Send a kill process with the event manager
+        Comments:
+            - a waiting job is cancelled
+            - a process job still running after grace (seconds)
+            is killed with its worker
         """
         if unique_id not in self.current:
             return {"error": "Id does not exist"}
         self.current[unique_id]["event"].set()
+        with self.lock:
+            lane = self.current[unique_id]["lane"]
+            if unique_id in self.waiting:
+                del self.waiting[unique_id]
+                self.current[unique_id]["future"].cancel()
+                for f in self.current[unique_id]["files"]:
+                    os.remove(f)
+            elif unique_id in self.running[lane] and not self.lanes[lane]["threads"]:
+                timer = threading.Timer(grace, self.terminate, (unique_id, lane))
+                timer.daemon = True
+                self.timers[unique_id] = timer
+                timer.start()
+        if self.db_manager is not None:
+            self.db_manager.update_job(unique_id, "killed")
         self.delete(unique_id)
         return {"success": "Process killed"}
 
+    def terminate(self, unique_id: str, lane: str) -> None:
+        """
+        Kill the worker of a job which didn't stop, and replace the
+        executor of its lane
+        """
+        with self.lock:
+            if self.timers.pop(unique_id, None) is None:
+                return None  # queue closed
+            pid = dict(self.progress.get(unique_id, {})).get("pid")
+            if unique_id not in self.running[lane] or pid is None:
+                return None
+            self.killed.add(unique_id)
+            executor = self.executors[lane]
+            self.executors[lane] = self.new_executor(lane)
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        executor.shutdown(wait=False, cancel_futures=True)
+        logger.warning(f"Worker of the job {unique_id} killed")
+
     def delete(self, ids: str | list) -> None:
         """
         Delete completed elements from the stack
@@ -148,6 +537,13 @@ class Queue:
         for i in ids:
             if not self.current[i]["future"].done():
                 print("Deleting a unfinished process")
+            elif (
+                self.db_manager is not None
+                and self.current[i].get("state", "finished") == "finished"
+            ):
+                self.db_manager.update_job(i, "collected")
+            if self.worker is not None:
+                self.db_manager.delete_shared(f"job:{i}")
             del self.current[i]
 
     def state(self) -> dict:
@@ -155,39 +551,111 @@ class Queue:
         Return state of the queue
         """
         r = {}
-        for f in self.current:
-            if self.current[f]["future"].running():
+        for f in list(self.current):
+            exception = None
+            if f in self.waiting:
+                info = "pending"
+            elif self.current[f]["future"].running():
                 info = "running"
-                exception = None
+            elif self.current[f]["future"].cancelled():
+                info = "killed"
             else:
                 info = "done"
                 exception = self.current[f]["future"].exception()
-            r[f] = {"state": info, "exception": exception}
+            r[f] = {
+                "state": info,
+                "exception": exception,
+                "kind": self.current[f]["kind"],
+                "lane": self.current[f]["lane"],
+                "user": self.current[f]["user"],
+            }
+            if info == "running":
+                r[f].update(self.get_progress(f))
+
+        # jobs running on the other workers of the api
+        if self.worker is not None:
+            workers = self.db_manager.get_shared_prefix("worker:")
+            for key, job in self.db_manager.get_shared_prefix("job:").items():
+                unique_id = key.removeprefix("job:")
+                if unique_id in r or job["worker"] == self.worker:
+                    continue
+                heartbeat = workers.get(f"worker:{job['worker']}", {"time": 0})
+                if time.time() - heartbeat["time"] >= self.timeout:
+                    continue
+                r[unique_id] = {
+                    "state": "running",
+                    "exception": None,
+                    "kind": job["kind"],
+                    "lane": None,
+                    "user": job["user"],
+                    "worker": job["worker"],
+                }
+        return r
+
+    def kill_remote(self, unique_id: str) -> dict:
+        """
+        Ask the worker running a job to kill it (shared mode)
+        """
+        if self.worker is None or self.owner(unique_id) is None:
+            return {"error": "Id does not exist"}
+        self.db_manager.set_shared(f"kill:{unique_id}", {"time": time.time()})
+        return {"success": "Process will be killed"}
+
+    def get_progress(self, unique_id: str) -> dict:
+        """
+        Progress of a running job : fraction done, time elapsed,
+        throughput (steps by second) and estimated time remaining
+        """
+        p = dict(self.progress.get(unique_id, {}))
+        elapsed = time.time() - self.current[unique_id].get("started", time.time())
+        r = {
+            "elapsed": round(elapsed, 1),
+            "progress": None,
+            "eta": None,
+            "throughput": None,
+        }
+        if p.get("total", 0) > 0:
+            fraction = p["done"] / p["total"]
+            r["progress"] = round(fraction, 3)
+            if elapsed > 0:
+                r["throughput"] = round(p["done"] / elapsed, 3)
+            if fraction > 0:
+                r["eta"] = round(elapsed * (1 - fraction) / fraction, 1)
         return r
 
     def get_nb_active_processes(self) -> int:
         """
         Number of active processes
         """
-        return len([f for f in self.current if self.current[f]["future"].running()])
+        return sum([len(self.running[lane]) for lane in self.running])
 
 
 class Users:
     """
     Managers users
+    Comments:
+        users and their auth on projects are cached for ttl seconds
+        (dropped when they are modified by this worker)
     """
 
     db_manager: DatabaseManager
+    cache: dict
+    ttl: float
+    lock: threading.Lock
 
     def __init__(
         self,
         db_manager: DatabaseManager,
         file_users: str = "add_users.yaml",
+        ttl: float = 60,
     ):
         """
         Init users references
         """
         self.db_manager = db_manager
+        self.cache = {}  # {key: [value, time]}
+        self.ttl = ttl
+        self.lock = threading.Lock()
 
         # add users if add_users.yaml exists
         if Path(file_users).exists():
@@ -209,11 +677,43 @@ class Users:
         auth = self.db_manager.get_project_auth(project_slug)
         return auth
 
+    def cached(self, key: tuple, get: Callable):
+        """
+        Value from the cache, or got and cached
+        """
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl:
+            return entry[0]
+        value = get()
+        with self.lock:
+            self.cache[key] = [value, time.time()]
+        return value
+
+    def invalidate(self, username: str) -> None:
+        """
+        Drop the cached user and its auth
+        """
+        with self.lock:
+            for key in [k for k in self.cache if k[1] == username]:
+                del self.cache[key]
+
+    def invalidate_project(self, project_slug: str) -> None:
+        """
+        Drop the cached auth of the users on a project
+        """
+        with self.lock:
+            for key in [
+                k for k in self.cache if k[0] == "auth" and k[2] == project_slug
+            ]:
+                del self.cache[key]
+
     def set_auth(self, username: str, project_slug: str, status: str):
         """
         Set user auth for a project
         """
         self.db_manager.add_auth(project_slug, username, status)
+        self.invalidate(username)
         return {"success": "Auth added to database"}
 
     def delete_auth(self, username: str, project_slug: str):
@@ -221,6 +721,7 @@ class Users:
         Delete user auth
         """
         self.db_manager.delete_auth(project_slug, username)
+        self.invalidate(username)
         return {"success": "Auth deleted"}
 
     def get_auth_projects(self, username: str) -> list:
@@ -264,6 +765,7 @@ class Users:
             return {"error": "Username already exists"}
         hash_pwd = functions.get_hash(password)
         self.db_manager.add_user(name, hash_pwd, role, created_by)
+        self.invalidate(name)
 
         return {"success": "User added to the database"}
 
@@ -279,16 +781,17 @@ class Users:
 
         # delete the user
         self.db_manager.delete_user(name)
+        self.invalidate(name)
 
         return {"success": "User deleted"}
 
     def get_user(self, name) -> UserInDBModel | dict:
         """
-        Get user from database
+        Get user from database (or the cache)
         """
-        if not name in self.existing_users():
+        user = self.cached(("user", name), lambda: self.db_manager.get_user(name))
+        if user is None:
             return {"error": "Username doesn't exist"}
-        user = self.db_manager.get_user(name)
         return UserInDBModel(
             username=name, hashed_password=user["key"], status=user["description"]
         )
@@ -310,7 +813,10 @@ class Users:
         """
         Check auth for a specific project
         """
-        user_auth = self.get_auth(username, project_slug)
+        user_auth = self.cached(
+            ("auth", username, project_slug),
+            lambda: self.get_auth(username, project_slug),
+        )
         if len(user_auth) == 0:  # not associated
             return None
         return user_auth[0][1]
@@ -319,6 +825,10 @@ class Users:
 class Server:
     """
     Server to manage backend
+    Comments:
+        in shared mode, several workers of the api use the same
+        database : the secret of the tokens, the jobs and the
+        projections are shared through it
     """
 
     db_name: str
@@ -335,7 +845,16 @@ class Server:
     path: Path
     path_models: Path
     db: Path
+    db_url: str | None
     projects: dict
+    loading: dict
+    lock: threading.Lock
+    max_memory: int
+    threads: int
+    shared: bool
+    worker: str | None
+    tokens: dict
+    token_ttl: float
     db_manager: DatabaseManager
     queue: Queue
     users: Users
@@ -360,6 +879,13 @@ class Server:
         # Define path
         self.path = Path(path)
         self.path_models = Path(path_models)
+        lanes = None
+        # memory for the loaded projects (default : half of the available one)
+        self.max_memory = functions.get_available_memory() // 2
+        # threads for the blocking routes of the api
+        self.threads = 40
+        self.shared = False
+        self.db_url = None  # SQLite file in the path by default
         # if a YAML configuration file exists, overwrite
         if Path("config.yaml").exists():
             with open("config.yaml") as f:
@@ -368,6 +894,16 @@ class Server:
                 self.path = Path(config["path"])
             if "path_models" in config:
                 self.path_models = Path(config["path_models"])
+            if "lanes" in config:
+                lanes = config["lanes"]
+            if "projects_memory" in config:
+                self.max_memory = int(config["projects_memory"]) * 1024**2
+            if "threads" in config:
+                self.threads = int(config["threads"])
+            if "shared" in config:
+                self.shared = bool(config["shared"])
+            if "database" in config:
+                self.db_url = config["database"]
 
         self.db = self.path / self.db_name
 
@@ -380,10 +916,24 @@ class Server:
             os.makedirs(self.path_models)
 
         # attributes of the server
-        self.projects: dict = {}
-        self.db_manager = DatabaseManager(self.db)
-        self.queue = Queue(self.n_workers)
-        self.users = Users(self.db_manager)
+        self.projects: dict = {}  # loaded projects, the last used at the end
+        self.loading: dict = {}  # projects being loaded
+        self.lock = threading.Lock()
+        self.db_manager = DatabaseManager(self.db_url or self.db)
+        self.worker = None
+        if self.shared:
+            # the first worker started chooses the secret
+            self.worker = f"{socket.gethostname()}-{os.getpid()}"
+            self.SECRET_KEY = self.db_manager.add_shared(
+                "secret", {"key": self.SECRET_KEY}
+            )["key"]
+        self.queue = Queue(self.n_workers, self.db_manager, lanes, worker=self.worker)
+        # tokens validated, checked again in the database after token_ttl
+        # (shorter when revoked tokens come from the other workers)
+        self.tokens = {}
+        self.token_ttl = 5 if self.shared else 60
+        self.users = Users(self.db_manager, ttl=self.token_ttl)
+        self.recover_jobs()
 
         # logging
         logging.basicConfig(
@@ -392,13 +942,48 @@ class Server:
             format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         )
 
+    def recover_jobs(self) -> None:
+        """
+        Reconcile the jobs of a previous run of the server
+        - running jobs have been interrupted, clean their partial outputs
+        - finished jobs are attached when their project is loaded
+        In shared mode, only the jobs of the workers which stopped
+        (checked again by the housekeeping of the api) ; a job without
+        worker is left until it is older than the heartbeat timeout
+        """
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        for job in self.db_manager.get_jobs(["running"]):
+            if self.worker is not None:
+                owner = job["worker"]
+                if owner == self.worker or self.queue.alive(owner):
+                    continue
+                if owner is None and (
+                    job["time_created"] is None
+                    or (now - job["time_created"]).total_seconds() < self.queue.timeout
+                ):
+                    continue
+                self.db_manager.delete_shared(f"job:{job['id']}")
+                self.db_manager.delete_shared(f"kill:{job['id']}")
+            location = Path(job["location"]) if job["location"] else None
+            if job["kind"] == "training" and location is not None:
+                # training completed before the stop
+                if (location / "finished").exists():
+                    self.db_manager.update_job(job["id"], "finished")
+                    continue
+                if location.exists():
+                    shutil.rmtree(location, ignore_errors=True)
+            if job["kind"] == "feature" and location is not None:
+                for f in location.parent.glob(f"{location.name}*"):
+                    os.remove(f)
+            self.db_manager.update_job(job["id"], "interrupted")
+            logger.info(f"Job {job['id']} ({job['kind']}) interrupted")
+
     def __del__(self):
         """
         Close the server
         """
         print("Ending the server")
         logger.error("Disconnect server")
-        self.queue.executor.shutdown()
         self.queue.close()
         print("Server off")
 
@@ -485,13 +1070,25 @@ class Server:
         """
         Revoke existing access token
         """
+        self.tokens.pop(token, None)
         self.db_manager.revoke_token(token)
         return None
 
     def decode_access_token(self, token: str):
         """
         Decode access token
+        Comments:
+            a valid token is kept in cache until it expires,
+            for token_ttl seconds
         """
+        now = time.time()
+        cached = self.tokens.get(token)
+        if cached is not None:
+            payload, checked = cached
+            if now - checked < self.token_ttl and now < payload["exp"]:
+                return payload
+            self.tokens.pop(token, None)
+
         # get status
         status = self.db_manager.get_token_status(token)
         if status != "active":
@@ -499,18 +1096,109 @@ class Server:
 
         # decode payload
         payload = jwt.decode(token, self.SECRET_KEY, algorithms=[self.ALGORITHM])
+        if len(self.tokens) > 10000:  # drop the tokens to check again
+            self.tokens = {}
+        self.tokens[token] = (payload, now)
         return payload
 
     def start_project(self, project_slug: str) -> dict:
         """
         Load project in server
+        Comments:
+            a project is loaded once, concurrent calls wait for it
         """
         if not self.exists(project_slug):
             return {"error": "Project does not exist"}
 
-        self.projects[project_slug] = Project(project_slug, self.queue, self.db_manager)
+        with self.lock:
+            if project_slug in self.projects:
+                return {"success": "Project loaded"}
+            waiting = project_slug in self.loading
+            if not waiting:
+                self.loading[project_slug] = threading.Event()
+            event = self.loading[project_slug]
+
+        # already loading in another thread
+        if waiting:
+            event.wait()
+            if project_slug not in self.projects:
+                return {"error": "Project could not be loaded"}
+            return {"success": "Project loaded"}
+
+        try:
+            project = Project(
+                project_slug, self.queue, self.db_manager, self.path_models
+            )
+            with self.lock:
+                self.projects[project_slug] = project
+        finally:
+            with self.lock:
+                del self.loading[project_slug]
+            event.set()
         return {"success": "Project loaded"}
 
+    def get_project(self, project_slug: str):
+        """
+        Get a project, loaded if needed, and mark it as the last used
+        """
+        project = None
+        with self.lock:
+            if project_slug in self.projects:
+                self.projects[project_slug] = self.projects.pop(project_slug)
+                project = self.projects[project_slug]
+        if project is None:
+            r = self.start_project(project_slug)
+            if "error" in r:
+                return None
+            self.evict_projects()
+            return self.projects.get(project_slug)
+        # changes of the other workers since the last request
+        if self.shared:
+            project.sync()
+        return project
+
+    @contextmanager
+    def use_project(self, project_slug: str):
+        """
+        Get a project for the time of a request
+        (not unloaded while it is used)
+        """
+        while True:
+            project = self.get_project(project_slug)
+            if project is None:
+                yield None
+                return
+            with self.lock:
+                if self.projects.get(project_slug) is project:
+                    project.in_use += 1
+                    break
+        try:
+            yield project
+        finally:
+            with self.lock:
+                project.in_use -= 1
+
+    def evict_projects(self) -> None:
+        """
+        Unload the least recently used projects while the memory
+        used by the loaded projects is over the budget
+        Comments:
+            the last used project, the projects used by a request and
+            the projects with work in progress stay loaded (they are
+            loaded again when needed)
+        """
+        with self.lock:
+            usage = {p: self.projects[p].memory_usage() for p in self.projects}
+            total = sum(usage.values())
+            for p in list(self.projects)[:-1]:
+                if total <= self.max_memory:
+                    break
+                if self.projects[p].in_use > 0 or self.projects[p].is_busy():
+                    continue
+                total -= usage[p]
+                del self.projects[p]
+                logger.info(f"Project {p} unloaded ({usage[p]} bytes)")
+
     def set_project_parameters(self, project: ProjectModel, username: str) -> dict:
         """
         Update project parameters in the DB
@@ -682,16 +1370,20 @@ class Server:
             )
 
             # add the labels in the database
-            for element_id, label in df.items():
-                self.db_manager.add_annotation(
-                    action="add",
-                    user=username,
-                    project_slug=project_slug,
-                    element_id=element_id,
-                    scheme="default",
-                    annotation=label,
-                )
-                print("add annotations ", element_id)
+            self.db_manager.add_annotations(
+                [
+                    {
+                        "project": project_slug,
+                        "scheme": "default",
+                        "element_id": element_id,
+                        "annotation": label,
+                        "user": username,
+                        "action": "add",
+                    }
+                    for element_id, label in df.items()
+                ]
+            )
+            print("add annotations ", len(df))
 
         # add user right on the project + root
         self.users.set_auth(username, project_slug, "manager")
@@ -724,9 +1416,12 @@ class Server:
         # remove directory
         params = self.get_project_params(project_slug)
         shutil.rmtree(params.dir)
+        with self.lock:
+            self.projects.pop(project_slug, None)
 
         # clean database
         self.db_manager.delete_project(project_slug)
+        self.users.invalidate_project(project_slug)
         return {"success": "Project deleted"}
 
 
@@ -734,20 +1429,26 @@ class Features:
     """
     Manage project features
     Comment :
-    - as a file
+    - one file per feature in a dedicated directory
+    - a manifest lists the features and their columns
+    - features.parquet only keeps the index of the trainset
     - use "__" as separator
     """
 
     project_slug: str
     path: Path
+    dir: Path
     queue: Queue
     informations: dict
-    content: DataFrame
+    index: pd.Index
+    manifest: dict
     map: dict
     training: dict
     projections: dict
     possible_projections: dict
     options: dict
+    lock: functions.RWLock
+    modified: float
 
     def __init__(self, project_slug: str, data_path: Path, queue) -> None:
         """
@@ -755,11 +1456,13 @@ class Features:
         """
         self.project_slug = project_slug
         self.path = data_path
+        self.dir = data_path.parent / features_dir
         self.queue = queue
         self.informations = {}
-        content, map = self.load()
-        self.content = content
-        self.map = map
+        self.manifest = {}
+        self.modified = 0  # time of the manifest read or written
+        self.lock = functions.RWLock()  # features and manifest
+        self.index, self.map = self.load()
         self.training: dict = {}
 
         # managing projections
@@ -800,111 +1503,356 @@ class Features:
 
     def load(self):
         """
-        Load file and agregate columns
+        Load the manifest and the index of the features
+        Comments:
+            projects created with a single wide features file
+            are split in one file per feature the first time
         """
-
-        def find_strings_with_pattern(strings, pattern):
-            matching_strings = [s for s in strings if re.match(pattern, s)]
-            return matching_strings
-
         data = pd.read_parquet(self.path)
+        index = data.index
+        self.index = index
+        if (self.dir / "manifest.json").exists():
+            with open(self.dir / "manifest.json", "r") as f:
+                self.manifest = json.load(f)
+            self.modified = os.path.getmtime(self.dir / "manifest.json")
+        if len(data.columns) > 0:
+            self.migrate(data)
+        dic = {i: self.manifest[i]["columns"] for i in self.manifest}
+        return index, dic
+
+    def migrate(self, data: DataFrame) -> None:
+        """
+        Split a wide features file in one file per feature
+        """
         var = set([i.split("__")[0] for i in data.columns])
-        dic = {i: find_strings_with_pattern(data.columns, i) for i in var}
-        return data, dic
+        for name in var:
+            cols = [i for i in data.columns if i.split("__")[0] == name]
+            if name == "dfm":
+                self.write(name, data[cols].astype(pd.SparseDtype("float", 0)))
+            elif all(re.match(r".*__(sb|ft)\d+$", i) for i in cols):
+                self.write(name, data[cols], embeddings=True)
+            else:
+                self.write(name, data[cols])
+        self.save_manifest()
+        data[[]].to_parquet(self.path)
+
+    def memory_usage(self) -> int:
+        """
+        Estimation of the memory used by the features (bytes)
+        Comments:
+            the index and the projections, the files of the features
+            are read (or memory-mapped) when needed
+        """
+        r = int(self.index.memory_usage(deep=True))
+        for projection in list(self.projections.values()):
+            if projection.get("data") is not None:
+                r += int(projection["data"].memory_usage(deep=True).sum())
+        return r
+
+    def save_manifest(self) -> None:
+        """
+        Write the manifest (replace the file in one step)
+        """
+        tmp = self.dir / "manifest.json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, self.dir / "manifest.json")
+        self.modified = os.path.getmtime(self.dir / "manifest.json")
+
+    def is_stale(self) -> bool:
+        """
+        Test if the manifest has been written by another worker of the api
+        """
+        if not (self.dir / "manifest.json").exists():
+            return False
+        return os.path.getmtime(self.dir / "manifest.json") != self.modified
+
+    def filename(self, name: str, ext: str) -> str:
+        """
+        Name of a new file for a feature
+        """
+        os.makedirs(self.dir, exist_ok=True)
+        used = [self.manifest[i]["file"] for i in self.manifest if i != name]
+        file = f"{slugify(name)}.{ext}"
+        n = 1
+        while file in used:
+            file = f"{slugify(name)}-{n}.{ext}"
+            n += 1
+        return file
+
+    def path_embeddings(self, name: str) -> Path:
+        """
+        Path where a worker writes the embeddings of a feature
+        """
+        return (self.dir / self.filename(name, "npy")).absolute()
+
+    def write(self, name: str, content: DataFrame, embeddings: bool = False) -> None:
+        """
+        Write the file of a feature and reference it in the manifest
+        """
+        if functions.is_sparse(content):
+            # sparse matrix (dfm) saved as such
+            file = self.filename(name, "npz")
+            matrix = functions.to_matrix(content.reindex(self.index))
+            scipy.sparse.save_npz(self.dir / file, matrix)
+            format = "npz"
+        elif embeddings:
+            # embeddings saved as float32 array
+            file = self.filename(name, "npy")
+            array = content.reindex(self.index).to_numpy(dtype=np.float32)
+            np.save(self.dir / file, array)
+            format = "npy"
+        else:
+            file = self.filename(name, "parquet")
+            content.to_parquet(self.dir / file)
+            format = "parquet"
+        self.manifest[name] = {
+            "file": file,
+            "columns": list(content.columns),
+            "format": format,
+        }
+
+    def read(self, name: str) -> DataFrame:
+        """
+        Read the file of a feature
+        Comments:
+            embeddings are memory-mapped, not loaded
+        """
+        file = self.dir / self.manifest[name]["file"]
+        columns = self.manifest[name]["columns"]
+        if self.manifest[name].get("format") == "npz":
+            matrix = scipy.sparse.load_npz(file)
+            return functions.to_sparse(matrix, index=self.index, columns=columns)
+        if self.manifest[name].get("format") == "npy":
+            array = np.load(file, mmap_mode="r")
+            return pd.DataFrame(array, index=self.index, columns=columns, copy=False)
+        return pd.read_parquet(file, memory_map=True)
+
+    def add_embeddings(self, name: str, path: Path | str, columns: list) -> dict:
+        """
+        Reference embeddings already written by a worker
+        """
+        with self.lock.write():
+            path = Path(path)
+            if name in self.map:
+                os.remove(path)
+                return {"error": "feature name already exists"}
+            array = np.load(path, mmap_mode="r")
+            if array.shape != (len(self.index), len(columns)):
+                os.remove(path)
+                raise ValueError("Features don't have the right shape")
+            columns = [f"{name}__{i}" for i in columns]
+            self.manifest[name] = {
+                "file": path.name,
+                "columns": columns,
+                "format": "npy",
+            }
+            self.save_manifest()
+            self.map[name] = columns
+            return {"success": "feature added"}
 
     def add(self, name: str, content: DataFrame | Series) -> dict:
         """
         Add feature(s) and save
         """
-        # test length
-        if len(content) != len(self.content):
-            raise ValueError("Features don't have the right shape")
-
-        if name in self.map:
-            return {"error": "feature name already exists"}
+        with self.lock.write():
+            # test length
+            if len(content) != len(self.index):
+                raise ValueError("Features don't have the right shape")
 
-        # change type
-        if type(content) == Series:
-            content = pd.DataFrame(content)
+            if name in self.map:
+                return {"error": "feature name already exists"}
 
-        # add to the table & dictionnary
-        content.columns = [f"{name}__{i}" for i in content.columns]
-        self.map[name] = list(content.columns)
+            # change type
+            if type(content) == Series:
+                content = pd.DataFrame(content)
 
-        self.content = pd.concat([self.content, content], axis=1)
-        # save
-        self.content.to_parquet(self.path)
+            # add to the dictionnary & save
+            content.columns = [f"{name}__{i}" for i in content.columns]
+            self.write(name, content)
+            self.save_manifest()
+            self.map[name] = list(content.columns)
 
-        return {"success": "feature added"}
+            return {"success": "feature added"}
 
     def delete(self, name: str):
         """
         Delete feature
         """
-        if name not in self.map:
-            return {"error": "feature doesn't exist"}
+        with self.lock.write():
+            if name not in self.map:
+                return {"error": "feature doesn't exist"}
 
-        col = self.get([name])
-        del self.map[name]
-        self.content = self.content.drop(columns=col)
-        self.content.to_parquet(self.path)
-        return {"success": "feature deleted"}
+            file = self.dir / self.manifest[name]["file"]
+            del self.map[name]
+            del self.manifest[name]
+            self.save_manifest()
+            if file.exists():
+                os.remove(file)
+            if name in self.informations:
+                del self.informations[name]
+            return {"success": "feature deleted"}
 
     def get(self, features: list | str = "all"):
         """
         Get content for specific features
-        """
-        if features == "all":
-            features = list(self.map.keys())
-        if type(features) is str:
-            features = [features]
-
-        cols = []
-        missing = []
-        for i in features:
-            if i in self.map:
-                cols += self.map[i]
-            else:
-                missing.append(i)
+        Comments:
+            only the files of the requested features are read
+        """
+        with self.lock.read():
+            if features == "all":
+                features = list(self.map.keys())
+            if type(features) is str:
+                features = [features]
+
+            frames = []
+            missing = []
+            for i in features:
+                if i in self.map:
+                    frames.append(self.read(i))
+                else:
+                    missing.append(i)
 
-        if len(i) > 0:
-            print("Missing features:", missing)
-        return self.content[cols]
+            if len(missing) > 0:
+                print("Missing features:", missing)
+            if len(frames) == 0:
+                return pd.DataFrame(index=self.index)
+            return pd.concat(frames, axis=1)
 
     def update_processes(self):
         """
         Check for computing processing completed
         and clean them for the queue
         """
-        # for features
-        for name in self.training.copy():
-            unique_id = self.training[name]
-            # case the process have been canceled, clean
-            if unique_id not in self.queue.current:
-                del self.training[name]
-                continue
-            # else check its state
-            if self.queue.current[unique_id]["future"].done():
-                r = self.queue.current[unique_id]["future"].result()
-                if "error" in r:
-                    print("Error in the feature processing", unique_id)
-                else:
-                    df = r["success"]
-                    self.add(name, df)
-                    self.queue.delete(unique_id)
+        with self.lock.write():
+            # for features
+            for name in self.training.copy():
+                unique_id = self.training[name]
+                # case the process have been canceled, clean
+                if unique_id not in self.queue.current:
                     del self.training[name]
-                    print("Add feature", name)
+                    continue
+                # else check its state
+                if self.queue.current[unique_id]["future"].done():
+                    r = self.queue.current[unique_id]["future"].result()
+                    if "error" in r:
+                        print("Error in the feature processing", unique_id)
+                    else:
+                        df = r["success"]
+                        if isinstance(df, dict):  # embeddings written by the worker
+                            self.add_embeddings(name, df["path"], df["columns"])
+                        else:
+                            self.add(name, df)
+                        self.queue.delete(unique_id)
+                        del self.training[name]
+                        print("Add feature", name)
+
+            # for projections (those of the other workers are synchronized)
+            training = [
+                u
+                for u in self.projections
+                if "queue" in self.projections[u]
+                and "remote" not in self.projections[u]
+            ]
+            for u in training:
+                unique_id = self.projections[u]["queue"]
+                # case the process have been canceled, clean
+                if unique_id not in self.queue.current:
+                    del self.projections[u]
+                    self.share_projection(u)
+                    continue
+                if self.queue.current[unique_id]["future"].done():
+                    df = self.queue.current[unique_id]["future"].result()
+                    if isinstance(df, dict) and "error" in df:
+                        del self.projections[u]
+                        self.share_projection(u)
+                        self.queue.delete(unique_id)
+                        continue
+                    self.projections[u]["data"] = df
+                    self.projections[u]["id"] = self.projections[u]["queue"]
+                    del self.projections[u]["queue"]
+                    self.share_projection(u)
+                    self.queue.delete(unique_id)
 
-        # for projections
-        training = [u for u in self.projections if "queue" in self.projections[u]]
-        for u in training:
-            unique_id = self.projections[u]["queue"]
-            if self.queue.current[unique_id]["future"].done():
-                df = self.queue.current[unique_id]["future"].result()
-                self.projections[u]["data"] = df
-                self.projections[u]["id"] = self.projections[u]["queue"]
-                del self.projections[u]["queue"]
-                self.queue.delete(unique_id)
+    def add_projection(
+        self, user: str, unique_id: str, method: str, params: ProjectionInStrictModel
+    ) -> None:
+        """
+        Record a projection computing for a user
+        """
+        self.projections[user] = {
+            "params": params,
+            "method": method,
+            "queue": unique_id,
+        }
+        self.share_projection(user)
+
+    def share_projection(self, user: str) -> None:
+        """
+        Write the state of the projection of a user in the shared state
+        (only with several workers of the api)
+        Comments:
+            the computed projection is written in a file
+        """
+        if self.queue.worker is None:
+            return None
+        key = f"projection:{self.project_slug}:{user}"
+        projection = self.projections.get(user)
+        if projection is None:
+            self.queue.db_manager.delete_shared(key)
+        elif "queue" in projection:
+            self.queue.db_manager.set_shared(key, {"queue": projection["queue"]})
+        else:
+            os.makedirs(self.dir / "projections", exist_ok=True)
+            file = self.dir / "projections" / f"{slugify(user)}.parquet"
+            df = projection["data"]
+            df.set_axis([str(i) for i in df.columns], axis=1).to_parquet(file)
+            self.queue.db_manager.set_shared(
+                key, {"id": projection["id"], "file": str(file)}
+            )
+
+    def sync_projections(self) -> None:
+        """
+        Get the projections computed or computing on the other workers
+        """
+        shared = self.queue.db_manager.get_shared_prefix(
+            f"projection:{self.project_slug}:"
+        )
+        shared = {k.split(":", 2)[2]: v for k, v in shared.items()}
+        self.merge_projections(shared)
+
+    def merge_projections(self, shared: dict) -> None:
+        """
+        Update the projections with the shared ones {user: state}
+        Comments:
+            the new projections are read without the lock,
+            the lock is only taken if there are changes
+        """
+        changes = {}
+        for user, projection in shared.items():
+            current = self.projections.get(user, {})
+            if "file" in projection and current.get("id") != projection["id"]:
+                df = pd.read_parquet(projection["file"])
+                df.columns = [int(i) if i.isdigit() else i for i in df.columns]
+                changes[user] = {"data": df, "id": projection["id"]}
+            elif (
+                "queue" in projection
+                and ("queue" not in current or "remote" in current)
+                and current.get("queue") != projection["queue"]
+            ):
+                changes[user] = {"queue": projection["queue"], "remote": True}
+        # projections of the other workers which failed
+        failed = [
+            user
+            for user, projection in list(self.projections.items())
+            if "remote" in projection and user not in shared
+        ]
+        if len(changes) == 0 and len(failed) == 0:
+            return None
+        with self.lock.write():
+            self.projections.update(changes)
+            for user in failed:
+                self.projections.pop(user, None)
 
     def get_info(self):
         """
@@ -922,6 +1870,477 @@ class Features:
         return dict(self.informations)
 
 
+class LabelsCache:
+    """
+    In-memory state of the annotations of a project
+    - built once from the current annotations when the project is loaded
+    - updated in place each time a tag is recorded
+    Structure : {scheme: {action: {element_id: [label, user, time, seq]}}}
+
+    Comments:
+        seq keeps the insertion order to resolve elements
+        annotated several times within the same second
+        last is the id of the last annotation read in the database
+        own are the ids of the annotations recorded by this worker
+        since the last read (shared mode), not applied again
+    """
+
+    project_slug: str
+    db_manager: DatabaseManager
+    shared: bool
+    state: dict
+    seq: int
+    last: int
+    own: dict
+
+    def __init__(
+        self, project_slug: str, db_manager: DatabaseManager, shared: bool = False
+    ) -> None:
+        self.project_slug = project_slug
+        self.db_manager = db_manager
+        self.shared = shared
+        self.state = {}
+        self.seq = 0
+        self.last = 0
+        self.own = {}  # {(scheme, action, element_id): annotation id}
+        self.load()
+
+    def __repr__(self) -> str:
+        return f"Labels cache for schemes {list(self.state.keys())}"
+
+    def load(self) -> None:
+        """
+        (Re)build the state from the current annotations table
+        """
+        self.state = {}
+        self.seq = 0
+        self.last = 0
+        annotations = self.db_manager.get_current_annotations(self.project_slug)
+        for scheme, action, element_id, label, user, timestamp, i in annotations:
+            self.update(scheme, action, element_id, label, user, timestamp)
+            self.last = i
+
+    def read(self) -> list:
+        """
+        Read the annotations recorded since the last read
+        (e.g. by another worker of the api)
+        """
+        return self.db_manager.get_project_annotations(self.project_slug, self.last)
+
+    def apply(self, annotations: list) -> list:
+        """
+        Apply the annotations read, except the ones recorded by this
+        worker or older than them, and return the ones applied
+        """
+        r = []
+        for annotation in annotations:
+            scheme, action, element_id, label, user, timestamp, i = annotation
+            if i <= self.last:  # applied meanwhile
+                continue
+            self.last = i
+            if self.own.get((scheme, action, str(element_id)), 0) >= i:
+                continue
+            self.update(scheme, action, element_id, label, user, timestamp)
+            r.append(annotation)
+        # the next annotations read are more recent
+        self.own = {k: v for k, v in self.own.items() if v > self.last}
+        return r
+
+    def update(
+        self,
+        scheme: str,
+        action: str,
+        element_id: str,
+        label: str | None,
+        user: str,
+        timestamp: datetime | None = None,
+        annotation_id: int | None = None,
+    ) -> None:
+        """
+        Record the last annotation of an element
+        (annotation_id : recorded by this worker)
+        """
+        if self.shared and annotation_id is not None:
+            self.own[(scheme, action, str(element_id))] = annotation_id
+        if timestamp is None:
+            # same convention as the database (UTC without timezone)
+            timestamp = datetime.now(timezone.utc).replace(tzinfo=None)
+        self.seq += 1
+        actions = self.state.setdefault(scheme, {})
+        actions.setdefault(action, {})[str(element_id)] = [
+            label,
+            user,
+            timestamp,
+            self.seq,
+        ]
+
+    def elements(self, scheme: str, kind: list) -> dict:
+        """
+        Last annotation for each element of a scheme
+        for a list of actions {element_id: [label, user, time, seq]}
+        """
+        actions = self.state.get(scheme, {})
+        if len(kind) == 1:
+            return actions.get(kind[0], {})
+        r = {}
+        for action in kind:
+            for element_id, entry in actions.get(action, {}).items():
+                if element_id not in r or r[element_id][3] < entry[3]:
+                    r[element_id] = entry
+        return r
+
+
+class IdPool:
+    """
+    Set of row positions with O(1) add, remove and random draw
+    - items : compact array of the positions in the pool
+    - where : place of each position in items (-1 if absent)
+    """
+
+    items: np.ndarray
+    where: np.ndarray
+    n: int
+    cursor: int
+
+    def __init__(self, size: int, positions: np.ndarray) -> None:
+        positions = np.asarray(positions, dtype=np.int64)
+        self.items = np.empty(size, dtype=np.int64)
+        self.where = np.full(size, -1, dtype=np.int64)
+        self.n = len(positions)
+        self.items[: self.n] = positions
+        self.where[positions] = np.arange(self.n)
+        self.cursor = 0  # no element of the pool before this position
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __contains__(self, position: int) -> bool:
+        return self.where[position] >= 0
+
+    def add(self, position: int) -> None:
+        if self.where[position] >= 0:
+            return None
+        self.items[self.n] = position
+        self.where[position] = self.n
+        self.n += 1
+        self.cursor = min(self.cursor, position)
+
+    def remove(self, position: int) -> None:
+        i = self.where[position]
+        if i < 0:
+            return None
+        # move the last element in the free slot
+        last = self.items[self.n - 1]
+        self.items[i] = last
+        self.where[last] = i
+        self.where[position] = -1
+        self.n -= 1
+
+    def mask(self) -> np.ndarray:
+        return self.where >= 0
+
+    def first(self, exclude: set, chunk: int = 4096) -> int | None:
+        """
+        First position of the pool (in the order of the data)
+        """
+        size = len(self.where)
+        start = self.cursor
+        moved = False
+        while start < size:
+            found = np.flatnonzero(self.where[start : start + chunk] >= 0) + start
+            if len(found) > 0 and not moved:
+                self.cursor = int(found[0])
+                moved = True
+            for position in found:
+                if int(position) not in exclude:
+                    return int(position)
+            start += chunk
+        return None
+
+    def random(self, exclude: set, rng: np.random.Generator) -> int | None:
+        """
+        Random position of the pool
+        """
+        if self.n == 0:
+            return None
+        for _ in range(10 + len(exclude)):
+            position = int(self.items[rng.integers(self.n)])
+            if position not in exclude:
+                return position
+        # pool almost exhausted by the exclusion
+        candidates = np.setdiff1d(self.items[: self.n], list(exclude))
+        if len(candidates) == 0:
+            return None
+        return int(rng.choice(candidates))
+
+
+class Sampler:
+    """
+    Precomputed sampling indexes to select the next element
+    - untagged/tagged pools of positions for each scheme
+    - cache of the regex filters on the texts/context
+    - short leases on the elements sent to a user
+
+    Comments:
+        pools are built lazily from the labels cache for the action "add"
+        and updated each time a tag is recorded
+        restore is called when an element becomes untagged again
+        (rankings of the simplemodels)
+        used under the read lock of the schemes, the lazy pools, the
+        filters and the leases have their own lock
+        in shared mode (db_manager set), the leases are in the state
+        shared by the workers of the api
+    """
+
+    content: DataFrame
+    labels: LabelsCache
+    position: dict
+    pools: dict
+    filters: dict
+    max_filters: int
+    leases: dict
+    rng: np.random.Generator
+    restore: Callable | None
+    lock: threading.Lock
+    db_manager: DatabaseManager | None
+    prefix: str
+
+    def __init__(
+        self,
+        content: DataFrame,
+        labels: LabelsCache,
+        max_filters: int = 50,
+        db_manager: DatabaseManager | None = None,
+        prefix: str = "",
+    ) -> None:
+        self.content = content
+        self.labels = labels
+        self.position = {str(j): i for i, j in enumerate(content.index)}
+        self.pools = {}
+        self.filters = {}
+        self.max_filters = max_filters
+        self.leases = {}  # {scheme: {element_id: [user, expiry]}}
+        self.rng = np.random.default_rng()
+        self.restore = None
+        self.lock = threading.Lock()
+        self.db_manager = db_manager  # shared leases
+        self.prefix = prefix  # of the keys of the shared leases
+
+    def __repr__(self) -> str:
+        return f"Sampling pools for schemes {list(self.pools.keys())}"
+
+    def get_pools(self, scheme: str) -> dict:
+        """
+        Get (or build) the tagged/untagged pools of a scheme
+        """
+        if scheme in self.pools:
+            return self.pools[scheme]
+        with self.lock:
+            if scheme in self.pools:
+                return self.pools[scheme]
+            size = len(self.content)
+            tagged = np.zeros(size, dtype=bool)
+            for element_id, entry in self.labels.elements(scheme, ["add"]).items():
+                if entry[0] is not None and element_id in self.position:
+                    tagged[self.position[element_id]] = True
+            self.pools[scheme] = {
+                "tagged": IdPool(size, np.flatnonzero(tagged)),
+                "untagged": IdPool(size, np.flatnonzero(~tagged)),
+            }
+        return self.pools[scheme]
+
+    def update(
+        self, scheme: str, element_id: str, label: str | None, release: bool = True
+    ) -> None:
+        """
+        Move an element between the pools after an annotation
+        (and release its reservation)
+        """
+        if release and self.db_manager is not None:
+            self.db_manager.delete_shared(f"{self.prefix}{scheme}:{element_id}")
+        elif release:
+            with self.lock:
+                self.leases.get(scheme, {}).pop(str(element_id), None)
+        if scheme not in self.pools or str(element_id) not in self.position:
+            return None
+        position = self.position[str(element_id)]
+        pools = self.pools[scheme]
+        if label is None:
+            pools["tagged"].remove(position)
+            pools["untagged"].add(position)
+            if self.restore is not None:
+                self.restore(scheme, str(element_id))
+        else:
+            pools["untagged"].remove(position)
+            pools["tagged"].add(position)
+
+    def reserve(self, scheme: str, element_ids: list, user: str, lease: int) -> list:
+        """
+        Reserve elements for a user during the lease (in seconds)
+        Return the elements reserved (not reserved by other users meanwhile)
+        """
+        now = time.time()
+        if self.db_manager is not None:
+            keys = {f"{self.prefix}{scheme}:{i}": i for i in element_ids}
+            leased = self.db_manager.lease_shared(list(keys), user, now + lease)
+            return [keys[k] for k in leased]
+        r = []
+        with self.lock:
+            leases = self.leases.setdefault(scheme, {})
+            for element_id in element_ids:
+                current = leases.get(str(element_id))
+                if current is not None and current[0] != user and current[1] >= now:
+                    continue
+                leases[str(element_id)] = [user, now + lease]
+                r.append(element_id)
+        return r
+
+    def reserved(self, scheme: str, user: str) -> list:
+        """
+        Elements currently reserved by other users
+        (and clean the expired leases)
+        """
+        now = time.time()
+        if self.db_manager is not None:
+            prefix = f"{self.prefix}{scheme}:"
+            return [
+                k.removeprefix(prefix)
+                for k, v in self.db_manager.get_shared_prefix(prefix).items()
+                if v["user"] != user and v["expiry"] >= now
+            ]
+        with self.lock:
+            leases = self.leases.get(scheme, {})
+            for element_id in [i for i in leases if leases[i][1] < now]:
+                del leases[element_id]
+            return [i for i in leases if leases[i][0] != user]
+
+    def is_untagged(self, scheme: str, element_id: str) -> bool:
+        """
+        Test if an element is in the untagged pool of a scheme
+        """
+        if str(element_id) not in self.position:
+            return False
+        return self.position[str(element_id)] in self.get_pools(scheme)["untagged"]
+
+    def get_filter(self, filter: str) -> np.ndarray:
+        """
+        Boolean mask of the elements matching a regex
+        (on the context if the filter starts with CONTEXT=)
+        """
+        mask = self.filters.get(filter)
+        if mask is not None:
+            return mask
+        if "CONTEXT=" in filter:
+            cols_context = [i for i in self.content.columns if i != "text"]
+            texts = self.content[cols_context].apply(
+                lambda row: " ".join(row.values.astype(str)), axis=1
+            )
+            pattern = filter.replace("CONTEXT=", "")
+        else:
+            texts = self.content["text"]
+            pattern = filter
+        mask = texts.str.contains(pattern, regex=True, case=True, na=False).to_numpy(
+            dtype=bool
+        )
+        # keep a limited number of filters
+        with self.lock:
+            if len(self.filters) >= self.max_filters:
+                del self.filters[next(iter(self.filters))]
+            self.filters[filter] = mask
+        return mask
+
+    def get_frame(self, projection: DataFrame, frame: list) -> np.ndarray:
+        """
+        Boolean mask of the elements inside a box of the projection
+        """
+        projection = projection.reindex(self.content.index)
+        x = projection[0].to_numpy()
+        y = projection[1].to_numpy()
+        return (x > frame[0]) & (x < frame[1]) & (y > frame[2]) & (y < frame[3])
+
+    def mask(
+        self,
+        scheme: str,
+        sample: str = "untagged",
+        filter: str | None = None,
+        frame: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """
+        Boolean mask of the elements available for a selection
+        """
+        if sample in ["untagged", "tagged"]:
+            f = self.get_pools(scheme)[sample].mask()
+        else:
+            f = np.ones(len(self.content), dtype=bool)
+        if filter:
+            f = f & self.get_filter(filter)
+        if frame is not None:
+            f = f & frame
+        return f
+
+    def draw(
+        self,
+        scheme: str,
+        selection: str = "deterministic",
+        sample: str = "untagged",
+        history: list = [],
+        filter: str | None = None,
+        frame: np.ndarray | None = None,
+    ) -> str | None:
+        """
+        Draw the next element (deterministic or random)
+        Return None if no element is available
+        """
+        exclude = {self.position[str(i)] for i in history if str(i) in self.position}
+
+        # direct draw in the pools
+        if not filter and frame is None:
+            if sample in ["untagged", "tagged"]:
+                pool = self.get_pools(scheme)[sample]
+            else:
+                pool = None
+            if selection == "random":
+                if pool is None:
+                    position = self.random_all(exclude)
+                else:
+                    position = pool.random(exclude, self.rng)
+            elif pool is None:
+                position = next(
+                    (i for i in range(len(self.content)) if i not in exclude), None
+                )
+            else:
+                position = pool.first(exclude)
+
+        # combination of filters
+        else:
+            f = self.mask(scheme, sample, filter, frame)
+            if len(exclude) > 0:
+                f[list(exclude)] = False
+            candidates = np.flatnonzero(f)
+            if len(candidates) == 0:
+                position = None
+            elif selection == "random":
+                position = int(self.rng.choice(candidates))
+            else:
+                position = int(candidates[0])
+
+        if position is None:
+            return None
+        return str(self.content.index[position])
+
+    def random_all(self, exclude: set) -> int | None:
+        """
+        Random position in the whole dataset
+        """
+        size = len(self.content)
+        if len(exclude) >= size:
+            return None
+        while True:
+            position = int(self.rng.integers(size))
+            if position not in exclude:
+                return position
+
+
 class Schemes:
     """
     Manage project schemes & tags
@@ -929,12 +2348,20 @@ class Schemes:
     Tables :
     - schemes
     - annotations
+
+    Comments:
+        the current labels are kept in memory (LabelsCache)
+        the annotations table is read when the project is loaded, then
+        only for the new annotations of the other workers (shared mode)
     """
 
     project_slug: str
     db_manager: DatabaseManager
     content: DataFrame
     test: DataFrame | None
+    labels: LabelsCache
+    sampler: Sampler
+    lock: functions.RWLock
 
     def __init__(
         self,
@@ -942,6 +2369,7 @@ class Schemes:
         path_content: Path,  # training data
         path_test: Path,  # test data
         db_manager: DatabaseManager,
+        shared: bool = False,
     ) -> None:
         """
         Init empty
@@ -953,6 +2381,16 @@ class Schemes:
         if path_test.exists():
             self.test = pd.read_parquet(path_test)
 
+        # current state of the annotations
+        self.lock = functions.RWLock()  # labels and sampler
+        self.labels = LabelsCache(project_slug, db_manager, shared)
+        self.sampler = Sampler(
+            self.content,
+            self.labels,
+            db_manager=db_manager if shared else None,
+            prefix=f"lease:{project_slug}:",
+        )
+
         available = self.available()
 
         # create a default scheme if not available
@@ -962,6 +2400,23 @@ class Schemes:
     def __repr__(self) -> str:
         return f"Coding schemes available {self.available()}"
 
+    def sync(self) -> None:
+        """
+        Update the labels and the sampling pools with the annotations
+        recorded by the other workers of the api
+        Comments:
+            read without the lock, applied under the lock if any
+        """
+        annotations = self.labels.read()
+        if len(annotations) == 0:
+            return None
+        with self.lock.write():
+            for scheme, action, element_id, label, _, _, _ in self.labels.apply(
+                annotations
+            ):
+                if action == "add":
+                    self.sampler.update(scheme, element_id, label, release=False)
+
     def get_scheme_data(
         self, scheme: str, complete: bool = False, kind: list | str = ["add"]
     ) -> DataFrame:
@@ -974,46 +2429,33 @@ class Schemes:
 
         TODO : replace all "add" with "train" in the code
         """
-        if scheme not in self.available():
-            return {"error": "Scheme doesn't exist"}
-
-        if isinstance(kind, str):
-            kind = [kind]
-
-        # get all elements from the db
-        # - last element for each id
-        # - for a specific scheme
-
-        results = self.db_manager.get_scheme_elements(self.project_slug, scheme, kind)
-
-        # conn = sqlite3.connect(self.db)
-        # cursor = conn.cursor()
-        # action = "(" + " OR ".join([f"action = ?" for i in kind]) + ")"
-
-        # query = f"""
-        #     SELECT element_id, tag, user, MAX(time)
-        #     FROM annotations
-        #     WHERE scheme = ? AND project = ? AND {action}
-        #     GROUP BY element_id
-        #     ORDER BY time DESC;
-        # """
-        # cursor.execute(query, (scheme, self.project_slug) + tuple(kind))
-
-        # results = cursor.fetchall()
-        # conn.close()
-
-        df = pd.DataFrame(
-            results, columns=["id", "labels", "user", "timestamp"]
-        ).set_index("id")
-        df.index = [str(i) for i in df.index]
-        if complete:  # all the elements
-            if "test" in kind:
-                # case if the test, join the text data
-                t = self.test[["text"]].join(df)
-                return t
-            else:
-                return self.content.join(df)
-        return df
+        with self.lock.read():
+            if scheme not in self.available():
+                return {"error": "Scheme doesn't exist"}
+
+            if isinstance(kind, str):
+                kind = [kind]
+
+            # get all elements from the labels cache
+            # - last element for each id
+            # - for a specific scheme
+            # - most recent first
+            elements = self.labels.elements(scheme, kind)
+            results = sorted(elements.items(), key=lambda x: x[1][3], reverse=True)
+
+            df = pd.DataFrame(
+                [[i, j[0], j[1], j[2]] for i, j in results],
+                columns=["id", "labels", "user", "timestamp"],
+            ).set_index("id")
+            df.index = [str(i) for i in df.index]
+            if complete:  # all the elements
+                if "test" in kind:
+                    # case if the test, join the text data
+                    t = self.test[["text"]].join(df)
+                    return t
+                else:
+                    return self.content.join(df)
+            return df
 
     def get_reconciliation_table(self, scheme: str):
         """
@@ -1072,9 +2514,12 @@ class Schemes:
         # get id with the current tag
         df = self.get_scheme_data(scheme)
         to_recode = df[df["labels"] == former_label].index
-        # for each of them, push the new tag
-        for i in to_recode:
-            self.push_tag(i, new_label, scheme, username, "add")
+        # push the new tag for all of them
+        r = self.push_tags(
+            list(to_recode), [new_label] * len(to_recode), scheme, username, "add"
+        )
+        if "error" in r:
+            return r
         return {"success": "All tags recoded"}
 
     def get_total(self, dataset="train"):
@@ -1212,21 +2657,20 @@ class Schemes:
         """
         Delete a label in a scheme
         """
-        available = self.available()
-        if not scheme in available:
-            return {"error": "scheme doesn't exist"}
-        if not label in available[scheme]:
-            return {"error": "label does not exist"}
-        labels = available[scheme]
-        labels.remove(label)
-        # push empty entry for tagged elements
-        df = self.get_scheme_data(scheme)
-        elements = list(df[df["labels"] == label].index)
-        for i in elements:
-            print(i)
-            self.push_tag(i, None, scheme, user, "add")
-        self.update_scheme(scheme, labels)
-        return {"success": "scheme updated removing a label"}
+        with self.lock.write():
+            available = self.available()
+            if not scheme in available:
+                return {"error": "scheme doesn't exist"}
+            if not label in available[scheme]:
+                return {"error": "label does not exist"}
+            labels = available[scheme]
+            labels.remove(label)
+            # push empty entry for tagged elements
+            df = self.get_scheme_data(scheme)
+            elements = list(df[df["labels"] == label].index)
+            self.push_tags(elements, [None] * len(elements), scheme, user, "add")
+            self.update_scheme(scheme, labels)
+            return {"success": "scheme updated removing a label"}
 
     def update_scheme(self, scheme: str, labels: list):
         """
@@ -1270,13 +2714,17 @@ class Schemes:
         i.e. : add empty label
         """
 
-        self.db_manager.post_annotation(
-            self.project_slug, scheme, element_id, None, user, "delete"
-        )
-        self.db_manager.post_annotation(
-            self.project_slug, scheme, element_id, None, user, "add"
-        )
-        return True
+        with self.lock.write():
+            i = self.db_manager.post_annotation(
+                self.project_slug, scheme, element_id, None, user, "delete"
+            )
+            self.labels.update(scheme, "delete", element_id, None, user, None, i)
+            i = self.db_manager.post_annotation(
+                self.project_slug, scheme, element_id, None, user, "add"
+            )
+            self.labels.update(scheme, "add", element_id, None, user, None, i)
+            self.sampler.update(scheme, element_id, None)
+            return True
 
     def push_tag(
         self,
@@ -1291,26 +2739,72 @@ class Schemes:
         mode : train, predict, test
         """
 
-        # TO FIX IN THE FUTURE
-        if mode == "train":
-            mode = "add"
+        with self.lock.write():
+            # TO FIX IN THE FUTURE
+            if mode == "train":
+                mode = "add"
 
-        # test if the action is possible
-        a = self.available()
-        if not scheme in a:
-            return {"error": "scheme unavailable"}
-        if (not tag is None) and (not tag in a[scheme]):
-            return {"error": "this tag doesn't belong to this scheme"}
+            # test if the action is possible
+            a = self.available()
+            if not scheme in a:
+                return {"error": "scheme unavailable"}
+            if (not tag is None) and (not tag in a[scheme]):
+                return {"error": "this tag doesn't belong to this scheme"}
 
-        # TODO : add a test also for testing
-        # if (not element_id in self.content.index):
-        #    return {"error":"element doesn't exist"}
+            # TODO : add a test also for testing
+            # if (not element_id in self.content.index):
+            #    return {"error":"element doesn't exist"}
 
-        self.db_manager.post_annotation(
-            self.project_slug, scheme, element_id, tag, user, mode
-        )
-        print(("push tag", mode, user, self.project_slug, element_id, scheme, tag))
-        return {"success": "tag added"}
+            i = self.db_manager.post_annotation(
+                self.project_slug, scheme, element_id, tag, user, mode
+            )
+            self.labels.update(scheme, mode, element_id, tag, user, None, i)
+            if mode == "add":
+                self.sampler.update(scheme, element_id, tag)
+            print(("push tag", mode, user, self.project_slug, element_id, scheme, tag))
+            return {"success": "tag added"}
+
+    def push_tags(
+        self,
+        element_ids: list,
+        tags: list,
+        scheme: str,
+        user: str = "server",
+        mode: str = "train",
+    ) -> dict:
+        """
+        Record tags in bulk (one transaction in the database)
+        mode : train, predict, test
+        """
+        with self.lock.write():
+            if mode == "train":
+                mode = "add"
+
+            # test if the actions are possible
+            a = self.available()
+            if not scheme in a:
+                return {"error": "scheme unavailable"}
+            if any((tag is not None) and (tag not in a[scheme]) for tag in tags):
+                return {"error": "a tag doesn't belong to this scheme"}
+
+            ids = self.db_manager.add_annotations(
+                [
+                    {
+                        "project": self.project_slug,
+                        "scheme": scheme,
+                        "element_id": element_id,
+                        "annotation": tag,
+                        "user": user,
+                        "action": mode,
+                    }
+                    for element_id, tag in zip(element_ids, tags)
+                ]
+            )
+            for element_id, tag, i in zip(element_ids, tags, ids):
+                self.labels.update(scheme, mode, element_id, tag, user, None, i)
+                if mode == "add":
+                    self.sampler.update(scheme, element_id, tag)
+            return {"success": f"{len(tags)} tags added"}
 
     def push_table(self, table, user: str, action: str = "add") -> bool:
         """
@@ -1319,10 +2813,11 @@ class Schemes:
         - only update modified labels
         """
         data = {i: j for i, j in zip(table.list_ids, table.list_labels)}
-        for i in data:
-            r = self.push_tag(i, data[i], table.scheme, user, action)
-            if "error" in r:
-                return {"error": "Something happened when recording."}
+        r = self.push_tags(
+            list(data.keys()), list(data.values()), table.scheme, user, action
+        )
+        if "error" in r:
+            return {"error": "Something happened when recording."}
         return {"success": "table pushed"}
 
     def get_coding_users(self, scheme: str):
@@ -1366,16 +2861,7 @@ class Generations:
                 if "error" in r:
                     print("Error in the generating process", unique_id)
                 else:
-                    results = r["success"]
-                    for row in results:
-                        self.add(
-                            user=row["user"],
-                            project_slug=row["project_slug"],
-                            element_id=row["element_id"],
-                            endpoint=row["endpoint"],
-                            prompt=row["prompt"],
-                            answer=row["answer"],
-                        )
+                    self.db_manager.add_generations(r["success"])
                     self.queue.delete(unique_id)
                     del self.generating[name]
 
@@ -1425,6 +2911,9 @@ class Generations:
 class Project(Server):
     """
     Project object
+    Comments:
+        loaded in stages : parameters and schemes first, the data,
+        features and simplemodels on first access
     """
 
     starting_time: float
@@ -1432,18 +2921,21 @@ class Project(Server):
     queue: Queue
     db_manager: DatabaseManager
     params: ProjectModel
-    content: DataFrame
     schemes: Schemes
-    features: Features
     bertmodels: BertModels
-    simplemodels: SimpleModels
     generations: Generations
+    memory: dict
+    in_use: int
+    synced: float
+    sync_lock: threading.Lock
+    path_models: Path
 
     def __init__(
         self,
         project_slug: str,
         queue: Queue,
         db_manager: DatabaseManager,
+        path_models: Path = Path("./models"),
     ) -> None:
         """
         Load existing project
@@ -1452,32 +2944,250 @@ class Project(Server):
         self.name = project_slug
         self.queue = queue
         self.db_manager = db_manager
+        self.path_models = path_models
+        self.in_use = 0  # requests using the project
+        self.synced = 0  # time of the last sync (shared mode)
+        self.sync_lock = threading.Lock()
         self.params = self.load_params(project_slug)
+        self.memory = {}  # size of the data loaded (bytes)
 
         # check if directory exists
         if self.params.dir is None:
             raise ValueError("No directory exists for this project")
 
-        # loading data
-        self.content = pd.read_parquet(self.params.dir / data_file)
-
         # create specific management objets
         self.schemes = Schemes(
             project_slug,
             self.params.dir / labels_file,
             self.params.dir / test_file,
             self.db_manager,
+            self.queue.worker is not None,
         )
-        self.features = Features(
-            project_slug, self.params.dir / features_file, self.queue
-        )
-        self.bertmodels = BertModels(self.params.dir, self.queue)
-        self.simplemodels = SimpleModels(self.params.dir, self.queue)
+        self.bertmodels = BertModels(project_slug, self.params.dir, self.queue)
         self.generations = Generations(self.queue, self.db_manager)
 
+        # results of the jobs of a previous run of the server
+        self.attach_jobs()
+
     def __del__(self):
         pass
 
+    @cached_property
+    def content(self) -> DataFrame:
+        """
+        Data of the project (loaded on first access)
+        """
+        return pd.read_parquet(self.params.dir / data_file)
+
+    @cached_property
+    def features(self) -> Features:
+        """
+        Features of the project (loaded on first access)
+        """
+        return self.load_features()
+
+    @cached_property
+    def simplemodels(self) -> SimpleModels:
+        """
+        Simplemodels of the project (loaded on first access)
+        """
+        return self.load_simplemodels()
+
+    def load_features(self) -> Features:
+        """
+        Load the features of the project
+        """
+        features = Features(
+            self.params.project_slug, self.params.dir / features_file, self.queue
+        )
+        if self.queue.worker is not None:
+            features.sync_projections()
+        return features
+
+    def load_simplemodels(self) -> SimpleModels:
+        """
+        Load the simplemodels of the project
+        """
+        simplemodels = SimpleModels(
+            self.params.project_slug, self.params.dir, self.queue
+        )
+        self.schemes.sampler.restore = simplemodels.restore
+        return simplemodels
+
+    def loaded(self, name: str) -> bool:
+        """
+        Test if a part of the project loaded on first access is loaded
+        """
+        return name in self.__dict__
+
+    def memory_usage(self) -> int:
+        """
+        Estimation of the memory used by the data of the project (bytes)
+        Comments:
+            the size of the texts is computed once by dataframe
+        """
+        frames = {"data": self.__dict__.get("content"), "labels": self.schemes.content}
+        frames["test"] = self.schemes.test
+        for name, df in frames.items():
+            if name not in self.memory and df is not None:
+                self.memory[name] = int(df.memory_usage(deep=True).sum())
+        r = sum(self.memory.values())
+        if self.loaded("features"):
+            r += self.features.memory_usage()
+        if self.loaded("simplemodels"):
+            for u in list(self.simplemodels.existing):
+                for sm in list(self.simplemodels.existing[u].values()):
+                    for df in [sm.proba, sm.X]:
+                        if df is not None:
+                            r += int(df.memory_usage().sum())
+        return r
+
+    def is_busy(self) -> bool:
+        """
+        Test if the project has work in progress (in memory only)
+        """
+        if len(self.bertmodels.computing) > 0 or len(self.generations.generating) > 0:
+            return True
+        if self.loaded("features"):
+            if len(self.features.training) > 0 or any(
+                "queue" in p and "remote" not in p
+                for p in self.features.projections.values()
+            ):
+                return True
+        if self.loaded("simplemodels"):
+            if (
+                len(self.simplemodels.computing) > 0
+                or len(self.simplemodels.validating) > 0
+                or len(self.simplemodels.autotrain) > 0
+            ):
+                return True
+        return False
+
+    def sync(self, step: float = 1) -> None:
+        """
+        Update the project with the changes of the other workers of the api
+        - annotations recorded since the last request
+        - features and simplemodels saved meanwhile, loaded again
+        if they have no work in progress
+        - projections computed or computing
+        Comments:
+            at most every step seconds, by one request at a time (the
+            others go on with the current state) ; the parts loaded
+            again replace the former ones in one step
+        """
+        if time.time() - self.synced < step:
+            return None
+        if not self.sync_lock.acquire(blocking=False):
+            return None
+        try:
+            self.synced = time.time()
+            self.schemes.sync()
+            features = self.__dict__.get("features")
+            if features is not None:
+                if (
+                    features.is_stale()
+                    and len(features.training) == 0
+                    and not any(
+                        "queue" in p and "remote" not in p
+                        for p in features.projections.values()
+                    )
+                ):
+                    self.__dict__["features"] = self.load_features()
+                else:
+                    features.sync_projections()
+            simplemodels = self.__dict__.get("simplemodels")
+            if (
+                simplemodels is not None
+                and simplemodels.is_stale()
+                and len(simplemodels.computing) == 0
+                and len(simplemodels.validating) == 0
+                and len(simplemodels.autotrain) == 0
+            ):
+                self.__dict__["simplemodels"] = self.load_simplemodels()
+        finally:
+            self.sync_lock.release()
+
+    def update_processes(self) -> None:
+        """
+        Update the processes of the project
+        (only for the parts loaded)
+        """
+        if self.loaded("features"):
+            self.features.update_processes()
+        if self.loaded("simplemodels"):
+            self.simplemodels.update_processes()
+            self.autotrain_simplemodels()
+        self.generations.update_generations()
+        predictions = self.bertmodels.update_processes()
+
+        # if predictions completed, add them as features
+        # careful : they are categorical variables
+        for f in predictions:
+            df_num = functions.cat2num(predictions[f])
+            name = f.replace("__", "_")
+            self.features.add(name, df_num)  # avoid __ in the name for features
+            print("Add feature", name)
+
+    def attach_jobs(self) -> None:
+        """
+        Attach the jobs of the project finished or interrupted
+        while the project was not loaded (e.g. restart of the server)
+        - add computed embeddings and predictions as features
+        - launch again interrupted simplemodels and features
+        (the other interrupted jobs are reported in the logs)
+        In shared mode, the jobs of the other workers still alive
+        are left to them
+        """
+        jobs = self.db_manager.get_jobs(
+            ["finished", "interrupted"], self.params.project_slug
+        )
+        for job in jobs:
+            if self.queue.worker is not None:
+                owner = job["worker"]
+                if owner != self.queue.worker and self.queue.alive(owner):
+                    continue
+            if job["id"] in self.queue.current:
+                self.queue.delete(job["id"])
+            if job["state"] == "interrupted":
+                if job["kind"] == "simplemodel" and job["params"] is not None:
+                    r = self.update_simplemodel(
+                        SimpleModelModel(**job["params"]), job["user"]
+                    )
+                    print("Simplemodel launched again", r)
+                    self.db_manager.update_job(job["id"], "resubmitted")
+                elif (
+                    job["kind"] == "feature"
+                    and job["params"] is not None
+                    and job["name"] not in self.features.map
+                ):
+                    r = self.compute_feature(FeatureModel(**job["params"]), job["user"])
+                    print("Feature launched again", r)
+                    self.db_manager.update_job(job["id"], "resubmitted")
+                else:
+                    self.db_manager.add_log(
+                        job["user"],
+                        f"{job['kind']} {job['name']} interrupted, to launch again",
+                        self.params.project_slug,
+                        "not implemented",
+                    )
+                    self.db_manager.update_job(job["id"], "abandoned")
+                continue
+            result = job["result"]
+            if job["kind"] == "feature" and result is not None and "path" in result:
+                if (
+                    Path(result["path"]).exists()
+                    and job["name"] not in self.features.map
+                ):
+                    self.features.add_embeddings(
+                        job["name"], result["path"], result["columns"]
+                    )
+            if job["kind"] == "prediction" and job["params"] is None:
+                name = ("predict_" + job["name"]).replace("__", "_")
+                if Path(job["location"]).exists() and name not in self.features.map:
+                    df = pd.read_parquet(job["location"])
+                    self.features.add(name, functions.cat2num(df["prediction"]))
+            self.db_manager.update_job(job["id"], "collected")
+
     def load_params(self, project_slug: str) -> ProjectModel:
         """
         Load params from database
@@ -1577,10 +3287,21 @@ class Project(Server):
             col_features=col_features,
             model_params=params,
             standardize=simplemodel.standardize,
+            incremental=simplemodel.incremental,
+            cv10=simplemodel.cv10,
         )
 
         return {"success": "Simplemodel updated"}
 
+    def autotrain_simplemodels(self) -> None:
+        """
+        Launch the automatic trainings of simplemodels which are due
+        """
+        for user, params in self.simplemodels.get_autotrain():
+            r = self.update_simplemodel(SimpleModelModel(**params), user)
+            if "error" in r:
+                logger.error(f"Automatic training of {user} failed: {r['error']}")
+
     def get_next(
         self,
         scheme: str,
@@ -1601,6 +3322,128 @@ class Project(Server):
         - test
 
         filter is a regex to use on the corpus
+        Comments:
+            only reads, several users can select their element at once
+        """
+        with self.schemes.lock.read():
+            r = self.select_next(
+                scheme, selection, sample, user, tag, history, frame, filter
+            )
+            if "error" in r:
+                return r
+            element_id = r["element_id"]
+
+            # specific case of test, random element
+            if selection == "test":
+                return self.format_test_element(element_id)
+
+            # get all tags already existing for the element
+            history = self.schemes.db_manager.get_annotations_by_element(
+                self.params.project_slug, scheme, element_id
+            )
+            return self.format_element(
+                element_id, scheme, user, selection, r["info"], frame, history
+            )
+
+    def get_next_batch(
+        self,
+        scheme: str,
+        n_elements: int = 10,
+        selection: str = "deterministic",
+        sample: str = "untagged",
+        user: str = "user",
+        tag: None | str = None,
+        history: list = [],
+        frame: None | list = None,
+        filter: str | None = None,
+        lease: int = 300,
+    ) -> dict:
+        """
+        Get the next n elements in one call
+        The elements are reserved for the user during the lease (in seconds)
+        so they are not sent to other users annotating the same scheme
+        Comments:
+            the elements are selected under the read lock, and reserved
+            under the write lock if still available ; the ones taken
+            meanwhile by another user are replaced (they stay excluded,
+            so the selection ends)
+        """
+        if n_elements < 1:
+            return {"error": "The number of elements must be positive"}
+
+        exclude = list(history)
+        selected: list = []
+        while True:
+            # select the elements one after the other
+            candidates = []
+            with self.schemes.lock.read():
+                while len(selected) + len(candidates) < n_elements:
+                    r = self.select_next(
+                        scheme, selection, sample, user, tag, exclude, frame, filter
+                    )
+                    if "error" in r:
+                        break
+                    candidates.append(r)
+                    exclude.append(r["element_id"])
+            if len(candidates) == 0 or selection == "test":
+                selected += candidates
+                break
+
+            # reserve the ones still available
+            with self.schemes.lock.write():
+                ids = [
+                    i["element_id"]
+                    for i in candidates
+                    if sample != "untagged"
+                    or self.schemes.sampler.is_untagged(scheme, i["element_id"])
+                ]
+                ids = self.schemes.sampler.reserve(scheme, ids, user, lease)
+            selected += [i for i in candidates if i["element_id"] in ids]
+            if len(ids) == len(candidates):
+                break
+
+        if len(selected) == 0:
+            return r
+
+        if selection == "test":
+            return {
+                "success": [self.format_test_element(i["element_id"]) for i in selected]
+            }
+
+        # get the tags of the elements in one query
+        with self.schemes.lock.read():
+            histories = self.schemes.db_manager.get_annotations_by_elements(
+                self.params.project_slug, scheme, [i["element_id"] for i in selected]
+            )
+            return {
+                "success": [
+                    self.format_element(
+                        i["element_id"],
+                        scheme,
+                        user,
+                        selection,
+                        i["info"],
+                        frame,
+                        histories.get(i["element_id"], []),
+                    )
+                    for i in selected
+                ]
+            }
+
+    def select_next(
+        self,
+        scheme: str,
+        selection: str = "deterministic",
+        sample: str = "untagged",
+        user: str = "user",
+        tag: None | str = None,
+        history: list = [],
+        frame: None | list = None,
+        filter: str | None = None,
+    ) -> dict:
+        """
+        Select the id of the next element
+        Return {"element_id", "info"} or an error
         """
 
         if scheme not in self.schemes.available():
@@ -1610,139 +3453,129 @@ class Project(Server):
         if selection == "test":
             df = self.schemes.get_scheme_data(scheme, complete=True, kind=["test"])
             f = df["labels"].isnull()
-            element_id = df[f].sample(random_state=42).index[0]
-            element = {
-                "element_id": str(element_id),
-                "text": df.loc[element_id, "text"],
-                "selection": "test",
-                "context": {},
-                "info": "",
-                "predict": {"label": None, "proba": None},
-                "frame": [],
-                "limit": 1200,
-                "history": [],
-            }
-            return element
-
-        # select the current state of annotation
-        df = self.schemes.get_scheme_data(scheme, complete=True)
-
-        # build filters regarding the selection mode
-        f = df["labels"].apply(lambda x: True)
-        if sample == "untagged":
-            f = df["labels"].isnull()
-        if sample == "tagged":
-            f = df["labels"].notnull()
+            ss = df[f].drop(history, errors="ignore")
+            if len(ss) == 0:
+                return {"error": "No element available with this selection mode."}
+            element_id = ss.sample(random_state=42).index[0]
+            return {"element_id": str(element_id), "info": ""}
 
-        # add a regex condition to the selection
-        if filter:
-            if "CONTEXT=" in filter:  # case to search in the context
-                f_regex = (
-                    df[self.params.cols_context]
-                    .apply(lambda row: " ".join(row.values.astype(str)), axis=1)
-                    .str.contains(
-                        filter.replace("CONTEXT=", ""), regex=True, case=True, na=False
-                    )
-                )
-            else:
-                f_regex = df["text"].str.contains(
-                    filter, regex=True, case=True, na=False
-                )
-            f = f & f_regex
+        # elements reserved by other users
+        history = list(history) + self.schemes.sampler.reserved(scheme, user)
 
         # manage frame selection (if projection, only in the box)
+        f_frame = None
         if frame and len(frame) == 4:
             if user in self.features.projections:
                 if "data" in self.features.projections[user]:
                     projection = self.features.projections[user]["data"]
-                    f_frame = (
-                        (projection[0] > frame[0])
-                        & (projection[0] < frame[1])
-                        & (projection[1] > frame[2])
-                        & (projection[1] < frame[3])
-                    )
-                    f = f & f_frame
+                    f_frame = self.schemes.sampler.get_frame(projection, frame)
                 else:
                     return {"error": "Data projection doesn't exist for this user"}
             else:
                 return {"error": "Projection model doesn't exist for this user"}
 
-        # test if there is at least one element available
-        if sum(f) == 0:
-            return {"error": "No element available with this selection mode."}
-
-        # select type of selection
-        ss = df[f].drop(history, errors="ignore")
-        if len(ss) == 0:
-            return {"error": "No element available with this selection mode."}
         indicator = None
 
-        if selection == "deterministic":  # next row
-            element_id = ss.index[0]
-
-        if selection == "random":  # random row
-            element_id = ss.sample(frac=1, random_state=42).index[0]
+        # next/random row drawn from the precomputed pools
+        if selection in ["deterministic", "random"]:
+            element_id = self.schemes.sampler.draw(
+                scheme, selection, sample, history, filter, f_frame
+            )
+            if element_id is None:
+                return {"error": "No element available with this selection mode."}
 
-        # higher prob, only possible if the model has been trained
-        if selection == "maxprob":
+        # higher prob/entropy, only possible if the model has been trained
+        elif selection in ["maxprob", "active"]:
             if not self.simplemodels.exists(user, scheme):
                 return {"error": "Simplemodel doesn't exist"}
-            if tag is None:  # default label to first
+            if selection == "maxprob" and tag is None:  # default label to first
                 return {"error": "Select a tag"}
             sm = self.simplemodels.get_model(user, scheme)  # get model
-            proba = sm.proba.reindex(f.index)
-            # use the history to not send already tagged data
-            element_id = (
-                proba[f][tag]
-                .drop(history, errors="ignore")
-                .sort_values(ascending=False)
-                .index[0]
-            )  # get max proba id
-            indicator = f"probability: {round(proba.loc[element_id,tag],2)}"
-
-        # higher entropy, only possible if the model has been trained
-        if selection == "active":
-            if not self.simplemodels.exists(user, scheme):
-                return {"error": "Simplemodel doesn't exist"}
-            sm = self.simplemodels.get_model(user, scheme)  # get model
-            proba = sm.proba.reindex(f.index)
+            key = tag if selection == "maxprob" else "entropy"
+            if key not in sm.proba.columns:
+                return {"error": "Tag not predicted by the simplemodel"}
+
             # use the history to not send already tagged data
-            element_id = (
-                proba[f]["entropy"]
-                .drop(history, errors="ignore")
-                .sort_values(ascending=False)
-                .index[0]
-            )  # get max entropy id
-            indicator = round(proba.loc[element_id, "entropy"], 2)
-            indicator = f"entropy: {indicator}"
+            if sample == "untagged" and not filter and f_frame is None:
+                # priority heap of the model
+                r = sm.rankings[key].next(
+                    lambda i: self.schemes.sampler.is_untagged(scheme, i), history
+                )
+            else:
+                # other selections : max on the filtered elements
+                f = self.schemes.sampler.mask(scheme, sample, filter, f_frame)
+                f = pd.Series(f, index=self.schemes.content.index)
+                scores = (
+                    sm.proba[key][f.reindex(sm.proba.index, fill_value=False)]
+                    .drop(history, errors="ignore")
+                    .dropna()
+                )
+                r = None
+                if len(scores) > 0:
+                    r = (scores.idxmax(), scores.max())
+            if r is None:
+                return {"error": "No element available with this selection mode."}
+            element_id = r[0]
+            if selection == "maxprob":
+                indicator = f"probability: {round(r[1],2)}"
+            else:
+                indicator = f"entropy: {round(r[1],2)}"
+
+        else:
+            return {"error": "Selection mode doesn't exist"}
+
+        return {"element_id": element_id, "info": indicator}
+
+    def format_test_element(self, element_id: str) -> dict:
+        """
+        Element of the test set to annotate
+        """
+        return {
+            "element_id": str(element_id),
+            "text": self.schemes.test.loc[element_id, "text"],
+            "selection": "test",
+            "context": {},
+            "info": "",
+            "predict": {"label": None, "proba": None},
+            "frame": [],
+            "limit": 1200,
+            "history": [],
+        }
 
+    def format_element(
+        self,
+        element_id: str,
+        scheme: str,
+        user: str,
+        selection: str,
+        info: str | None,
+        frame: None | list,
+        history: list,
+    ) -> dict:
+        """
+        Element of the train set to annotate
+        with its text, context and prediction
+        """
         # get prediction of the id if it exists
         predict = {"label": None, "proba": None}
 
         if self.simplemodels.exists(user, scheme):
             sm = self.simplemodels.get_model(user, scheme)
-            predicted_label = sm.proba.loc[element_id, "prediction"]
-            predicted_proba = round(sm.proba.loc[element_id, predicted_label], 2)
-            predict = {"label": predicted_label, "proba": predicted_proba}
-
-        # get all tags already existing for the element
-        history = self.schemes.db_manager.get_annotations_by_element(
-            self.params.project_slug, scheme, element_id
-        )
+            if element_id in sm.proba.index:
+                predicted_label = sm.proba.loc[element_id, "prediction"]
+                predicted_proba = round(sm.proba.loc[element_id, predicted_label], 2)
+                predict = {"label": predicted_label, "proba": predicted_proba}
 
+        row = self.content.loc[element_id]
         element = {
             "element_id": element_id,
-            "text": self.content.fillna("NA").loc[element_id, "text"],
-            "context": dict(
-                self.content.fillna("NA")
-                .loc[element_id, self.params.cols_context]
-                .apply(str)
-            ),
+            "text": row.fillna("NA")["text"],
+            "context": dict(row[self.params.cols_context].fillna("NA").apply(str)),
             "selection": selection,
-            "info": indicator,
+            "info": info,
             "predict": predict,
             "frame": frame,
-            "limit": int(self.content.loc[element_id, "limit"]),
+            "limit": int(row["limit"]),
             "history": history,
         }
 
@@ -1920,6 +3753,61 @@ class Project(Server):
         self.features.add(name, f)
         return {"success": "regex added"}
 
+    def compute_feature(self, feature: FeatureModel, username: str) -> dict:
+        """
+        Launch the computation of a feature on the texts (sbert,
+        fasttext or dfm) in the queue
+        """
+        if feature.name in self.features.training:
+            return {"error": "This feature is already in training"}
+        df = self.content["text"]
+
+        # Add SBERT transformation
+        if feature.type == "sbert":
+            args = {
+                "texts": df,
+                "model": "distiluse-base-multilingual-cased-v1",
+                "path": self.features.path_embeddings(feature.name),
+                "path_models": self.path_models,
+            }
+            func = functions.to_sbert
+
+        # Add fasttext transformation
+        elif feature.type == "fasttext":
+            args = {
+                "texts": df,
+                "language": self.params.language,
+                "path_models": self.path_models,
+                "path": self.features.path_embeddings(feature.name),
+            }
+            func = functions.to_fasttext
+
+        # Add Data Frequency Matrice
+        elif feature.type == "dfm":
+            args = dict(feature.parameters)
+            args["texts"] = df
+            func = functions.to_dtm
+
+        else:
+            return {"error": "Not implemented"}
+
+        # add the computation to queue
+        unique_id = self.queue.add(
+            "feature",
+            func,
+            args,
+            project_slug=self.params.project_slug,
+            user=username,
+            name=feature.name,
+            location=args.get("path"),
+            params=feature.model_dump(),
+            lane="heavy" if feature.type in ["sbert", "fasttext"] else None,
+        )
+        if unique_id == "error":
+            return {"error": "Error in adding in the queue"}
+        self.features.training[feature.name] = unique_id
+        return {"success": unique_id}
+
     def export_features(self, features: list, format: str = "parquet"):
         """
         Export features data in different formats
@@ -1932,6 +3820,13 @@ class Project(Server):
             raise ValueError("Problem of filesystem for project")
 
         data = self.features.get(features)
+        # files are written dense
+        dense = {
+            c: t.subtype
+            for c, t in data.dtypes.items()
+            if isinstance(t, pd.SparseDtype)
+        }
+        data = data.astype(dense)
 
         file_name = f"extract_schemes_{self.name}.{format}"
 
@@ -21,3 +21,82 @@ def test_get_root_pwd(monkeypatch, capsys):
     assert root_password == "password123"
     assert "Password confirmed successfully." in captured.out
     assert "Creating the entry in the database..." in captured.out
+
+
+def test_cached_embeddings(tmp_path):
+    """
+    Test the embeddings cache : only new texts are encoded
+    """
+    import numpy as np
+    import pandas as pd
+    from functions import cached_embeddings
+
+    encoded = []
+
+    def encode(texts):
+        encoded.extend(texts)
+        return np.array([[len(t), 1.0] for t in texts])
+
+    texts = pd.Series(["a", "bb", "a", "ccc"])
+    emb = cached_embeddings(texts, "model", tmp_path, encode)
+    assert emb.tolist() == [[1, 1], [2, 1], [1, 1], [3, 1]]
+    assert sorted(encoded) == ["a", "bb", "ccc"]
+
+    # second call with overlapping texts
+    encoded.clear()
+    emb = cached_embeddings(pd.Series(["dddd", "bb"]), "model", tmp_path, encode)
+    assert emb.tolist() == [[4, 1], [2, 1]]
+    assert encoded == ["dddd"]
+
+    # shards merged in one, still found in the cache
+    from functions import merge_embeddings
+
+    directory = tmp_path / "model"
+    assert len(list(directory.glob("*.keys.npy"))) == 2
+    merge_embeddings(directory, max_shards=1)
+    assert len(list(directory.glob("*.keys.npy"))) == 1
+    assert len(list(directory.glob("*.npy"))) == 2
+    encoded.clear()
+    texts = pd.Series(["ccc", "dddd", "a", "bb"])
+    emb = cached_embeddings(texts, "model", tmp_path, encode)
+    assert emb.tolist() == [[3, 1], [4, 1], [1, 1], [2, 1]]
+    assert encoded == []
+
+
+def test_rwlock():
+    """
+    Test the readers-writer lock
+    """
+    import threading
+    import time
+    from functions import RWLock
+
+    lock = RWLock()
+    events = []
+
+    def reader():
+        with lock.read():
+            events.append("read")
+            time.sleep(0.2)
+
+    def writer():
+        with lock.write():
+            events.append("write")
+
+    # several readers at the same time, the writer after them
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    for t in readers:
+        t.start()
+    time.sleep(0.05)
+    w = threading.Thread(target=writer)
+    w.start()
+    for t in readers + [w]:
+        t.join()
+    assert events == ["read", "read", "write"]
+
+    # the writer can take the lock again
+    with lock.write():
+        with lock.read():
+            with lock.write():
+                pass
+    assert lock.writer is None
@@ -1,6 +1,7 @@
 import os
 import shutil
 
+import pandas as pd
 import pytest
 from activetigger.datamodels import ProjectDataModel
 from activetigger.server import Server
@@ -114,6 +115,384 @@ def test_scheme(project):
     assert len(available) == 1
 
 
+def test_labels_cache(project):
+
+    r = project.schemes.add_scheme("test", ["A", "B"])
+    assert not "error" in r
+    element_id = project.content.index[0]
+
+    # ADD
+    r = project.schemes.push_tag(element_id, "A", "test", "test", "train")
+    assert not "error" in r
+    df = project.schemes.get_scheme_data("test")
+    assert df.loc[element_id, "labels"] == "A"
+
+    # UPDATE
+    project.schemes.push_tag(element_id, "B", "test", "test", "train")
+    df = project.schemes.get_scheme_data("test")
+    assert len(df) == 1
+    assert df.loc[element_id, "labels"] == "B"
+
+    # DELETE
+    project.schemes.delete_tag(element_id, "test", "test")
+    df = project.schemes.get_scheme_data("test", complete=True)
+    assert df["labels"].isnull().all()
+
+    # same state when rebuilt from the database
+    cache = project.schemes.labels.elements("test", ["add"])
+    cache = {i: j[0] for i, j in cache.items()}
+    project.schemes.labels.load()
+    reloaded = project.schemes.labels.elements("test", ["add"])
+    assert {i: j[0] for i, j in reloaded.items()} == cache
+
+
+def test_push_tags(project):
+
+    project.schemes.add_scheme("test", ["A", "B"])
+    ids = [str(i) for i in project.content.index[:3]]
+
+    # bulk with a wrong tag is refused
+    r = project.schemes.push_tags(ids, ["A", "C", "B"], "test", "test")
+    assert "error" in r
+
+    r = project.schemes.push_tags(ids, ["A", "A", "B"], "test", "test")
+    assert not "error" in r
+    assert not project.schemes.sampler.is_untagged("test", ids[0])
+
+    # relabel
+    r = project.schemes.convert_tags("A", "B", "test", "test")
+    assert not "error" in r
+    df = project.schemes.get_scheme_data("test")
+    assert (df.loc[ids, "labels"] == "B").all()
+    current = project.db_manager.get_scheme_elements(project.name, "test", ["add"])
+    assert {i[0]: i[1] for i in current} == {i: "B" for i in ids}
+
+
+def test_get_next(project):
+
+    project.schemes.add_scheme("test", ["A", "B"])
+    first = project.content.index[0]
+
+    # DETERMINISTIC
+    r = project.get_next("test", "deterministic", "untagged")
+    assert r["element_id"] == first
+    r = project.get_next("test", "deterministic", "untagged", history=[first])
+    assert r["element_id"] != first
+
+    # the pools follow the annotations
+    project.schemes.push_tag(first, "A", "test", "test", "train")
+    r = project.get_next("test", "deterministic", "untagged")
+    assert r["element_id"] != first
+    r = project.get_next("test", "deterministic", "tagged")
+    assert r["element_id"] == first
+
+    # RANDOM
+    r = project.get_next("test", "random", "tagged", history=[first])
+    assert "error" in r
+    r = project.get_next("test", "random", "untagged")
+    assert r["element_id"] != first
+
+    # ACTIVE, the heap follows the annotations
+    from activetigger.models import SimpleModel
+
+    index = project.content.index
+    sm = SimpleModel("liblinear", "test", None, None, ["A", "B"], "", [], False, {})
+    sm.proba = pd.DataFrame(
+        {"A": 0.5, "entropy": range(len(index)), "prediction": "A"}, index=index
+    )
+    sm.compute_rankings()
+    project.simplemodels.existing["test"] = {"test": sm}
+    project.simplemodels.manifest["test"] = {"test": {}}
+    r = project.get_next("test", "active", "untagged", user="test")
+    assert r["element_id"] == index[-1]
+    project.schemes.push_tag(index[-1], "A", "test", "test", "train")
+    r = project.get_next("test", "active", "untagged", user="test")
+    assert r["element_id"] == index[-2]
+    project.schemes.delete_tag(index[-1], "test", "test")
+    r = project.get_next("test", "active", "untagged", user="test")
+    assert r["element_id"] == index[-1]
+
+
+def test_get_next_batch(project):
+
+    project.schemes.add_scheme("test", ["A", "B"])
+
+    r = project.get_next_batch("test", 5, user="user1")
+    assert not "error" in r
+    ids = [e["element_id"] for e in r["success"]]
+    assert ids == list(project.content.index[0:5])
+
+    # reserved elements are not sent to another user
+    r = project.get_next("test", "deterministic", "untagged", user="user2")
+    assert r["element_id"] not in ids
+    r = project.get_next("test", "deterministic", "untagged", user="user1")
+    assert r["element_id"] == ids[0]
+
+    # released once annotated
+    project.schemes.push_tag(ids[1], None, "test", "user1", "train")
+    r = project.get_next("test", "deterministic", "untagged", user="user2")
+    assert r["element_id"] == ids[1]
+
+    # an element reserved meanwhile is not taken again
+    sampler = project.schemes.sampler
+    assert sampler.reserve("test", [ids[1], ids[2]], "user2", 300) == [ids[1]]
+
+    # concurrent users get different elements
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(4) as executor:
+        batches = list(
+            executor.map(
+                lambda u: project.get_next_batch("test", 5, user=u)["success"],
+                ["user3", "user4", "user5", "user6"],
+            )
+        )
+    ids = [e["element_id"] for b in batches for e in b]
+    assert len(ids) == 20 and len(set(ids)) == 20
+
+
+def test_features(project):
+
+    r = project.add_regex("regex_test", "a")
+    assert not "error" in r
+    assert "regex_test" in project.features.map
+    df = project.features.get("regex_test")
+    assert len(df) == len(project.content)
+    assert list(df.columns) == ["regex_test__text"]
+
+    # one file per feature, listed in the manifest
+    assert (project.features.dir / "manifest.json").exists()
+    file = project.features.dir / project.features.manifest["regex_test"]["file"]
+    assert file.exists()
+
+    # DELETE
+    r = project.features.delete("regex_test")
+    assert not "error" in r
+    assert not file.exists()
+    assert "regex_test" not in project.features.map
+
+
+def test_attach_interrupted_jobs(project):
+    db_manager = project.db_manager
+
+    # an interrupted feature launched again, the others reported
+    params = {"type": "dfm", "name": "dfm_again", "parameters": {}}
+    db_manager.add_job("f", "feature", "test", "test", "dfm_again", "", None, params)
+    db_manager.add_job("p", "prediction", "test", "test", "model", "", None, None)
+    for i in ["f", "p"]:
+        db_manager.update_job(i, "interrupted")
+    project.attach_jobs()
+    assert [j["id"] for j in db_manager.get_jobs(["resubmitted"])] == ["f"]
+    assert "dfm_again" in project.features.training
+    assert [j["id"] for j in db_manager.get_jobs(["abandoned"])] == ["p"]
+    logs = db_manager.get_logs("test", "test", 10)
+    assert "prediction model interrupted" in logs[0]["action"]
+
+
+def test_features_sparse(project):
+    from activetigger.functions import fit_model, is_sparse, to_dtm
+    from sklearn.naive_bayes import MultinomialNB
+
+    dfm = to_dtm(project.content["text"], min_term_freq=1)["success"]
+    assert is_sparse(dfm)
+    project.features.add("dfm", dfm)
+    assert project.features.manifest["dfm"]["format"] == "npz"
+    df = project.features.get("dfm")
+    assert is_sparse(df)
+    assert df.shape == dfm.shape
+
+    # models use the sparse matrix directly
+    Y = pd.Series(None, index=df.index, dtype=object)
+    Y.iloc[0:10] = "A"
+    Y.iloc[10:20] = "B"
+    r = fit_model(MultinomialNB(), df, Y, ["A", "B"])
+    assert len(r["proba"]) == len(df)
+
+
+def test_features_embeddings(project):
+    import numpy as np
+    from activetigger.functions import write_embeddings
+
+    # embeddings written by a worker
+    emb = np.random.rand(len(project.content), 5)
+    path = project.features.path_embeddings("sbert")
+    write_embeddings(emb, path)
+    r = project.features.add_embeddings("sbert", path, [f"sb{i}" for i in range(5)])
+    assert not "error" in r
+
+    # memory-mapped float32 array
+    df = project.features.get("sbert")
+    assert df.index.equals(project.content.index)
+    assert (df.dtypes == np.float32).all()
+    assert np.allclose(df.values, emb)
+
+
+def test_simplemodel_incremental(project):
+    import numpy as np
+    from activetigger.functions import fit_model, to_dtm, to_matrix
+    from activetigger.models import SimpleModel, SimpleModels
+    from sklearn.naive_bayes import MultinomialNB
+
+    df = to_dtm(project.content["text"], min_term_freq=1)["success"]
+    Y = pd.Series(None, index=df.index, dtype=object)
+    Y.iloc[0:10] = "A"
+    Y.iloc[10:20] = "B"
+    params = project.simplemodels.available_models["multi_naivebayes"]
+    r = fit_model(MultinomialNB(), df, Y, ["A", "B"], cv10=False)
+    assert r["cv10"] is None
+    sm = SimpleModel(
+        "multi_naivebayes",
+        "test",
+        df,
+        Y,
+        ["A", "B"],
+        "computing",
+        ["dfm"],
+        False,
+        params,
+    )
+    sm.model = r["model"]
+    sm.proba = r["proba"]
+
+    # saved without the features, loaded when needed
+    project.simplemodels.existing["test"] = {"default": sm}
+    project.simplemodels.dumps("test", "default")
+    simplemodels = SimpleModels("test", project.simplemodels.path, None)
+    assert simplemodels.exists("test", "default")
+    assert "test" not in simplemodels.existing
+    loaded = simplemodels.get_model("test", "default")
+    assert loaded.X is None
+    assert loaded.proba.equals(sm.proba)
+    X = to_matrix(df)
+    assert np.allclose(loaded.model.predict_proba(X), r["model"].predict_proba(X))
+
+    # only the new annotations are folded in
+    Y2 = Y.copy()
+    Y2.iloc[20:30] = "A"
+    model, delta = project.simplemodels.get_incremental(
+        sm, "multi_naivebayes", ["dfm"], params, False, Y2
+    )
+    assert sorted(delta) == sorted(df.index[20:30])
+    r_inc = fit_model(model, df, Y2, ["A", "B"], delta=delta, cv10=False)
+    r_full = fit_model(MultinomialNB(), df, Y2, ["A", "B"], cv10=False)
+    assert np.allclose(r_inc["proba"][["A", "B"]], r_full["proba"][["A", "B"]])
+
+    # a modified annotation needs a full training
+    Y2.iloc[0] = "B"
+    r = project.simplemodels.get_incremental(
+        sm, "multi_naivebayes", ["dfm"], params, False, Y2
+    )
+    assert r is None
+
+
+def test_simplemodel_saved(project):
+    import numpy as np
+    from activetigger.functions import fit_model, to_dtm, to_matrix
+    from activetigger.models import SimpleModel, SimpleModels
+
+    simplemodels = project.simplemodels
+    df = to_dtm(project.content["text"], min_term_freq=1)["success"]
+    Y = pd.Series(None, index=df.index, dtype=object)
+    Y.iloc[0:10] = "A"
+    Y.iloc[10:20] = "B"
+
+    # every model, trained on sparse and dense features
+    for X in [df, df.sparse.to_dense()]:
+        for name, params in simplemodels.available_models.items():
+            r = fit_model(
+                simplemodels.create_model(name, params), X, Y, ["A", "B"], cv10=False
+            )
+            sm = SimpleModel(
+                name, "test", X, Y, ["A", "B"], "computing", ["dfm"], False, params
+            )
+            sm.model = r["model"]
+            sm.proba = r["proba"]
+            simplemodels.existing["test"] = {"default": sm}
+            simplemodels.dumps("test", "default")
+            loaded = SimpleModels("test", simplemodels.path, None).get_model(
+                "test", "default"
+            )
+            M = to_matrix(X)
+            assert np.allclose(
+                loaded.model.predict_proba(M), r["model"].predict_proba(M)
+            )
+    del simplemodels.existing["test"]
+    del simplemodels.manifest["test"]
+
+
+def test_load_skops(tmp_path):
+    import scipy.sparse as sp
+    import skops.io as sio
+    from activetigger.models import load_skops
+
+    # only the exact types trusted, not their modules
+    sio.dump({"X": sp.csr_matrix([[0, 1]])}, tmp_path / "csr.skops")
+    assert load_skops(tmp_path / "csr.skops")["X"].nnz == 1
+    sio.dump({"X": sp.coo_matrix([[0, 1]])}, tmp_path / "coo.skops")
+    with pytest.raises(ValueError):
+        load_skops(tmp_path / "coo.skops")
+
+
+def test_simplemodel_update_processes(project, monkeypatch):
+    import time
+
+    import activetigger.models as models
+
+    simplemodels = project.simplemodels
+    dump = models.sio.dump
+
+    # the model is saved without holding the lock
+    def unlocked_dump(*args, **kwargs):
+        assert simplemodels.lock.writer is None
+        return dump(*args, **kwargs)
+
+    monkeypatch.setattr(models.sio, "dump", unlocked_dump)
+    df = project.content[["text"]].copy()
+    df["labels"] = None
+    df.iloc[0:10, 1] = "A"
+    df.iloc[10:20, 1] = "B"
+    df["f"] = range(len(df))
+    simplemodels.add_simplemodel(
+        "test", "default", ["f"], "liblinear", df, "labels", ["f"], False
+    )
+    for _ in range(300):
+        simplemodels.update_processes()
+        if not simplemodels.computing and not simplemodels.validating:
+            break
+        time.sleep(0.1)
+    assert simplemodels.exists("test", "default")
+    assert simplemodels.manifest["test"]["default"]["cv10"] is not None
+    assert simplemodels.get_model("test", "default").X is None
+
+
+def test_simplemodel_autotrain(project):
+
+    simplemodels = project.simplemodels
+    assert "error" in simplemodels.set_autotrain("test", "default", 2, None)
+    simplemodels.manifest["test"] = {
+        "default": {
+            "name": "liblinear",
+            "features": ["sbert"],
+            "params": {"cost": 1},
+            "standardize": True,
+        }
+    }
+    assert "success" in simplemodels.set_autotrain("test", "default", 2, None)
+
+    # trained again every 2 annotations
+    assert not simplemodels.add_annotations("default")
+    assert simplemodels.add_annotations("default")
+    r = simplemodels.get_autotrain()
+    assert r[0][0] == "test"
+    assert r[0][1]["model"] == "liblinear"
+    assert simplemodels.get_autotrain() == []
+
+    # only one training at a time
+    simplemodels.add_annotations("default", 2)
+    simplemodels.computing["test"] = {"default": {}}
+    assert simplemodels.get_autotrain() == []
+
+
 # def test_add_label():
 #     return None
 
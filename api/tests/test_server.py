@@ -4,7 +4,9 @@ from activetigger.server import Server, Queue, Users
 import os
 import shutil
 import sqlalchemy
+import threading
 import time
+import numpy as np
 
 from activetigger.datamodels import ProjectDataModel
 
@@ -98,6 +100,139 @@ def test_state_queue():
     queue.close()
 
 
+def dummy_job(x, **kwargs):
+    return {"success": x * 2}
+
+
+def sleep_job(duration=1, **kwargs):
+    time.sleep(duration)
+    return {"success": True}
+
+
+def frame_job(df, **kwargs):
+    return {"success": df * 2}
+
+
+def test_handles_queue():
+    import pandas as pd
+
+    queue = Queue(2)
+
+    # dataframes exchanged as files
+    df = pd.DataFrame({"a": [1.0, 2.0]}, index=["x", "y"])
+    num = queue.add("test", frame_job, {"df": df})
+    r = queue.current[num]["future"].result()
+    assert r["success"].equals(df * 2)
+    assert len(os.listdir(queue.path)) == 0
+
+    queue.close()
+
+
+def test_scheduler_queue():
+
+    queue = Queue(2)
+
+    # fair share : the job of b starts before the third job of a
+    a1 = queue.add("test", sleep_job, {}, user="a")
+    a2 = queue.add("test", sleep_job, {"duration": 3}, user="a")
+    a3 = queue.add("test", sleep_job, {}, user="a")
+    b1 = queue.add("test", sleep_job, {}, user="b")
+    state = queue.state()
+    assert state[a2]["state"] == "running"
+    assert state[a3]["state"] == "pending"
+    assert state[b1]["state"] == "pending"
+    queue.current[a1]["future"].result()
+    for _ in range(20):
+        if queue.state()[b1]["state"] == "running":
+            break
+        time.sleep(0.1)
+    state = queue.state()
+    assert state[a3]["state"] == "pending"
+    assert state[b1]["state"] == "running"
+
+    # separate lane for heavy jobs
+    t = queue.add("training", sleep_job, {}, user="a")
+    assert queue.state()[t]["lane"] == "heavy"
+    assert queue.state()[t]["state"] == "running"
+
+    # a waiting job can be killed
+    assert "success" in queue.kill(a3)
+    queue.current[b1]["future"].result()
+    assert len(queue.waiting) == 0
+
+    queue.close()
+
+
+def progress_job(progress=None, unique_id=None, **kwargs):
+    from activetigger.functions import report_progress
+
+    report_progress(progress, unique_id, done=1, total=2)
+    time.sleep(3)
+    return {"success": True}
+
+
+def stubborn_job(**kwargs):
+    time.sleep(30)
+    return {"success": True}
+
+
+def test_progress_kill_queue():
+
+    queue = Queue(2)
+
+    # progress reported by the job
+    p = queue.add("test", progress_job, {})
+    for _ in range(50):
+        if queue.state()[p].get("progress") is not None:
+            break
+        time.sleep(0.1)
+    assert queue.state()[p]["progress"] == 0.5
+    assert queue.state()[p]["eta"] is not None
+
+    # a job ignoring its event is killed with its worker
+    s = queue.add("test", stubborn_job, {})
+    for _ in range(50):
+        if "pid" in queue.progress.get(s, {}):
+            break
+        time.sleep(0.1)
+    executor = queue.executors["interactive"]
+    assert "success" in queue.kill(s, grace=0.1)
+    for _ in range(50):
+        if queue.executors["interactive"] is not executor:
+            break
+        time.sleep(0.1)
+    assert queue.executors["interactive"] is not executor
+    assert s not in queue.current
+
+    # the other job of the lane is sent again
+    assert queue.current[p]["future"].result(timeout=20) == {"success": True}
+
+    queue.close()
+
+
+def test_job_registry(start_server):
+    queue = start_server.queue
+    db_manager = start_server.db_manager
+
+    num = queue.add("test", dummy_job, {"x": 2}, project_slug="test", user="test")
+    assert db_manager.get_jobs(["running", "finished"])[0]["id"] == num
+    queue.current[num]["future"].result()
+    for _ in range(20):
+        if len(db_manager.get_jobs(["finished"])) > 0:
+            break
+        time.sleep(0.1)
+    assert [j["id"] for j in db_manager.get_jobs(["finished"])] == [num]
+    queue.delete(num)
+    assert len(db_manager.get_jobs(["collected"])) == 1
+
+    # a training running when the server stopped is cleaned
+    os.makedirs("bert/model")
+    db_manager.add_job("1", "training", "test", "test", "model", "", "bert/model", None)
+    start_server.recover_jobs()
+    assert not Path("bert/model").exists()
+    assert db_manager.get_jobs(["interrupted"])[0]["id"] == "1"
+
+
 ##############
 # Test Server#
 ##############
@@ -133,6 +268,7 @@ def test_db_existing(start_server):
         "logs",
         "tokens",
         "generations",
+        "current_annotations",
     ]
 
     inspector = sqlalchemy.inspect(engine)
@@ -155,14 +291,105 @@ def test_db_existing(start_server):
     assert len(users) == 1
 
 
+def test_current_annotations(start_server):
+    from activetigger.db import DatabaseManager, migrations
+
+    db_manager = start_server.db_manager
+    db_manager.post_annotation("p", "s", "1", "a", "u1", "add")
+    db_manager.post_annotation("p", "s", "2", "b", "u1", "add")
+    db_manager.post_annotation("p", "s", "1", "c", "u2", "add")
+    db_manager.post_annotation("p", "s", "2", "d", "u2", "test")
+    current = db_manager.get_current_annotations("p")
+    assert [(r[2], r[3]) for r in current] == [("2", "b"), ("1", "c"), ("2", "d")]
+    assert [r[:2] for r in db_manager.get_scheme_elements("p", "s", ["add"])] == [
+        ["1", "c"],
+        ["2", "b"],
+    ]
+
+    # built from the history for a former database (without versions)
+    engine = sqlalchemy.create_engine(f"sqlite:///{str(start_server.db)}")
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text("DROP TABLE current_annotations"))
+        connection.execute(sqlalchemy.text("DROP TABLE schema_version"))
+    db_manager = DatabaseManager(start_server.db)
+    assert db_manager.get_current_annotations("p") == current
+    assert db_manager.get_version() == len(migrations)
+
+    # migrated by one worker at a time, a lock left by a stopped worker removed
+    with engine.begin() as connection:
+        connection.execute(sqlalchemy.text("DROP TABLE current_annotations"))
+        connection.execute(sqlalchemy.text("DELETE FROM schema_version"))
+        connection.execute(
+            sqlalchemy.text(
+                "INSERT INTO schema_version (version, time) "
+                "VALUES (-1, '2000-01-01 00:00:00')"
+            )
+        )
+    threads = [
+        threading.Thread(target=DatabaseManager, args=(start_server.db,))
+        for _ in range(3)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db_manager.get_current_annotations("p") == current
+    assert db_manager.get_version() == len(migrations)
+    with engine.begin() as connection:
+        versions = connection.execute(
+            sqlalchemy.text("SELECT version FROM schema_version ORDER BY version")
+        ).fetchall()
+    assert [v[0] for v in versions] == list(range(1, len(migrations) + 1))
+
+
+def test_postgresql_dialect():
+    """
+    Statements of the database compiled for PostgreSQL
+    """
+    from sqlalchemy.dialects import postgresql
+    from sqlalchemy.schema import CreateIndex, CreateTable
+    from activetigger.db import Base, upsert_current_statement
+
+    dialect = postgresql.dialect()
+    for table in Base.metadata.sorted_tables:
+        CreateTable(table).compile(dialect=dialect)
+        for index in table.indexes:
+            CreateIndex(index).compile(dialect=dialect)
+    statement = upsert_current_statement("postgresql")
+    assert "ON CONFLICT" in str(statement.compile(dialect=dialect))
+
+
+def test_token_cache(start_server):
+    token = start_server.create_access_token({"sub": "root"})
+    assert start_server.decode_access_token(token)["sub"] == "root"
+    assert token in start_server.tokens
+    assert start_server.users.get_user("root").username == "root"
+
+    # revoked, no longer valid
+    start_server.revoke_access_token(token)
+    assert "error" in start_server.decode_access_token(token)
+
+    # user cache dropped when modified
+    start_server.users.add_user("test", "password", "manager", "root")
+    assert start_server.users.get_user("test").status == "manager"
+    start_server.users.delete_user("test")
+    assert "error" in start_server.users.get_user("test")
+
+
 def test_log(start_server):
-    # log action
+    # log action (written with the next batch)
     start_server.log_action("test", "test", "test", "test")
+    assert len(start_server.db_manager.logs) == 1
 
     # get element
     r = start_server.get_logs("test", "test", 10)
 
     assert len(r) > 0
+    assert len(start_server.db_manager.logs) == 0
+
+    # database in WAL mode
+    with start_server.db_manager.engine.connect() as connection:
+        assert connection.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
 
 
 @pytest.fixture
@@ -211,8 +438,167 @@ def test_create_delete_project(start_server, new_project):
     assert project.params.project_slug == "test"
     assert Path(project.params.dir).exists()
 
-    # delete project
+    # delete project (and the cached auth on it)
+    assert start_server.users.auth("root", "test") == "manager"
     r = start_server.delete_project(project.params.project_slug)
     assert not "error" in r
+    assert start_server.users.auth("root", "test") is None
 
     # TODO : ADD STRATIFICATION
+
+
+def test_evict_projects(start_server, new_project):
+    """
+    Projects loaded in stages, least recently used unloaded
+    """
+    start_server.create_project(new_project, "test")
+    start_server.create_project(
+        new_project.model_copy(update={"project_name": "test2"}), "test"
+    )
+
+    project = start_server.get_project("test")
+    assert not project.loaded("features")
+    assert project.memory_usage() > 0
+    assert len(project.content) > 0
+    assert project.loaded("content")
+    usage = project.memory_usage()
+    project.features
+    assert project.memory_usage() > usage
+
+    # over the budget, only the last used project stays
+    start_server.max_memory = 0
+    start_server.get_project("test2")
+    assert list(start_server.projects) == ["test2"]
+
+    # except the projects used by a request
+    with start_server.use_project("test") as project:
+        start_server.get_project("test2")
+        start_server.evict_projects()
+        assert list(start_server.projects) == ["test", "test2"]
+    start_server.evict_projects()
+    assert list(start_server.projects) == ["test2"]
+
+
+def test_single_flight_loading(start_server, new_project, monkeypatch):
+    """
+    Concurrent first requests load the project once
+    """
+    import threading
+    import activetigger.server
+
+    start_server.create_project(new_project, "test")
+    loaded = []
+
+    class CountedProject(activetigger.server.Project):
+        def __init__(self, *args, **kwargs):
+            loaded.append(args[0])
+            time.sleep(0.5)
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(activetigger.server, "Project", CountedProject)
+    projects = []
+    threads = [
+        threading.Thread(
+            target=lambda: projects.append(start_server.get_project("test"))
+        )
+        for _ in range(3)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert loaded == ["test"]
+    assert all(p is projects[0] for p in projects)
+
+
+def test_shared_workers(
+    monkeypatch, root_pwd, create_and_change_directory, new_project
+):
+    """
+    Two workers of the api sharing the database
+    """
+    monkeypatch.setattr("builtins.input", lambda _: root_pwd)
+    with open("config.yaml", "w") as f:
+        f.write("shared: true\n")
+    s1 = Server()
+    s2 = Server()
+    s2.worker = s2.queue.worker = "other"
+
+    # tokens of a worker are valid for the others
+    assert s1.SECRET_KEY == s2.SECRET_KEY
+    token = s1.create_access_token({"sub": "root"})
+    assert s2.decode_access_token(token)["sub"] == "root"
+
+    # annotations of a worker seen by the other
+    s1.create_project(new_project, "test")
+    p1 = s1.get_project("test")
+    p2 = s2.get_project("test")
+    element_id = str(p1.schemes.content.index[0])
+    p1.schemes.add_label("yes", "default", "test")
+    p1.schemes.push_tag(element_id, "yes", "default", "test")
+    assert s2.get_project("test") is p2
+    assert p2.schemes.labels.elements("default", ["add"])[element_id][0] == "yes"
+    assert not p2.schemes.sampler.is_untagged("default", element_id)
+
+    # own annotations not applied again, sync at most every second
+    p1.schemes.push_tag(element_id, None, "default", "test")
+    assert p1.schemes.labels.apply(p1.schemes.labels.read()) == []
+    p2.synced = time.time()
+    s2.get_project("test")
+    assert p2.schemes.labels.elements("default", ["add"])[element_id][0] == "yes"
+    p2.synced = 0
+    threads = [
+        threading.Thread(target=s2.get_project, args=("test",)) for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert p2.schemes.labels.elements("default", ["add"])[element_id][0] is None
+    assert p2.schemes.sampler.is_untagged("default", element_id)
+
+    # elements leased by a worker not leased by the other
+    ids = [str(i) for i in p1.content.index[1:4]]
+    assert p1.schemes.sampler.reserve("default", ids, "a", 300) == ids
+    assert p2.schemes.sampler.reserve("default", ids[1:] + ids[:1], "b", 300) == []
+    assert sorted(p2.schemes.sampler.reserved("default", "b")) == sorted(ids)
+    assert p2.schemes.sampler.reserved("default", "a") == []
+    p1.schemes.push_tag(ids[0], "yes", "default", "a")
+    assert p2.schemes.sampler.reserve("default", ids, "b", 300) == ids[:1]
+
+    # jobs of a worker listed and killed by the other
+    s1.queue.check()
+    num = s1.queue.add("test", sleep_job, {"duration": 3}, user="test")
+    assert s2.queue.state()[num]["worker"] == s1.worker
+    assert "success" in s2.queue.kill_remote(num)
+    s1.queue.check()
+    assert num not in s1.queue.current
+
+    # a worker stopped, its jobs are interrupted
+    s2.db_manager.add_job("1", "test", "test", "test", None, "", None, None, "stopped")
+    s2.recover_jobs()
+    assert s2.db_manager.get_jobs(["interrupted"])[0]["id"] == "1"
+
+    # a job just recorded without its worker is not interrupted
+    s2.db_manager.add_job("4", "test", "test", "test", None, "", None, None)
+    s2.recover_jobs()
+    assert [j["id"] for j in s2.db_manager.get_jobs(["running"])] == ["4"]
+    s2.queue.timeout = 0
+    s2.recover_jobs()
+    assert s2.db_manager.get_jobs(["running"]) == []
+    s2.queue.timeout = 60
+
+    # finished jobs attached only by their worker, or once it stopped
+    os.makedirs(p1.features.dir, exist_ok=True)
+    location = p1.features.dir / "job.npy"
+    np.save(location, np.zeros((len(p1.content), 2), dtype=np.float32))
+    result = {"path": str(location), "columns": ["a", "b"]}
+    for i, worker in [("2", s1.worker), ("3", "stopped")]:
+        s2.db_manager.add_job(
+            i, "feature", "test", "test", f"f{i}", "", None, None, worker
+        )
+        s2.db_manager.update_job(i, "finished", result)
+    p2.attach_jobs()
+    assert [j["id"] for j in s2.db_manager.get_jobs(["finished"])] == ["2"]
+    assert "f2" not in p2.features.map
+    assert "f3" in p2.features.map